@@ -5,6 +5,8 @@ Description: Program searches excel files in current directory of script for
 Fiehn Lab HILIC internal standards.  Writes results to new sheet called "results.xlsx"
 that writes 'Y' if internal standards is foundand 'N' if internal standard is not
 found.  For untargeted metabolomics bootcamp paper focusing on MS-Dial output.
+The calibrated mode corrects the retention time and m/z drift of each file before
+matching and writes the drift of every file and standard to "drift.xlsx".
 Sources:
 https://automatetheboringstuff.com/
 http://prime.psc.riken.jp/Metabolomics_Software/MS-DIAL/
@@ -14,13 +16,34 @@ Standard exported output from MS-Dial
 
 import openpyxl
 import os.path
+import sys
+
+import numpy as np
+
+# shared MS-Dial reader lives with the data reduction scripts
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'Metabolomics-Automate-Data-Reduction'))
+import msdial
+
+# retention time (min) and m/z (Da) windows of a match
+RT_WINDOW = 0.05
+MZ_WINDOW = 0.005
+
+# wide retention time window (min) of the first pass that estimates the drift of a file
+CALIBRATION_RT_WINDOW = 0.5
+
+# fewest standards found in the first pass to correct drift, files with fewer are matched uncorrected
+MIN_CALIBRATION_STANDARDS = 3
+
+# workbooks written by this script, never searched for standards
+RESULTS_FILE = 'results.xlsx'
+DRIFT_FILE = 'drift.xlsx'
 
 # return list of excel documents in folder
 def getExcelSheets():
     excelSheets = []
     for file in os.listdir():
         if file[-5:] == '.xlsx':
-            if file[0] != '~':
+            if file[0] != '~' and file not in (RESULTS_FILE, DRIFT_FILE):
                 excelSheets.append(os.path.join(os.getcwd(), file))
     return excelSheets
 
@@ -29,10 +52,22 @@ def getFileName(excelSheets, index):
     split = excelSheets[index].split(os.path.sep)
     return split[-1]
 
-# opens and returns workbook of current excel sheet
-def openWorkBook(excelSheets, index):
-    wb = openpyxl.load_workbook(excelSheets[index])
-    return wb
+# reads retention times and m/z values of all features in current excel sheet
+def readExport(excelSheets, index):
+    export = msdial.read_export(excelSheets[index])
+    retentionTimes = msdial.metadata_column(export, msdial.RT_COLUMNS).to_numpy(dtype=float)
+    massToCharges = msdial.metadata_column(export, msdial.MZ_COLUMNS).to_numpy(dtype=float)
+    return retentionTimes, massToCharges
+
+# reads retention times, m/z values, and average height over all sample columns of every feature
+def readFeatures(excelSheets, index):
+    export = msdial.read_export(excelSheets[index])
+    retentionTimes = msdial.metadata_column(export, msdial.RT_COLUMNS).to_numpy(dtype=float)
+    massToCharges = msdial.metadata_column(export, msdial.MZ_COLUMNS).to_numpy(dtype=float)
+    heights = np.full(len(massToCharges), np.nan)
+    if export.heights.shape[1]:
+        heights = export.heights.mean(axis=1, dtype=float)
+    return retentionTimes, massToCharges, heights
 
 # returns sheet of current workbook
 def makeSheet(wb):
@@ -53,37 +88,27 @@ def makeResultsWorkBook(standards):
         currentRow += 1
 
     sheet.cell(row=currentRow + 1, column=1).value = 'Count'
-    wb.save('results.xlsx')
+    wb.save(RESULTS_FILE)
     return wb
 
 # finds standards and writes results to return sheet
-def findStandards(sheet, results, currentRow, currentColumn, standards):
+def findStandards(retentionTimes, massToCharges, results, currentRow, currentColumn, standards):
     count = 0  # count number of internal standard found in each file
-    found = False  # bool if individual standard is found, changes to true
 
     # top results row with filename
     results.cell(row=1, column=currentColumn).value = fileName
 
     # loop through all internal standards in standard dictionary
     for name in standards:
+        libraryRetentionTime = standards[name]['rt']
+        libraryMassToCharge = standards[name]['mz']
 
-        found = False  # reset found for each standard
-
-        # check to find mz and rt match
-        for rowNum in range(5, sheet.max_row):
-            retentionTime = float(sheet.cell(row=rowNum, column=2).value)
-            libraryRetentionTime = standards[name]['rt']
-
-            # retention time match
-            if retentionTime < (libraryRetentionTime + 0.05) and retentionTime > (libraryRetentionTime - 0.05):
-                massToCharge = float(sheet.cell(row=rowNum, column=3).value)
-                libraryMassToCharge = standards[name]['mz']
-
-                # mz match
-                if massToCharge < (libraryMassToCharge + 0.005) and massToCharge > (libraryMassToCharge - 0.005):
-                    if found == False:
-                        count +=1
-                        found = True
+        # check all features at once for retention time and mz match
+        rtMatch = np.abs(retentionTimes - libraryRetentionTime) < RT_WINDOW
+        mzMatch = np.abs(massToCharges - libraryMassToCharge) < MZ_WINDOW
+        found = bool(np.any(rtMatch & mzMatch))
+        if found:
+            count += 1
 
         # write result to 'results.xlsx'
         if found:
@@ -95,6 +120,120 @@ def findStandards(sheet, results, currentRow, currentColumn, standards):
     # print count
     results.cell(row=currentRow + 1, column=currentColumn).value = count
 
+# sorts features by m/z once, so every standard is looked up by binary search instead of a scan of all features
+def buildIndex(massToCharges):
+    order = np.argsort(massToCharges, kind='stable')
+    return order, massToCharges[order]
+
+# returns the best feature of every standard within the windows, -1 where no feature is within them
+def matchStandards(index, retentionTimes, massToCharges, libraryRetentionTimes, libraryMassToCharges,
+                   rtWindow=RT_WINDOW, mzWindow=MZ_WINDOW):
+    order, sortedMassToCharges = index
+
+    # features within the m/z window of each standard are one contiguous run of the index
+    starts = np.searchsorted(sortedMassToCharges, libraryMassToCharges - mzWindow, side='left')
+    counts = np.searchsorted(sortedMassToCharges, libraryMassToCharges + mzWindow, side='right') - starts
+
+    # every standard and feature pair in the m/z window, scored by its distance relative to the windows
+    pairStandards = np.repeat(np.arange(len(libraryMassToCharges)), counts)
+    offsets = np.arange(counts.sum()) - np.repeat(np.cumsum(counts) - counts, counts)
+    pairFeatures = order[np.repeat(starts, counts) + offsets]
+    rtError = np.abs(retentionTimes[pairFeatures] - libraryRetentionTimes[pairStandards])
+    mzError = np.abs(massToCharges[pairFeatures] - libraryMassToCharges[pairStandards])
+    within = (rtError < rtWindow) & (mzError < mzWindow)
+    score = rtError[within] / rtWindow + mzError[within] / mzWindow
+    pairStandards = pairStandards[within]
+    pairFeatures = pairFeatures[within]
+
+    # closest pair of each standard is the first after sorting pairs by standard then score
+    ranked = np.lexsort((score, pairStandards))
+    matched, first = np.unique(pairStandards[ranked], return_index=True)
+    best = np.full(len(libraryMassToCharges), -1)
+    best[matched] = pairFeatures[ranked][first]
+    return best
+
+# estimates the retention time shift (min) and m/z error (ppm) of a file from all standards found in a wide window
+def estimateDrift(index, retentionTimes, massToCharges, libraryRetentionTimes, libraryMassToCharges):
+    best = matchStandards(index, retentionTimes, massToCharges, libraryRetentionTimes, libraryMassToCharges,
+                          CALIBRATION_RT_WINDOW, MZ_WINDOW)
+    found = best >= 0
+    if found.sum() < MIN_CALIBRATION_STANDARDS:
+        return 0.0, 0.0, int(found.sum())
+
+    # medians are not moved by the odd standard matched to the wrong feature
+    rtShift = np.median(retentionTimes[best[found]] - libraryRetentionTimes[found])
+    ppmShift = np.median((massToCharges[best[found]] - libraryMassToCharges[found]) / libraryMassToCharges[found] * 1e6)
+    return float(rtShift), float(ppmShift), int(found.sum())
+
+# matches standards after correcting the drift of the file, returns drift summary and the best hit of every standard
+def calibrateStandards(retentionTimes, massToCharges, heights, standards):
+    names = list(standards)
+    libraryRetentionTimes = np.array([standards[name]['rt'] for name in names], dtype=float)
+    libraryMassToCharges = np.array([standards[name]['mz'] for name in names], dtype=float)
+    index = buildIndex(massToCharges)
+
+    rtShift, ppmShift, calibrationStandards = estimateDrift(
+        index, retentionTimes, massToCharges, libraryRetentionTimes, libraryMassToCharges)
+
+    # rematch with the windows centered on the shifted library values
+    best = matchStandards(index, retentionTimes, massToCharges, libraryRetentionTimes + rtShift,
+                          libraryMassToCharges * (1 + ppmShift / 1e6))
+
+    hits = []
+    for position, name in enumerate(names):
+        feature = best[position]
+        libraryRetentionTime = standards[name]['rt']
+        libraryMassToCharge = standards[name]['mz']
+        if feature < 0:
+            hits.append([name, libraryRetentionTime, None, None, libraryMassToCharge, None, None, None])
+            continue
+
+        observedRetentionTime = float(retentionTimes[feature])
+        observedMassToCharge = float(massToCharges[feature])
+        ppmError = (observedMassToCharge - libraryMassToCharge) / libraryMassToCharge * 1e6
+        hits.append([name, libraryRetentionTime, observedRetentionTime,
+                     round(observedRetentionTime - libraryRetentionTime, 4),
+                     libraryMassToCharge, observedMassToCharge, round(ppmError, 2), float(heights[feature])])
+
+    drift = [round(rtShift, 4), round(ppmShift, 2), calibrationStandards, int((best >= 0).sum())]
+    return drift, hits
+
+# writes found standards of one file to the results sheet from the calibrated hits
+def writeCalibratedResults(hits, fileName, results, currentRow, currentColumn):
+    results.cell(row=1, column=currentColumn).value = fileName
+    for hit in hits:
+        results.cell(row=currentRow, column=currentColumn).value = 'N' if hit[2] is None else 'Y'
+        currentRow += 1
+
+    results.cell(row=currentRow + 1, column=currentColumn).value = sum(hit[2] is not None for hit in hits)
+
+# writes the drift of every file and the best hit of every standard in every file to 'drift.xlsx'
+def writeDriftWorkBook(fileDrifts, fileHits, fileLocation=DRIFT_FILE):
+    wb = openpyxl.Workbook(write_only=True)
+
+    files = wb.create_sheet('Files')
+    files.append(['File', 'RT Shift (min)', 'm/z Error (ppm)', 'Calibration Standards', 'Standards Found'])
+    for fileName, drift in fileDrifts:
+        files.append([fileName] + drift)
+
+    hits = wb.create_sheet('Standards')
+    hits.append(['File', 'Standard Name', 'Library RT', 'Observed RT', 'RT Error (min)', 'Library m/z',
+                 'Observed m/z', 'm/z Error (ppm)', 'Height'])
+    for fileName, standardHits in fileHits:
+        for hit in standardHits:
+            hits.append([fileName] + hit)
+
+    wb.save(fileLocation)
+
+#select between Y/N search and drift calibrated search, return int for selection
+def selectMode():
+    print('Please select a mode:\n')
+    print('1) found (Y/N)')
+    print('2) drift calibrated (RT, m/z error, and height of every standard)')
+
+    choice = input()
+    return int(choice)
+
 #select between HILIC and CSH, return int for selection
 def selectMethod():
     print('Please select a method:\n')
@@ -168,6 +307,7 @@ if __name__ == "__main__":
 
     #select standards to look for
     standards = getStandards(selectMethod())
+    mode = selectMode()
 
     # initialize excelSheets list and open results file
     excelSheets = getExcelSheets()
@@ -178,16 +318,29 @@ if __name__ == "__main__":
     currentColumn = 2
     currentRow = 2
 
+    # drift and hits of every file for the calibrated mode
+    fileDrifts = []
+    fileHits = []
+
     # for each excel file found perform loop
     for index in range(len(excelSheets)):
         fileName = getFileName(excelSheets, index)
-        wb = openWorkBook(getExcelSheets(), index)
-        sheet = makeSheet(wb)
-        findStandards(sheet, results, currentRow, currentColumn, standards)
-        resultsWorkBook.save('results.xlsx')
+        if mode == 2:
+            retentionTimes, massToCharges, heights = readFeatures(excelSheets, index)
+            drift, hits = calibrateStandards(retentionTimes, massToCharges, heights, standards)
+            writeCalibratedResults(hits, fileName, results, currentRow, currentColumn)
+            fileDrifts.append((fileName, drift))
+            fileHits.append((fileName, hits))
+        else:
+            retentionTimes, massToCharges = readExport(excelSheets, index)
+            findStandards(retentionTimes, massToCharges, results, currentRow, currentColumn, standards)
+        resultsWorkBook.save(RESULTS_FILE)
 
         # update results row and column
         currentColumn += 1
         currentRow = 2
 
-print('exiting program\n')
\ No newline at end of file
+    if mode == 2:
+        writeDriftWorkBook(fileDrifts, fileHits)
+
+    print('exiting program\n')
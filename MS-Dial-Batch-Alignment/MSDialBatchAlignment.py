@@ -18,13 +18,21 @@ Standard exported output from MS-Dial
 
 import openpyxl
 import os.path
+import sys
+
+import numpy as np
+import pandas as pd
+
+# shared MS-Dial reader lives with the data reduction scripts
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'Metabolomics-Automate-Data-Reduction'))
+import msdial
 
 # return list of excel documents in folder
 def getExcelSheets():
     excelSheets = []
     for file in os.listdir():
         if file[-5:] == '.xlsx':
-            if file[0] != '~':
+            if file[0] != '~' and file != 'results.xlsx':
                 excelSheets.append(os.path.join(os.getcwd(), file))
     return excelSheets
 
@@ -33,56 +41,46 @@ def getFileName(excelSheets, index):
     split = excelSheets[index].split(os.path.sep)
     return split[-1]
 
-# opens and returns workbook of current excel sheet
-def openWorkBook(excelSheets, index):
-    wb = openpyxl.load_workbook(excelSheets[index])
-    return wb
+# reads export of current excel sheet, heights kept as float64 so values are copied exactly
+def readExport(excelSheets, index):
+    return msdial.read_export(excelSheets[index], dtype=np.float64)
+
+# returns annotation names of every feature in export
+def getNames(export):
+    return pd.Index(msdial.metadata_column(export, msdial.NAME_COLUMNS))
+
+# if feature matches, return study heights lined up with results rows, nan where no name matches
+def findMatch(studyExport, resultsNames):
+    studyNames = getNames(studyExport)
+
+    # when a name repeats in the study, the last row is the one kept
+    lastRows = np.flatnonzero(~studyNames.duplicated(keep='last'))
+    matchRows = studyNames[lastRows].get_indexer(resultsNames)
 
-# returns sheet of current workbook
-def makeSheet(wb):
-    sheets = wb.sheetnames
-    sheet = wb[sheets[0]]
-    return sheet
+    heights = studyExport.heights[lastRows[matchRows]]
+    heights[matchRows == -1] = np.nan
+    return heights
 
-# makes new sheet called results and returns sheet
-def makeResultsWorkBook():
-    wb = openpyxl.Workbook()
-    sheet = wb.active
+# writes results sheet with header rows, metadata of first sheet, and aligned heights of every sheet
+def writeResults(resultsExport, sampleInfo, samples, heights):
+    wb = openpyxl.Workbook(write_only=True)
+    sheet = wb.create_sheet()
+    metadataColumns = len(resultsExport.metadata.columns)
+
+    # rows above the header, labelled in the last metadata column
+    for label in sampleInfo.columns:
+        sheet.append([None] * (metadataColumns - 1) + [label] + sampleInfo[label].tolist())
+
+    sheet.append(list(resultsExport.metadata.columns) + samples)
+
+    # feature rows, missing heights are left as empty cells
+    metadata = resultsExport.metadata.astype(object).where(resultsExport.metadata.notna(), None).values.tolist()
+    values = heights.astype(object)
+    values[np.isnan(heights)] = None
+    for metadataRow, heightRow in zip(metadata, values.tolist()):
+        sheet.append(metadataRow + heightRow)
 
     wb.save('results.xlsx')
-    return wb
-
-# copys all of first sheet into results sheet
-def initializeResults(studySheet, resultsSheet):
-    for c in range(1, studySheet.max_column + 1):
-        for r in range(1, studySheet.max_row + 1):
-            resultsSheet.cell(row = r, column=c).value = studySheet.cell(row = r, column = c).value
-
-# copys sample informations from studySheet to resultsSheet
-def copySampleInformation(studySheet, resultsSheet):
-    count = 0
-    col = resultsSheet.max_column
-    for c in range(29, studySheet.max_column + 1):
-        count += 1
-        for r in range(1, 6):  
-            resultsSheet.cell(row = r, column = col + count).value = studySheet.cell(row = r, column = c).value
-    return col + 1
-
-# determines if name matches for features in study row and results row
-def nameMatch(studySheet, resultsSheet, studyRow, resultsRow):
-    if studySheet.cell(row = studyRow, column = 4).value == resultsSheet.cell(row = resultsRow, column = 4).value:
-        return True
-    return False
-
-# if feature matches, combine into results sheet
-def findMatch(studySheet, resultsSheet, colStart):
-    for studyRow in range(6, studySheet.max_row + 1):
-        studyColumn = 29
-        for resultsRow in range(6, resultsSheet.max_row + 1):
-            if nameMatch(studySheet, resultsSheet, studyRow, resultsRow):
-                for c in range(colStart, resultsSheet.max_column + 1):
-                    resultsSheet.cell(row = resultsRow, column = c).value = studySheet.cell(row = studyRow, column = studyColumn).value
-                    studyColumn += 1
     
 """
 Execute main program
@@ -92,21 +90,20 @@ if __name__ == "__main__":
 
     # initialize excelSheets
     excelSheets = getExcelSheets()
-    wb = [openWorkBook(getExcelSheets(), num) for num in range(len(excelSheets))]
-    sheet = [makeSheet(wb[num]) for num in range(len(wb))]
-    
-    # initialize results sheet
-    resultsWB = makeResultsWorkBook()
-    resultsSheet = makeSheet(resultsWB)
     
-    # combine information from all excel sheets into results sheet with features aligned
-    for i in range(len(sheet)):
+    # combine information from all excel sheets with features aligned to the first sheet
+    for i in range(len(excelSheets)):
+        print(getFileName(excelSheets, i))
+        export = readExport(excelSheets, i)
         if i == 0:
-            initializeResults(sheet[i], resultsSheet)
-            print(getFileName(excelSheets, i))
+            resultsExport = export
+            resultsNames = getNames(export)
+            sampleInfo = [export.sample_info]
+            samples = list(export.samples)
+            heights = [export.heights]
         else:
-            print(getFileName(excelSheets, i))
-            startColumn = copySampleInformation(sheet[i], resultsSheet)
-            findMatch(sheet[i], resultsSheet, startColumn)
-    resultsWB.save('results.xlsx')
-    print("done") 
\ No newline at end of file
+            sampleInfo.append(export.sample_info)
+            samples += export.samples
+            heights.append(findMatch(export, resultsNames))
+    writeResults(resultsExport, pd.concat(sampleInfo), samples, np.hstack(heights))
+    print("done")
\ No newline at end of file
@@ -0,0 +1,203 @@
+#!/usr/bin/env python
+
+""" batches.py: Batch of each injection and grouped per-batch reductions of blank heights """
+
+__author__ = "Bryan Roberts"
+
+import os
+
+import numpy as np
+import pandas as pd
+
+import sample_names  # local source
+
+# hours between injections that start a new batch when batches are taken from acquisition times
+BATCH_GAP_HOURS = 12
+
+# acquisition times written next to the raw data files by agilent_date_time_extractor.py
+FILE_TIMES_NAME = "file_times.csv"
+
+
+def from_batch_ids(columns, batch_ids):
+    """ batch of each column from the Batch ID row of an MS-Dial export
+
+    Parameters:
+            columns (list): injection columns
+            batch_ids (pandas series): Batch ID of every sample column of the export, indexed by column
+
+    Returns:
+            pandas series: batch label of each column, "unknown" for columns without a Batch ID
+
+    """
+
+    labels = batch_ids.reindex(columns).astype(object)
+
+    return pd.Series(
+        np.where(labels.isna(), "unknown", labels.astype(str)), index=pd.Index(columns, name="Sample"), name="Batch")
+
+
+def from_injection_order(columns, size):
+    """ batch of each column from its place in injection order, every size injections are one batch
+
+    Parameters:
+            columns (list): injection columns
+            size (int): injections per batch
+
+    Returns:
+            pandas series: batch label of each column, "1", "2", ... in injection order
+
+    """
+
+    assert size >= 1, "batch size must be at least 1"
+
+    injection = sample_names.parse(columns)["Injection"].to_numpy()
+
+    # columns without an injection number are placed after the numbered columns, as drift.injection_order does
+    order = np.argsort(np.where(np.isnan(injection), np.inf, injection), kind="stable")
+    position = np.empty(len(columns), dtype=np.int64)
+    position[order] = np.arange(len(columns))
+
+    return pd.Series(
+        (position // size + 1).astype(str), index=pd.Index(columns, name="Sample"), name="Batch")
+
+
+def from_acquisition_times(columns, times, gap_hours=BATCH_GAP_HOURS):
+    """ batch of each column from acquisition times, a new batch starts after a gap of more than gap_hours
+
+    Parameters:
+            columns (list): injection columns
+            times (pandas series): acquisition datetime of each column, indexed by column
+            gap_hours (float): hours without an injection that separate two batches
+
+    Returns:
+            pandas series: batch label of each column, "1", "2", ... in acquisition order, "unknown" without a time
+
+    """
+
+    acquired = pd.to_datetime(times.reindex(columns)).to_numpy(dtype="datetime64[ns]")
+    timed = np.flatnonzero(~np.isnat(acquired))
+    order = timed[np.argsort(acquired[timed], kind="stable")]
+
+    gaps = np.diff(acquired[order]) > np.timedelta64(int(gap_hours * 3600), "s")
+    labels = np.full(len(columns), "unknown", dtype=object)
+    labels[order] = (np.concatenate(([0], np.cumsum(gaps))) + 1).astype(str)
+
+    return pd.Series(labels, index=pd.Index(columns, name="Sample"), name="Batch")
+
+
+def read_file_times(file_location):
+    """ reads acquisition times of raw data files from file_times.csv, rows of file name, ctime, and mtime
+
+    Parameters:
+            file_location (str): Full directory path of file_times.csv
+
+    Returns:
+            pandas series: acquisition datetime of each file, indexed by file name without the .d extension
+
+    """
+
+    times = pd.read_csv(file_location, header=None, names=["File", "ctime", "mtime"])
+    names = times["File"].astype(str).map(lambda name: os.path.splitext(name)[0])
+
+    return pd.Series(
+        pd.to_datetime(times["mtime"], unit="s").to_numpy(), index=pd.Index(names, name="Sample"), name="Acquired")
+
+
+def group_means(heights, codes, count):
+    """ mean of the columns of each group for every row, one pass over heights whatever the number of groups
+
+    Columns are sorted by group once and every group is summed as a contiguous segment with np.add.reduceat.
+
+    Parameters:
+            heights (numpy array): float64 heights, one row per feature
+            codes (numpy array): group of each column, 0 to count - 1
+            count (int): number of groups
+
+    Returns:
+            numpy array: rows x count means, nan for groups without columns
+
+    """
+
+    means = np.full((len(heights), count), np.nan)
+    if not len(codes):
+
+        return means
+
+    order = np.argsort(codes, kind="stable")
+    groups, starts = np.unique(codes[order], return_index=True)
+    sizes = np.diff(np.append(starts, len(codes)))
+
+    means[:, groups] = np.add.reduceat(heights[:, order], starts, axis=1) / sizes
+
+    return means
+
+
+def blank_means(blank_heights, blank_codes, count):
+    """ blank mean of every feature in each batch, batches without blanks use the mean of all blanks
+
+    Parameters:
+            blank_heights (numpy array): float64 heights of the blank columns, one row per feature
+            blank_codes (numpy array): batch of each blank column, 0 to count - 1
+            count (int): number of batches
+
+    Returns:
+            numpy array: features x count blank means
+
+    """
+
+    means = group_means(blank_heights, blank_codes, count)
+    without_blanks = np.setdiff1d(np.arange(count), blank_codes)
+
+    if len(without_blanks):
+
+        with np.errstate(invalid="ignore"):
+
+            overall = blank_heights.mean(axis=1) if blank_heights.shape[1] else np.full(len(blank_heights), np.nan)
+
+        means[:, without_blanks] = overall[:, None]
+
+    return means
+
+
+def batch_fold2(sample_heights, sample_codes, means):
+    """ largest ratio of a sample height to the blank mean of its own batch, for every feature
+
+    With one batch this is Sample Max / Blank Mean.
+
+    Parameters:
+            sample_heights (numpy array): float64 heights of the study sample columns, one row per feature
+            sample_codes (numpy array): batch of each sample column
+            means (numpy array): features x batches blank means from blank_means
+
+    Returns:
+            numpy array: Fold 2 of each feature
+
+    """
+
+    if not sample_heights.shape[1]:
+
+        return np.full(len(sample_heights), np.nan)
+
+    with np.errstate(divide="ignore", invalid="ignore"):
+
+        return (sample_heights / means[:, sample_codes]).max(axis=1)
+
+
+def subtract_means(heights, codes, means):
+    """ heights minus the blank mean of the batch of each column, not below zero, nan blank means subtract nothing
+
+    Parameters:
+            heights (numpy array): float64 heights, one row per feature
+            codes (numpy array): batch of each column
+            means (numpy array): features x batches blank means from blank_means
+
+    Returns:
+            numpy array: blank subtracted heights
+
+    """
+
+    subtracted = heights - np.nan_to_num(means[:, codes])
+
+    with np.errstate(invalid="ignore"):
+
+        return np.where(subtracted < 0, 0.0, subtracted)
@@ -0,0 +1,177 @@
+#!/usr/bin/env python
+
+""" drift.py: QC-RSC signal drift correction of peak heights using pool qc injections and run order """
+
+__author__ = "Bryan Roberts"
+
+import numpy as np
+import pandas as pd
+
+import sample_names  # local source
+
+# number of features smoothed at once, bounds memory of the feature x injection work arrays
+CHUNK_SIZE = 2000
+
+
+def injection_order(columns):
+    """ orders sample columns by the injection number at the start of each sample name
+
+    Parameters:
+            columns (list): List of all sample columns from row 1
+
+    Returns:
+            run_order (list): sample columns sorted by injection number, columns without a number keep their place at the end
+
+    """
+
+    # sample names start with the client name followed by the injection number, ex: Bryan001_MX123456_posHILIC_ABA-01
+    injection = sample_names.parse(columns)["Injection"].to_numpy()
+    numbered = np.flatnonzero(~np.isnan(injection))
+    unnumbered = np.flatnonzero(np.isnan(injection))
+
+    # stable sort keeps columns with the same injection number in their original order
+    order = numbered[np.argsort(injection[numbered], kind="stable")]
+
+    return [columns[position] for position in order] + [columns[position] for position in unnumbered]
+
+
+def pool_cv(heights):
+    """ %CV of each feature across pool qc injections
+
+    Parameters:
+            heights (numpy array): features x pool injections peak heights
+
+    Returns:
+            numpy array of %CV rounded to 2 decimals for each feature
+
+    """
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+
+        cv = heights.std(axis=1, ddof=1) / heights.mean(axis=1) * 100
+
+    return np.round(cv, 2)
+
+
+def smoother_weights(qc_positions, positions, span):
+    """ tricube LOWESS weights of every pool qc injection for every injection in the run
+
+    Parameters:
+            qc_positions (numpy array): run order position of each pool qc injection
+            positions (numpy array): run order position of every injection to be corrected
+            span (float): fraction of pool qc injections used in each local fit
+
+    Returns:
+            weights (numpy array): injections x pool injections tricube weights
+            offsets (numpy array): injections x pool injections distance of each pool from the injection
+
+    """
+
+    offsets = qc_positions[np.newaxis, :] - positions[:, np.newaxis]
+    distance = np.abs(offsets)
+
+    # bandwidth is the distance to the furthest of the nearest span fraction of pools
+    neighbours = min(max(int(np.ceil(span * len(qc_positions))), 3), len(qc_positions))
+    bandwidth = np.partition(distance, neighbours - 1, axis=1)[:, neighbours - 1]
+    bandwidth = np.maximum(bandwidth, 1) * 1.0001
+
+    weights = np.clip(1 - (distance / bandwidth[:, np.newaxis]) ** 3, 0, None) ** 3
+
+    return weights, offsets
+
+
+def fit_drift(qc_heights, weights, offsets):
+    """ local linear fit of pool heights evaluated at every injection for a block of features
+
+    Zero heights are treated as missing and left out of each feature's fit, so the weighted sums are formed
+    for all features at once with matrix products instead of one regression per feature.
+
+    Parameters:
+            qc_heights (numpy array): features x pool injections peak heights
+            weights (numpy array): injections x pool injections tricube weights
+            offsets (numpy array): injections x pool injections distance of each pool from the injection
+
+    Returns:
+            fit (numpy array): features x injections fitted drift, nan where a feature cannot be fit
+
+    """
+
+    detected = (qc_heights > 0).astype(np.float64)
+    values = np.where(qc_heights > 0, qc_heights, 0.0)
+
+    weighted_offsets = weights * offsets
+
+    # weighted sums of the normal equations for every feature and injection
+    s0 = detected @ weights.T
+    s1 = detected @ weighted_offsets.T
+    s2 = detected @ (weighted_offsets * offsets).T
+    t0 = values @ weights.T
+    t1 = values @ weighted_offsets.T
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+
+        determinant = s0 * s2 - s1 ** 2
+        fit = (s2 * t0 - s1 * t1) / determinant
+
+        # fall back to the local weighted mean where the local line is not determined
+        flat = np.abs(determinant) <= 1e-9 * np.maximum(s0 * s2, 1e-300)
+        fit[flat] = (t0 / s0)[flat]
+
+    fit[(s0 <= 0) | ~np.isfinite(fit) | (fit <= 0)] = np.nan
+
+    return fit
+
+
+def correct_drift(data_frame, pools, run_order, span=0.5, min_pools=5):
+    """ corrects peak heights for signal drift by dividing each injection by a LOWESS fit of pool qc heights
+
+    Parameters:
+            data_frame (pandas data-frame): Currated data-frame containing peak heights for all samples and features
+            pools (list): List of all matrix matched pool qc samples from row 1
+            run_order (list): every sample column to be corrected in order of injection
+            span (float): fraction of pool qc injections used in each local fit
+            min_pools (int): features detected in fewer pool injections than this are left uncorrected
+
+    Returns:
+            cv (pandas data-frame): 'Pool %CV Before Correction' and 'Pool %CV After Correction' for each feature
+
+    """
+
+    assert (len(pools) >= 3), "drift correction needs at least 3 pool qc injections"
+    assert (set(pools) <= set(run_order)), "all pool qc injections must be in the run order"
+
+    positions = np.arange(len(run_order), dtype=np.float64)
+    position_of = {col: position for position, col in enumerate(run_order)}
+    qc_positions = np.array([position_of[col] for col in pools], dtype=np.float64)
+    qc_index = np.array([position_of[col] for col in pools])
+
+    weights, offsets = smoother_weights(qc_positions, positions, span)
+
+    heights = data_frame[run_order].to_numpy(dtype=np.float64)
+    corrected = heights.copy()
+
+    for start in range(0, len(heights), CHUNK_SIZE):
+
+        block = heights[start:start + CHUNK_SIZE]
+        qc_heights = block[:, qc_index]
+
+        fit = fit_drift(qc_heights, weights, offsets)
+
+        # rescale corrected heights back to the median pool height of each feature
+        with np.errstate(invalid='ignore'):
+
+            target = np.nanmedian(np.where(qc_heights > 0, qc_heights, np.nan), axis=1)
+
+        correctable = ((qc_heights > 0).sum(axis=1) >= min_pools)[:, np.newaxis] & np.isfinite(fit)
+        corrected[start:start + CHUNK_SIZE] = np.where(
+            correctable, block / np.where(correctable, fit, 1) * target[:, np.newaxis], block)
+
+    cv = pd.DataFrame({
+        'Pool %CV Before Correction': pool_cv(heights[:, qc_index]),
+        'Pool %CV After Correction': pool_cv(corrected[:, qc_index])},
+        index=data_frame.index)
+
+    # update peak heights in data frame
+    data_frame[run_order] = corrected
+
+    return cv
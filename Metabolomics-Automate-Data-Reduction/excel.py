@@ -0,0 +1,283 @@
+#!/usr/bin/env python
+
+""" excel.py: Streaming .xlsx writer, sheet xml is written row chunk by row chunk so memory does not grow with the table """
+
+__author__ = "Bryan Roberts"
+
+import math
+import re
+import zipfile
+from xml.sax.saxutils import escape
+
+import numpy as np
+import pandas as pd
+
+# largest sheet excel opens, tables larger than this are split across sheets
+MAX_ROWS = 1048576
+MAX_COLUMNS = 16384
+
+# rows formatted at a time, bounds memory of formatted xml
+CHUNK_ROWS = 1000
+
+# deflate level of sheet xml, repetitive xml compresses well even at the fastest level
+COMPRESSION_LEVEL = 1
+
+# characters xml 1.0 does not allow, removed from text cells
+ILLEGAL_CHARACTERS = re.compile("[\x00-\x08\x0b\x0c\x0e-\x1f]")
+
+CONTENT_TYPES = (
+    '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>\n'
+    '<Types xmlns="http://schemas.openxmlformats.org/package/2006/content-types">'
+    '<Default Extension="rels" ContentType="application/vnd.openxmlformats-package.relationships+xml"/>'
+    '<Default Extension="xml" ContentType="application/xml"/>'
+    '<Override PartName="/xl/workbook.xml" '
+    'ContentType="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet.main+xml"/>'
+    '<Override PartName="/xl/styles.xml" '
+    'ContentType="application/vnd.openxmlformats-officedocument.spreadsheetml.styles+xml"/>'
+    '{sheets}</Types>')
+
+SHEET_CONTENT_TYPE = (
+    '<Override PartName="/xl/worksheets/sheet{number}.xml" '
+    'ContentType="application/vnd.openxmlformats-officedocument.spreadsheetml.worksheet+xml"/>')
+
+PACKAGE_RELATIONSHIPS = (
+    '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>\n'
+    '<Relationships xmlns="http://schemas.openxmlformats.org/package/2006/relationships">'
+    '<Relationship Id="rId1" '
+    'Type="http://schemas.openxmlformats.org/officeDocument/2006/relationships/officeDocument" '
+    'Target="xl/workbook.xml"/></Relationships>')
+
+WORKBOOK = (
+    '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>\n'
+    '<workbook xmlns="http://schemas.openxmlformats.org/spreadsheetml/2006/main" '
+    'xmlns:r="http://schemas.openxmlformats.org/officeDocument/2006/relationships">'
+    '<sheets>{sheets}</sheets></workbook>')
+
+WORKBOOK_SHEET = '<sheet name="{name}" sheetId="{number}" r:id="rId{number}"/>'
+
+WORKBOOK_RELATIONSHIPS = (
+    '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>\n'
+    '<Relationships xmlns="http://schemas.openxmlformats.org/package/2006/relationships">'
+    '{sheets}<Relationship Id="rId{styles}" '
+    'Type="http://schemas.openxmlformats.org/officeDocument/2006/relationships/styles" Target="styles.xml"/>'
+    '</Relationships>')
+
+WORKBOOK_SHEET_RELATIONSHIP = (
+    '<Relationship Id="rId{number}" '
+    'Type="http://schemas.openxmlformats.org/officeDocument/2006/relationships/worksheet" '
+    'Target="worksheets/sheet{number}.xml"/>')
+
+# default style and a bold style for header cells, like pandas to_excel headers
+STYLES = (
+    '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>\n'
+    '<styleSheet xmlns="http://schemas.openxmlformats.org/spreadsheetml/2006/main">'
+    '<fonts count="2"><font><sz val="11"/><name val="Calibri"/></font>'
+    '<font><b/><sz val="11"/><name val="Calibri"/></font></fonts>'
+    '<fills count="2"><fill><patternFill patternType="none"/></fill>'
+    '<fill><patternFill patternType="gray125"/></fill></fills>'
+    '<borders count="1"><border><left/><right/><top/><bottom/><diagonal/></border></borders>'
+    '<cellStyleXfs count="1"><xf numFmtId="0" fontId="0" fillId="0" borderId="0"/></cellStyleXfs>'
+    '<cellXfs count="2"><xf numFmtId="0" fontId="0" fillId="0" borderId="0" xfId="0"/>'
+    '<xf numFmtId="0" fontId="1" fillId="0" borderId="0" xfId="0" applyFont="1"/></cellXfs>'
+    '<cellStyles count="1"><cellStyle name="Normal" xfId="0" builtinId="0"/></cellStyles>'
+    '</styleSheet>')
+
+SHEET_START = (
+    '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>\n'
+    '<worksheet xmlns="http://schemas.openxmlformats.org/spreadsheetml/2006/main"><sheetData>')
+
+SHEET_END = '</sheetData></worksheet>'
+
+EMPTY_CELL = '<c/>'
+
+
+def sheet_blocks(rows, columns, max_rows=MAX_ROWS, max_columns=MAX_COLUMNS):
+    """ row and column ranges of each sheet, every sheet keeps one row for the header
+
+    Parameters:
+            rows (int): number of data rows
+            columns (int): number of columns
+            max_rows (int): most rows of a sheet including the header
+            max_columns (int): most columns of a sheet
+
+    Returns:
+            blocks (list): (row range, column range) of each sheet, row blocks first then column blocks
+
+    """
+
+    row_starts = range(0, max(rows, 1), max_rows - 1)
+    column_starts = range(0, max(columns, 1), max_columns)
+
+    return [
+        (range(row, min(row + max_rows - 1, rows)), range(column, min(column + max_columns, columns)))
+        for row in row_starts
+        for column in column_starts]
+
+
+def sheet_names(sheet_name, count):
+    """ sheet_name for a single sheet, numbered names when a table is split """
+
+    if count == 1:
+
+        return [sheet_name]
+
+    return [f"{sheet_name[:25]} ({number})" for number in range(1, count + 1)]
+
+
+def text_cell(value, style=None):
+    """ inline string cell """
+
+    text = escape(ILLEGAL_CHARACTERS.sub("", value))
+    space = ' xml:space="preserve"' if text != text.strip() else ""
+    style = f' s="{style}"' if style is not None else ""
+
+    return f'<c t="inlineStr"{style}><is><t{space}>{text}</t></is></c>'
+
+
+def number_cell(value):
+    """ numeric cell, nan is left empty and infinity is written as text like pandas to_excel """
+
+    if math.isfinite(value):
+
+        return f'<c><v>{value!r}</v></c>'
+
+    if value != value:
+
+        return EMPTY_CELL
+
+    return text_cell("inf" if value > 0 else "-inf")
+
+
+def object_cell(value):
+    """ cell of a mixed column, type decided per value """
+
+    if value is None or value is pd.NaT or value is pd.NA:
+
+        return EMPTY_CELL
+
+    if isinstance(value, (bool, np.bool_)):
+
+        return f'<c t="b"><v>{int(value)}</v></c>'
+
+    if isinstance(value, (int, np.integer)):
+
+        return f'<c><v>{int(value)}</v></c>'
+
+    if isinstance(value, (float, np.floating)):
+
+        return number_cell(float(value))
+
+    if isinstance(value, str):
+
+        return text_cell(value)
+
+    return text_cell(str(value))
+
+
+def format_column(column):
+    """ cell xml of every value of a column
+
+    Parameters:
+            column (pandas series): values of one column
+
+    Returns:
+            cells (list): cell xml str of each value
+
+    """
+
+    dtype = column.dtype
+
+    if isinstance(dtype, np.dtype) and dtype.kind == "b":
+
+        return [f'<c t="b"><v>{int(value)}</v></c>' for value in column.tolist()]
+
+    if isinstance(dtype, np.dtype) and dtype.kind in "iu":
+
+        return [f'<c><v>{value}</v></c>' for value in column.tolist()]
+
+    if isinstance(dtype, np.dtype) and dtype.kind == "f":
+
+        values = column.to_numpy()
+
+        # most heights are finite, the checks of number_cell are only needed when some are not
+        if np.isfinite(values).all():
+
+            return [f'<c><v>{value!r}</v></c>' for value in values.tolist()]
+
+        return [number_cell(value) for value in values.tolist()]
+
+    return [object_cell(value) for value in column.astype(object).tolist()]
+
+
+def write_sheet(zip_file, number, data_frame, rows, columns, chunk_rows=CHUNK_ROWS):
+    """ streams rows of one sheet into the workbook zip
+
+    Parameters:
+            zip_file (ZipFile): workbook being written
+            number (int): sheet number, from 1
+            data_frame (pandas data-frame): table being written
+            rows (range): data rows of this sheet
+            columns (range): columns of this sheet
+
+    Returns:
+            None
+
+    """
+
+    frame = data_frame.iloc[:, columns.start:columns.stop]
+    header = "".join(text_cell(str(name), style=1) for name in frame.columns)
+
+    with zip_file.open(f"xl/worksheets/sheet{number}.xml", "w", force_zip64=True) as sheet:
+
+        sheet.write(SHEET_START.encode())
+        sheet.write(f'<row>{header}</row>'.encode("utf-8"))
+
+        for start in range(rows.start, rows.stop, chunk_rows):
+
+            chunk = frame.iloc[start:min(start + chunk_rows, rows.stop)]
+            cells = [format_column(chunk.iloc[:, position]) for position in range(chunk.shape[1])]
+            sheet.write("".join("<row>" + "".join(row) + "</row>" for row in zip(*cells)).encode("utf-8"))
+
+        sheet.write(SHEET_END.encode())
+
+
+def write_excel(data_frame, file_path, sheet_name="Sheet1", max_rows=MAX_ROWS, max_columns=MAX_COLUMNS):
+    """ writes data_frame to .xlsx file without holding the workbook in memory, same cells as to_excel(index=False)
+
+    Tables with more rows or columns than excel allows are split across sheets, each sheet keeps the column order and
+    has its own header row.
+
+    Parameters:
+            data_frame (pandas data-frame): table to write
+            file_path (str): Full directory path of .xlsx file
+            sheet_name (str): name of the sheet, split sheets are numbered "Sheet1 (1)", "Sheet1 (2)", ...
+            max_rows (int): most rows of a sheet including the header
+            max_columns (int): most columns of a sheet
+
+    Returns:
+            names (list): names of the sheets written
+
+    """
+
+    blocks = sheet_blocks(len(data_frame), data_frame.shape[1], max_rows, max_columns)
+    names = sheet_names(sheet_name, len(blocks))
+    numbers = range(1, len(blocks) + 1)
+
+    with zipfile.ZipFile(file_path, "w", zipfile.ZIP_DEFLATED, compresslevel=COMPRESSION_LEVEL) as zip_file:
+
+        zip_file.writestr("[Content_Types].xml", CONTENT_TYPES.format(
+            sheets="".join(SHEET_CONTENT_TYPE.format(number=number) for number in numbers)))
+        zip_file.writestr("_rels/.rels", PACKAGE_RELATIONSHIPS)
+        zip_file.writestr("xl/workbook.xml", WORKBOOK.format(sheets="".join(
+            WORKBOOK_SHEET.format(name=escape(name, {'"': "&quot;"}), number=number)
+            for name, number in zip(names, numbers))))
+        zip_file.writestr("xl/_rels/workbook.xml.rels", WORKBOOK_RELATIONSHIPS.format(
+            sheets="".join(WORKBOOK_SHEET_RELATIONSHIP.format(number=number) for number in numbers),
+            styles=len(blocks) + 1))
+        zip_file.writestr("xl/styles.xml", STYLES)
+
+        for number, (rows, columns) in zip(numbers, blocks):
+
+            write_sheet(zip_file, number, data_frame, rows, columns)
+
+    return names
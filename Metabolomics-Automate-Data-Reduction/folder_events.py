@@ -0,0 +1,155 @@
+#!/usr/bin/env python
+
+""" folder_events.py: Waits for files in a folder to change, with inotify on Linux and by polling elsewhere """
+
+__author__ = "Bryan Roberts"
+
+import ctypes
+import ctypes.util
+import os
+import select
+import struct
+import sys
+import time
+
+# seconds between folder scans when inotify is not available
+POLL_SECONDS = 2
+
+# inotify event masks from <sys/inotify.h>
+IN_MODIFY = 0x00000002
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_NONBLOCK = os.O_NONBLOCK
+IN_CLOEXEC = 0o2000000
+WATCH_MASK = IN_MODIFY | IN_CLOSE_WRITE | IN_MOVED_TO | IN_CREATE
+EVENT_HEADER = struct.Struct("iIII")
+
+
+def open_watch(folder):
+    """ starts watching folder with inotify, falling back to polling on systems without it
+
+    Parameters:
+            folder (str): Full directory path of folder to watch
+
+    Returns:
+            watch (dict): "folder" and inotify "fd", fd is None when polling
+
+    """
+
+    watch = {"folder": folder, "fd": None}
+
+    if not sys.platform.startswith("linux"):
+
+        return watch
+
+    try:
+
+        libc = ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True)
+        fd = libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+
+    except (OSError, AttributeError):
+
+        return watch
+
+    if fd < 0:
+
+        return watch
+
+    if libc.inotify_add_watch(fd, os.fsencode(folder), WATCH_MASK) < 0:
+
+        os.close(fd)
+        return watch
+
+    watch["fd"] = fd
+
+    return watch
+
+
+def close_watch(watch):
+    """ stops inotify watch """
+
+    if watch["fd"] is not None:
+
+        os.close(watch["fd"])
+        watch["fd"] = None
+
+
+def wait_for_events(watch, timeout=None):
+    """ blocks until files in the watched folder change or timeout passes
+
+    Parameters:
+            watch (dict): watch from open_watch
+            timeout (float): seconds to wait, forever if None
+
+    Returns:
+            names (set): names of changed files, None when polling and the folder has to be rescanned
+
+    """
+
+    if watch["fd"] is None:
+
+        time.sleep(POLL_SECONDS if timeout is None else min(timeout, POLL_SECONDS))
+        return None
+
+    readable, _, _ = select.select([watch["fd"]], [], [], timeout)
+    names = set()
+    if not readable:
+
+        return names
+
+    try:
+
+        buffer = os.read(watch["fd"], 64 * 1024)
+
+    except BlockingIOError:
+
+        return names
+
+    offset = 0
+    while offset < len(buffer):
+
+        _, _, _, length = EVENT_HEADER.unpack_from(buffer, offset)
+        offset += EVENT_HEADER.size
+        name = buffer[offset:offset + length].rstrip(b"\0")
+        offset += length
+
+        if name:
+
+            names.add(os.fsdecode(name))
+
+    return names
+
+
+def wait_for_file(file_path, timeout=None):
+    """ waits for a file to appear, woken by inotify instead of checking every second
+
+    Parameters:
+            file_path (str): Full directory path of expected file
+            timeout (float): seconds to wait, forever if None
+
+    Returns:
+            bool: True if the file exists, False if timeout passed first
+
+    """
+
+    watch = open_watch(os.path.dirname(file_path) or ".")
+    deadline = None if timeout is None else time.monotonic() + timeout
+
+    try:
+
+        # checked after the watch starts so a file created in between is not missed
+        while not os.path.exists(file_path):
+
+            remaining = None if deadline is None else deadline - time.monotonic()
+            if remaining is not None and remaining <= 0:
+
+                return False
+
+            wait_for_events(watch, remaining)
+
+    finally:
+
+        close_watch(watch)
+
+    return True
@@ -0,0 +1,259 @@
+#!/usr/bin/env python
+
+""" imputation.py: Whole-matrix imputation of missing, zero, and near-zero heights by half minimum, blank LOD, or kNN """
+
+__author__ = "Bryan Roberts"
+
+import numpy as np
+import pandas as pd
+
+import projection  # local source
+
+# ways of filling missing heights
+STRATEGIES = ("half_min", "blank_lod", "knn")
+
+# heights below this value are missing, MS-Dial writes 0 or near-zero heights for peaks it did not find
+MISSING_HEIGHT = 1.0
+
+# blank standard deviations above the blank mean of the limit of detection
+LOD_STDEVS = 3
+
+# neighboring features averaged by kNN imputation
+NEIGHBORS = 5
+
+# principal components of the feature profiles the neighbor index is built on
+NEIGHBOR_COMPONENTS = 10
+
+# feature rows imputed at a time by kNN, bounds memory of the gathered neighbor heights
+BLOCK_ROWS = 1024
+
+
+def missing_mask(heights, threshold=MISSING_HEIGHT):
+    """ True where a height is nan or below threshold """
+
+    with np.errstate(invalid="ignore"):
+
+        return ~(heights >= threshold)
+
+
+def half_minimum(heights, missing):
+    """ half the smallest height of every feature, features without heights take half the smallest height of all
+
+    Parameters:
+            heights (numpy array): float64 heights, one row per feature
+            missing (numpy array): bool mask from missing_mask
+
+    Returns:
+            numpy array: fill value of each feature
+
+    """
+
+    present = np.where(missing, np.inf, heights)
+    minimum = present.min(axis=1)
+    overall = minimum[np.isfinite(minimum)].min() if np.isfinite(minimum).any() else 2 * MISSING_HEIGHT
+
+    return np.where(np.isfinite(minimum), minimum, overall) / 2
+
+
+def blank_limit(heights, missing, blank_columns, stdevs=LOD_STDEVS):
+    """ limit of detection of every feature, blank mean plus stdevs blank standard deviations
+
+    Features with fewer than two blank heights have no limit and take half_minimum instead.
+
+    Parameters:
+            heights (numpy array): float64 heights, one row per feature
+            missing (numpy array): bool mask from missing_mask
+            blank_columns (numpy array): bool mask of blank columns
+            stdevs (float): standard deviations above the blank mean
+
+    Returns:
+            numpy array: fill value of each feature
+
+    """
+
+    blanks = np.where(missing[:, blank_columns], np.nan, heights[:, blank_columns])
+    counts = np.sum(~np.isnan(blanks), axis=1)
+
+    with np.errstate(divide="ignore", invalid="ignore"):
+
+        mean = np.nansum(blanks, axis=1) / counts
+        deviations = np.where(np.isnan(blanks), 0.0, blanks - mean[:, None])
+        deviation = np.sqrt(np.einsum("ij,ij->i", deviations, deviations) / (counts - 1))
+
+    return np.where(counts >= 2, mean + stdevs * deviation, half_minimum(heights, missing))
+
+
+def neighbor_index(heights, missing, components=NEIGHBOR_COMPONENTS):
+    """ kd-tree of features by the shape of their log height profiles across injections
+
+    Profiles are log2 transformed and autoscaled, so features rising and falling together are close whatever their
+    intensity, and projected on their leading principal components before the tree is built.
+
+    Parameters:
+            heights (numpy array): float64 heights, one row per feature
+            missing (numpy array): bool mask from missing_mask
+            components (int): dimensions of the tree
+
+    Returns:
+            tree (scipy cKDTree): index of feature coordinates
+            coordinates (numpy array): features x components coordinates
+
+    """
+
+    from scipy.spatial import cKDTree
+
+    scaled = np.where(missing, np.nan, heights).astype(np.float32)
+    projection.scale_heights(scaled)
+
+    # scores of the columns of the transposed profiles are feature coordinates
+    coordinates, _ = projection.randomized_pca(scaled.T, components)
+
+    return cKDTree(coordinates), coordinates
+
+
+def knn_fill(heights, missing, neighbors=NEIGHBORS, components=NEIGHBOR_COMPONENTS, block_rows=BLOCK_ROWS):
+    """ imputes each missing height from the same injection of the nearest features in the neighbor index
+
+    Neighbor heights are compared on the log scale as z-scores, the mean z-score of the neighbors with a height in the
+    injection is converted back with the log mean and standard deviation of the imputed feature.  Heights no neighbor
+    has, and features with fewer than two heights, take half_minimum.
+
+    Parameters:
+            heights (numpy array): float64 heights, one row per feature
+            missing (numpy array): bool mask from missing_mask
+            neighbors (int): neighbors averaged
+            components (int): dimensions of the neighbor index
+            block_rows (int): features imputed at a time
+
+    Returns:
+            numpy array: heights with every missing height filled
+
+    """
+
+    rows = len(heights)
+    neighbors = min(neighbors, rows - 1)
+    fallback = half_minimum(heights, missing)
+    filled = np.where(missing, fallback[:, None], heights)
+
+    if neighbors < 1:
+
+        return filled
+
+    # log z-scores of every height, zero where missing so neighbors are summed without nan checks
+    present = ~missing
+    logs = np.zeros(heights.shape)
+    np.log2(heights, out=logs, where=present)
+    counts = present.sum(axis=1)
+
+    with np.errstate(divide="ignore", invalid="ignore"):
+
+        mean = logs.sum(axis=1) / counts
+        logs -= mean[:, None]
+        logs[missing] = 0
+        deviation = np.sqrt(np.einsum("ij,ij->i", logs, logs) / (counts - 1))
+        logs /= deviation[:, None]
+
+    usable = (counts >= 2) & (deviation > 0)
+    logs[~usable] = 0
+    present &= usable[:, None]
+
+    tree, coordinates = neighbor_index(heights, missing, components)
+
+    # nearest features of every feature in one query, the first is the feature itself
+    _, nearest = tree.query(coordinates, k=neighbors + 1)
+    nearest = nearest[:, 1:]
+
+    for start in range(0, rows, block_rows):
+
+        block = slice(start, min(start + block_rows, rows))
+        total = np.zeros((block.stop - start, heights.shape[1]))
+        found = np.zeros((block.stop - start, heights.shape[1]))
+
+        # each neighbor rank is added for every feature of the block at once
+        for rank in range(neighbors):
+
+            total += logs[nearest[block, rank]]
+            found += present[nearest[block, rank]]
+
+        with np.errstate(divide="ignore", invalid="ignore", over="ignore"):
+
+            imputed = np.exp2(mean[block, None] + total / found * deviation[block, None])
+
+        replace = missing[block] & usable[block, None] & (found > 0) & np.isfinite(imputed)
+        filled[block] = np.where(replace, imputed, filled[block])
+
+    return filled
+
+
+def impute_heights(heights, strategy="half_min", blank_columns=None, threshold=MISSING_HEIGHT):
+    """ fills missing, zero, and near-zero heights of a matrix
+
+    Parameters:
+            heights (numpy array): float64 heights, one row per feature
+            strategy (str): "half_min", "blank_lod", or "knn"
+            blank_columns (numpy array): bool mask of blank columns, needed by "blank_lod", which leaves them unfilled
+            threshold (float): heights below threshold are missing
+
+    Returns:
+            imputed (numpy array): heights with missing heights filled
+            missing (numpy array): bool mask of the imputed heights
+
+    """
+
+    assert strategy in STRATEGIES, f"strategy must be one of {STRATEGIES}"
+
+    missing = missing_mask(heights, threshold)
+
+    if strategy == "knn":
+
+        return knn_fill(heights, missing), missing
+
+    if strategy == "blank_lod":
+
+        assert blank_columns is not None and blank_columns.any(), "blank_lod imputation needs blank columns"
+        fill = blank_limit(heights, missing, blank_columns)
+
+        # blanks keep their heights, a limit above every blank height would raise the blank average and Fold 2 would
+        # drop the feature
+        missing = missing & ~blank_columns
+
+    else:
+
+        fill = half_minimum(heights, missing)
+
+    return np.where(missing, fill[:, None], heights), missing
+
+
+def impute(data_frame, samples, strategy="half_min", blanks=None, threshold=MISSING_HEIGHT):
+    """ imputes missing heights of the sample columns of a curated data frame in place
+
+    Only columns with an imputed height are replaced, so the other columns keep their dtype.
+
+    Parameters:
+            data_frame (pandas data-frame): Currated data-frame containing peak heights for all samples and features
+            samples (list): columns imputed, ex: blanks + biorecs + pools + samples
+            strategy (str): "half_min", "blank_lod", or "knn"
+            blanks (list): blank columns, needed by "blank_lod"
+            threshold (float): heights below threshold are missing
+
+    Returns:
+            imputed (dict): "features" series of imputed heights per feature indexed like data_frame, "samples" series
+            of imputed heights per sample column, and the strategy
+
+    """
+
+    heights = data_frame[samples].apply(pd.to_numeric, errors="coerce").to_numpy(dtype=np.float64)
+    blank_columns = np.isin(samples, blanks) if blanks else None
+
+    imputed, missing = impute_heights(heights, strategy, blank_columns, threshold)
+
+    replaced = {
+        column: imputed[:, position] for position, column in enumerate(samples) if missing[:, position].any()}
+    if replaced:
+
+        data_frame[list(replaced)] = pd.DataFrame(replaced, index=data_frame.index)
+
+    return {
+        "strategy": strategy,
+        "features": pd.Series(missing.sum(axis=1), index=data_frame.index, name="Imputed"),
+        "samples": pd.Series(missing.sum(axis=0), index=pd.Index(samples, name="Sample"), name="Imputed")}
@@ -4,6 +4,14 @@
 
 __author__ = "Bryan Roberts"
 
+import os
+
+# default reduction parameters of each instrument, shared by process.py and the watch folder daemon
+PRESETS = {
+    "qtof": {"known_fold2": 5, "unknown_fold2": 5, "known_sample_max": 1000, "unknown_sample_average": 3000},
+    "ttof": {"known_fold2": 5, "unknown_fold2": 5, "known_sample_max": 1000, "unknown_sample_average": 3000},
+    "qehf": {"known_fold2": 5, "unknown_fold2": 5, "known_sample_max": 10000, "unknown_sample_average": 50000}}
+
 
 def user_specified_values():
     """ allows user to choose default values or input values for reduction
@@ -51,3 +59,159 @@ def choose_instrument():
             return True
         elif user_selection == "2":
             return False
+
+
+def choose_drift_correction():
+    """ allows user to choose whether pool qc drift correction is applied before reduction
+
+    Parameters:
+            None
+
+    Returns:
+            bool: True if drift correction is applied, False if heights are left uncorrected
+
+    """
+
+    while(True):
+        print("Select an option for drift correction: ")
+        print("1) no drift correction")
+        print("2) correct drift using pool qc samples and injection order")
+
+        user_selection = input()
+
+        if user_selection == "1":
+            return False
+        elif user_selection == "2":
+            return True
+
+
+def choose_imputation():
+    """ allows user to choose how missing, zero, and near-zero heights are filled before reduction
+
+    Parameters:
+            None
+
+    Returns:
+            str: strategy from imputation.STRATEGIES, None if heights are left as exported
+
+    """
+
+    while(True):
+        print("Select an option for missing value imputation: ")
+        print("1) no imputation")
+        print("2) half of the feature minimum")
+        print("3) blank limit of detection (blank mean + 3 stdev)")
+        print("4) nearest neighbor features (kNN)")
+
+        user_selection = input()
+
+        if user_selection == "1":
+            return None
+        elif user_selection == "2":
+            return "half_min"
+        elif user_selection == "3":
+            return "blank_lod"
+        elif user_selection == "4":
+            return "knn"
+
+
+def choose_batches():
+    """ allows user to choose how injections are split into batches for blank averages and Fold 2
+
+    Parameters:
+            None
+
+    Returns:
+            batch parameter of pipeline.run: None for one batch, "batch_id", "acquisition_time", or injections per batch
+
+    """
+
+    while(True):
+        print("Select an option for batches: ")
+        print("1) one batch")
+        print("2) Batch ID row of the export")
+        print("3) gaps in acquisition times from file_times.csv")
+        print("4) fixed number of injections per batch")
+
+        user_selection = input()
+
+        if user_selection == "1":
+            return None
+        elif user_selection == "2":
+            return "batch_id"
+        elif user_selection == "3":
+            return "acquisition_time"
+        elif user_selection == "4":
+            print("Enter number of injections per batch: ")
+            size = input()
+            if size.isdigit() and int(size) > 0:
+                return int(size)
+
+
+def choose_blank_subtraction():
+    """ allows user to choose whether the blank average of each batch is subtracted from its injections
+
+    Parameters:
+            None
+
+    Returns:
+            bool: True if batch blank averages are subtracted, False if heights are left as exported
+
+    """
+
+    while(True):
+        print("Select an option for blank subtraction: ")
+        print("1) no blank subtraction")
+        print("2) subtract the blank average of each batch")
+
+        user_selection = input()
+
+        if user_selection == "1":
+            return False
+        elif user_selection == "2":
+            return True
+
+
+def choose_run_order():
+    """ allows user to choose whether injections are ordered by the acquisition times of file_times.csv
+
+    Parameters:
+            None
+
+    Returns:
+            bool: True if heights are read and drift corrected in acquisition order, False for injection numbers
+
+    """
+
+    while(True):
+        print("Select an option for run order: ")
+        print("1) injection number in the sample names")
+        print("2) acquisition time from file_times.csv next to the export")
+
+        user_selection = input()
+
+        if user_selection == "1":
+            return False
+        elif user_selection == "2":
+            return True
+
+
+def validate_file_location(file_location):
+    """ validates file location exists and delete quotation marks if user copied them into string
+
+    Parameters:
+            file_location (list): Full directory path of file to be analyzed
+
+    Returns:
+            file_location (str): Full directory path of file to be analyzed
+
+    """
+
+    # if user pastes file location with quotation marks, delete quotation marks
+    if file_location[0] == "\"":
+
+        file_location = file_location[1:len(file_location) - 1]
+
+    assert (os.path.isfile(file_location)), "File location invalid"
+
+    return file_location
@@ -0,0 +1,304 @@
+#!/usr/bin/env python
+
+""" merge.py: Merges processed files of each polarity into one compound table with the best supported adduct """
+
+__author__ = "Bryan Roberts"
+
+import argparse
+import os
+
+import numpy as np
+import pandas as pd
+
+import excel  # local source
+import msdial
+import sample_names
+
+# InChIKey values MS-Dial writes for features without a structure
+MISSING_INCHIKEYS = ("", "null", "nan", "none")
+
+# ways of choosing between adducts of a compound
+SELECTIONS = ("cv", "intensity")
+
+# columns describing the chosen feature, written before the sample columns
+MERGED_COLUMNS = [
+    "Metabolite name",
+    "INCHIKEY",
+    "Mode",
+    "Adduct type",
+    "Average Mz",
+    "Average Rt(min)",
+    "Pool %CV",
+    "Sample Average",
+    "Candidates"]
+
+
+def sample_keys(data_frame):
+    """ sample columns of a processed table and their names without the mode
+
+    The same injection run in each polarity has the same key, ex: Biorec001_MX123456_posCSH_p1-001 and
+    Biorec001_MX123456_negCSH_p1-001 are both Biorec001_MX123456_p1-001.
+
+    Parameters:
+            data_frame (pandas data-frame): processed file
+
+    Returns:
+            samples (list): sample columns in file order
+            keys (list): key of each sample column
+
+    """
+
+    index = sample_names.parse(data_frame.columns)
+    index = index[index["Parsed"].to_numpy()]
+    keys = [
+        "_".join(field for field in (name, study, sample_id) if isinstance(field, str))
+        for name, study, sample_id in zip(index["Name"], index["Study"], index["Sample ID"])]
+
+    return index.index.tolist(), keys
+
+
+def compound_keys(data_frame):
+    """ key of each feature, InChIKey when MS-Dial has one otherwise the normalized name, "" for unknowns
+
+    Parameters:
+            data_frame (pandas data-frame): processed file with Metabolite name and INCHIKEY columns
+
+    Returns:
+            numpy array: object array of str keys
+
+    """
+
+    names = data_frame["Metabolite name"].astype(object).fillna("").astype(str).str.strip()
+
+    # identical names written with different case or spacing are the same compound
+    normalized = "name:" + names.str.lower().str.replace(r"\s+", " ", regex=True)
+
+    if "INCHIKEY" in data_frame.columns:
+
+        inchikeys = data_frame["INCHIKEY"].astype(object).fillna("").astype(str).str.strip().str.upper()
+        has_inchikey = ~inchikeys.str.lower().isin(MISSING_INCHIKEYS)
+
+    else:
+
+        inchikeys = pd.Series("", index=data_frame.index)
+        has_inchikey = pd.Series(False, index=data_frame.index)
+
+    keys = np.where(has_inchikey, "inchikey:" + inchikeys, normalized)
+
+    return np.where(names != "", keys, "").astype(object)
+
+
+def feature_scores(heights, pools):
+    """ pool %CV and sample average of each feature
+
+    Parameters:
+            heights (numpy array): float64 heights, one row per feature
+            pools (numpy array): bool mask of pool qc columns
+
+    Returns:
+            cv (numpy array): pool %CV, nan when fewer than two pools have a height
+            average (numpy array): mean height over all sample columns
+
+    """
+
+    with np.errstate(divide="ignore", invalid="ignore"):
+
+        pool_heights = heights[:, pools]
+        counts = np.sum(~np.isnan(pool_heights), axis=1)
+        mean = np.nanmean(pool_heights, axis=1) if pools.any() else np.full(len(heights), np.nan)
+        stdev = np.nanstd(pool_heights, axis=1, ddof=1) if pools.any() else np.full(len(heights), np.nan)
+        cv = np.where((counts >= 2) & (mean > 0), stdev / mean * 100, np.nan)
+        average = np.nanmean(heights, axis=1)
+
+    return cv, average
+
+
+def read_processed(file_location):
+    """ reads one processed file into the rows and sample heights used by merge_frames
+
+    Parameters:
+            file_location (str): Full directory path of _processed.xlsx or _toBeProcessed_processed.txt file
+
+    Returns:
+            data_frame (pandas data-frame): processed file
+            mode (str): mode of the first sample column, ex: posCSH
+
+    """
+
+    data_frame = msdial.read_table(file_location)
+    index = sample_names.parse(data_frame.columns)
+    modes = index.loc[index["Parsed"].to_numpy(), "Mode"]
+    assert len(modes), f"no sample columns found in {file_location}"
+
+    return data_frame, modes.iloc[0]
+
+
+def merge_frames(frames, select="cv"):
+    """ merges processed tables of each mode into one row per compound
+
+    Features of every mode are indexed by compound key in one hash table, so the adducts of a compound found in either
+    polarity compete together.  The adduct with the lowest pool %CV is kept, features without a pool %CV lose to those
+    with one and ties are broken by sample average.  With select="intensity" the highest sample average is kept.
+    Samples are matched across modes by name without the mode, samples run in one mode only are kept with empty heights
+    in the other.  Unknowns cannot be matched between modes and are left out.
+
+    Parameters:
+            frames (list): (data-frame, mode) of each processed file, from read_processed
+            select (str): "cv" or "intensity"
+
+    Returns:
+            merged (pandas data-frame): MERGED_COLUMNS followed by sample columns named by sample_keys
+            summary (dict): features, unknowns, compounds, and compounds kept from each mode
+
+    """
+
+    assert select in SELECTIONS, f"select must be one of {SELECTIONS}"
+
+    # union of samples in first seen order, the column of each sample in the merged matrix
+    sample_order = {}
+    for data_frame, _ in frames:
+
+        for key in sample_keys(data_frame)[1]:
+
+            sample_order.setdefault(key, len(sample_order))
+
+    pieces = []
+    for number, (data_frame, mode) in enumerate(frames):
+
+        samples, _ = sample_keys(data_frame)
+        heights = data_frame[samples].apply(pd.to_numeric, errors="coerce").to_numpy(dtype=np.float64)
+        cv, average = feature_scores(heights, np.array(["PoolQC" in sample for sample in samples]))
+
+        pieces.append(pd.DataFrame({
+            "key": compound_keys(data_frame),
+            "frame": number,
+            "row": np.arange(len(data_frame)),
+            "mode": mode,
+            "cv": cv,
+            "average": average}))
+
+    features = pd.concat(pieces, ignore_index=True)
+    known = features["key"].to_numpy() != ""
+    candidates = features[known]
+
+    # hash index of compound keys, every feature gets the code of its compound
+    codes, keys = pd.factorize(candidates["key"])
+
+    # best feature of each compound is first after sorting by compound then score, features without an average last
+    average = candidates["average"].to_numpy()
+    average = np.where(np.isnan(average), -np.inf, average)
+    if select == "cv":
+
+        score = np.where(np.isnan(candidates["cv"]), np.inf, candidates["cv"])
+        order = np.lexsort((-average, score, codes))
+
+    else:
+
+        order = np.lexsort((-average, codes))
+
+    first = np.ones(len(order), dtype=bool)
+    first[1:] = codes[order][1:] != codes[order][:-1]
+    best = candidates.iloc[order[first]]
+    counts = np.bincount(codes, minlength=len(keys))
+
+    merged_heights = np.full((len(best), len(sample_order)), np.nan)
+    metadata = pd.DataFrame(index=range(len(best)), columns=MERGED_COLUMNS[:6], dtype=object)
+    positions = np.arange(len(best))
+
+    # heights and metadata of the kept features are copied frame by frame
+    for number, (data_frame, _) in enumerate(frames):
+
+        kept = best["frame"].to_numpy() == number
+        if not kept.any():
+
+            continue
+
+        rows = best["row"].to_numpy()[kept]
+        samples, keys = sample_keys(data_frame)
+        columns = [sample_order[key] for key in keys]
+        merged_heights[np.ix_(positions[kept], columns)] = (
+            data_frame[samples].iloc[rows].apply(pd.to_numeric, errors="coerce").to_numpy(dtype=np.float64))
+
+        for column in MERGED_COLUMNS[:6]:
+
+            if column in data_frame.columns:
+
+                metadata.loc[positions[kept], column] = data_frame[column].iloc[rows].to_numpy()
+
+        metadata.loc[positions[kept], "Mode"] = frames[number][1]
+
+    metadata["Pool %CV"] = np.round(best["cv"].to_numpy(), 2)
+    metadata["Sample Average"] = np.round(best["average"].to_numpy(), 2)
+    metadata["Candidates"] = counts[codes[order[first]]]
+
+    merged = pd.concat(
+        [metadata, pd.DataFrame(merged_heights, columns=list(sample_order))], axis=1)
+
+    summary = {
+        "features": int(len(features)),
+        "unknowns": int((~known).sum()),
+        "compounds": int(len(best)),
+        "kept_by_mode": {mode: int((best["mode"] == mode).sum()) for _, mode in frames}}
+
+    return merged, summary
+
+
+def merge_files(file_locations, merged_path=None, select="cv"):
+    """ merges processed files of each polarity and saves the compound table
+
+    Parameters:
+            file_locations (list): Full directory paths of processed files, one per mode
+            merged_path (str): .xlsx or .txt file to save, <client>_<minix>_merged.xlsx next to the first file if None
+            select (str): "cv" or "intensity"
+
+    Returns:
+            merged_path (str): Full directory path of saved file
+
+    """
+
+    frames = [read_processed(file_location) for file_location in file_locations]
+    merged, summary = merge_frames(frames, select)
+
+    if merged_path is None:
+
+        # named from the first study sample as reduce.extract_sample_information does, blanks and qcs come first
+        samples, _ = sample_keys(frames[0][0])
+        study_samples = sample_names.columns_of_type(sample_names.parse(samples), "Sample") or samples
+        study = sample_names.study_name(sample_names.parse(study_samples[:1]))
+        merged_path = os.path.join(
+            os.path.dirname(file_locations[0]), study[:study.rindex("_")] + "_merged.xlsx")
+
+    if merged_path.lower().endswith(".xlsx"):
+
+        excel.write_excel(merged, merged_path)
+
+    else:
+
+        merged.to_csv(merged_path, sep="\t", index=False)
+
+    print(f"{summary['features']} features, {summary['unknowns']} unknowns left out, "
+          f"{summary['compounds']} compounds: " +
+          ", ".join(f"{count} from {mode}" for mode, count in summary["kept_by_mode"].items()))
+    print(f"file saved: {merged_path}")
+
+    return merged_path
+
+
+def main():
+
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("files", nargs="+", help="processed files of each mode, ex: posCSH and negCSH _processed.xlsx")
+    parser.add_argument("--output", help="merged .xlsx or .txt file, saved next to the first file by default")
+    parser.add_argument("--select", choices=SELECTIONS, default="cv", help="keep lowest pool %%CV or highest average")
+    args = parser.parse_args()
+
+    for file_location in args.files:
+
+        assert os.path.exists(file_location), f"{file_location} does not exist"
+
+    merge_files(args.files, args.output, args.select)
+
+
+if __name__ == "__main__":
+
+    main()
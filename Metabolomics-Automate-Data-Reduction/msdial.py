@@ -0,0 +1,371 @@
+#!/usr/bin/env python
+
+""" msdial.py: Shared reader for MS-Dial alignment exports (.txt or .xlsx) and plain result tables """
+
+__author__ = "Bryan Roberts"
+
+import csv
+import os
+from collections import namedtuple
+
+import numpy as np
+import pandas as pd
+
+# major and minor version of pandas, read_excel engines depend on it
+PANDAS_VERSION = tuple(int(part) for part in pd.__version__.split(".")[:2])
+
+# python-calamine reads xlsx files in rust and is used by pandas 2.2 and later when installed, otherwise openpyxl
+# streams rows, pandas before 1.2 only reads xlsx with its default xlrd engine
+try:
+    import python_calamine  # noqa: F401
+    EXCEL_ENGINE = "calamine" if PANDAS_VERSION >= (2, 2) else "openpyxl"
+except ImportError:
+    EXCEL_ENGINE = "openpyxl"
+
+if PANDAS_VERSION < (1, 2):
+
+    EXCEL_ENGINE = None
+
+# number of rows searched for the MS-Dial column header row
+HEADER_SEARCH_ROWS = 20
+
+# last metadata column before sample columns begin, used when an export has no rows above the header
+LAST_METADATA_COLUMNS = ("MS/MS spectrum", "MS1-spectrum")
+
+# MS-Dial 4 adds per-class summary columns after the sample columns
+SUMMARY_LABELS = ("Average", "Stdev")
+
+# columns only found in exports of each MS-Dial version, legacy exports start with peak_id
+VERSION_COLUMNS = (("4", "Post curation result"), ("3", "MS/MS included"), ("legacy", "peak_id"))
+
+# names of retention time, m/z, and annotation columns across MS-Dial versions
+RT_COLUMNS = ("Average Rt(min)", "retention_time")
+MZ_COLUMNS = ("Average Mz", "m/z")
+NAME_COLUMNS = ("Metabolite name",)
+
+Export = namedtuple(
+    "Export", ["metadata", "heights", "samples", "sample_info", "header_rows", "version", "file_format"])
+Export.__doc__ = """ MS-Dial alignment export
+
+    metadata (pandas data-frame): feature columns up to and including MS/MS spectrum, one row per feature
+    heights (numpy array): contiguous features x samples peak heights
+    samples (list): sample column names in export order
+    sample_info (pandas data-frame): rows above the header (Class, File type, Injection order, Batch ID) for each sample
+    header_rows (int): number of rows above the column header row
+    version (str): MS-Dial version detected from columns, "unknown" if not recognised
+    file_format (str): "txt" or "xlsx"
+"""
+
+
+def file_format(file_location):
+    """ determines export format from file extension
+
+    Parameters:
+            file_location (str): Full directory path of file to be read
+
+    Returns:
+            str: "xlsx" for excel workbooks, "txt" for tab or comma separated text
+
+    """
+
+    extension = os.path.splitext(file_location)[1].lower()
+
+    if extension in (".xlsx", ".xlsm"):
+
+        return "xlsx"
+
+    assert (extension in (".txt", ".tsv", ".csv")), f"{file_location} is not a .txt, .csv, or .xlsx file"
+
+    return "txt"
+
+
+def text_separator(file_location):
+    """ comma for .csv files, tab for MS-Dial .txt exports """
+
+    return "," if file_location.lower().endswith(".csv") else "\t"
+
+
+def read_rows(file_location, nrows=None):
+    """ reads the first rows of a file as lists of cell values without type conversion
+
+    Parameters:
+            file_location (str): Full directory path of file to be read
+            nrows (int): number of rows to read, all rows if None
+
+    Returns:
+            rows (list): list of rows, each a list of cell values
+
+    """
+
+    rows = []
+
+    if file_format(file_location) == "txt":
+
+        with open(file_location, newline="", encoding="utf-8", errors="replace") as text_file:
+
+            for row in csv.reader(text_file, delimiter=text_separator(file_location)):
+
+                if nrows is not None and len(rows) == nrows:
+
+                    break
+
+                rows.append(row)
+
+    elif EXCEL_ENGINE == "calamine":
+
+        frame = pd.read_excel(file_location, engine="calamine", header=None, nrows=nrows)
+        rows = frame.astype(object).where(frame.notna(), None).values.tolist()
+
+    else:
+
+        import openpyxl
+
+        # read only workbooks stream rows instead of building every cell object
+        workbook = openpyxl.load_workbook(file_location, read_only=True, data_only=True)
+        for row in workbook.worksheets[0].iter_rows(values_only=True):
+
+            if nrows is not None and len(rows) == nrows:
+
+                break
+
+            rows.append(list(row))
+
+        workbook.close()
+
+    return rows
+
+
+def find_header_row(rows):
+    """ finds index of MS-Dial column header row, the first row with a value in the first column
+
+    Rows above the header (Class, File type, Injection order, Batch ID) are only filled from the label column on.
+
+    """
+
+    for index, row in enumerate(rows):
+
+        if len(row) and row[0] is not None and str(row[0]).strip() != "":
+
+            return index
+
+    raise ValueError("MS-Dial column header row not found")
+
+
+def find_first_sample(rows, header_row, columns):
+    """ finds index of first sample column, the column after the labels of the rows above the header """
+
+    for row in rows[:header_row]:
+
+        for column, value in enumerate(row):
+
+            if value is not None and str(value).strip() != "":
+
+                return column + 1
+
+    for column in LAST_METADATA_COLUMNS:
+
+        if column in columns:
+
+            return columns.index(column) + 1
+
+    raise ValueError(f"none of {LAST_METADATA_COLUMNS} columns found before sample columns")
+
+
+def header_layout(rows):
+    """ locates the column header and the sample columns in the first rows of an export
+
+    Parameters:
+            rows (list): first HEADER_SEARCH_ROWS rows from read_rows
+
+    Returns:
+            header_row (int): index of the column header row
+            columns (list): column names, "" for empty header cells
+            first_sample (int): index of the first sample column
+            last_sample (int): index after the last sample column, MS-Dial 4 per-class summary columns are left out
+
+    """
+
+    header_row = find_header_row(rows)
+    columns = [str(col) if col is not None else "" for col in rows[header_row]]
+
+    first_sample = find_first_sample(rows, header_row, columns)
+
+    # sample columns end where MS-Dial 4 per-class summary columns begin
+    last_sample = len(columns)
+    for column in range(first_sample, len(columns)):
+
+        if any(column < len(row) and row[column] in SUMMARY_LABELS for row in rows[:header_row]):
+
+            last_sample = column
+            break
+
+    return header_row, columns, first_sample, last_sample
+
+
+def sample_information(rows, header_row, first_sample, last_sample):
+    """ rows above the header (Class, File type, Injection order, Batch ID) as one row per sample
+
+    Metadata rows above the header are labelled in the last metadata column.
+
+    """
+
+    samples = [str(col) if col is not None else "" for col in rows[header_row][first_sample:last_sample]]
+
+    return pd.DataFrame(
+        {str(row[first_sample - 1]): [row[column] if column < len(row) else None for column in
+                                      range(first_sample, last_sample)] for row in rows[:header_row]},
+        index=pd.Index(samples, name="Sample"))
+
+
+def read_sample_info(file_location):
+    """ reads only the header rows of an export for the Class, File type, Injection order, and Batch ID of samples
+
+    Parameters:
+            file_location (str): Full directory path of MS-Dial .txt or .xlsx export
+
+    Returns:
+            sample_info (pandas data-frame): one row per sample column, no columns when the export has no rows above
+            the header
+
+    """
+
+    rows = read_rows(file_location, HEADER_SEARCH_ROWS)
+    header_row, _, first_sample, last_sample = header_layout(rows)
+
+    return sample_information(rows, header_row, first_sample, last_sample)
+
+
+def metadata_column(export, names):
+    """ returns the first of names found in export metadata, ex: metadata_column(export, RT_COLUMNS)
+
+    Parameters:
+            export (Export): MS-Dial export from read_export
+            names (tuple): equivalent column names across MS-Dial versions
+
+    Returns:
+            pandas series
+
+    """
+
+    for name in names:
+
+        if name in export.metadata.columns:
+
+            return export.metadata[name]
+
+    raise KeyError(f"none of {names} found in export")
+
+
+def detect_version(columns):
+    """ detects MS-Dial version from columns present in export """
+
+    for version, column in VERSION_COLUMNS:
+
+        if column in columns:
+
+            return version
+
+    return "unknown"
+
+
+def read_table(file_location, header_row=0):
+    """ reads plain table (MS-FLO output, processed or quant sheets) with the fastest available engine
+
+    Parameters:
+            file_location (str): Full directory path of file to be read
+            header_row (int): index of row containing column names
+
+    Returns:
+            pandas data-frame
+
+    """
+
+    if file_format(file_location) == "txt":
+
+        return pd.read_csv(file_location, sep=text_separator(file_location), skiprows=header_row, engine="c")
+
+    return pd.read_excel(file_location, engine=EXCEL_ENGINE, skiprows=header_row)
+
+
+def read_export(file_location, dtype=np.float32):
+    """ reads MS-Dial alignment export into feature metadata and a contiguous peak height matrix
+
+    Parameters:
+            file_location (str): Full directory path of MS-Dial .txt or .xlsx export
+            dtype (numpy dtype): dtype of height matrix, float64 keeps heights exactly as exported
+
+    Returns:
+            Export: metadata, heights, samples, sample_info, header_rows, version, and file_format
+
+    """
+
+    # header rows are read first to locate the column header and the first sample column
+    top = read_rows(file_location, HEADER_SEARCH_ROWS)
+    header_row, columns, first_sample, last_sample = header_layout(top)
+    samples = columns[first_sample:last_sample]
+
+    if file_format(file_location) == "txt":
+
+        # c parser with sample columns parsed straight into the requested dtype
+        frame = pd.read_csv(
+            file_location,
+            sep=text_separator(file_location),
+            skiprows=header_row,
+            engine="c",
+            usecols=range(last_sample),
+            dtype={sample: dtype for sample in samples},
+            low_memory=False)
+
+        metadata = frame.iloc[:, :first_sample]
+        heights = np.ascontiguousarray(frame.iloc[:, first_sample:last_sample].to_numpy(dtype=dtype))
+
+    else:
+
+        rows = read_rows(file_location)[header_row + 1:]
+        metadata = pd.DataFrame([row[:first_sample] for row in rows], columns=columns[:first_sample])
+        metadata = metadata.infer_objects()
+        heights = np.array([row[first_sample:last_sample] for row in rows], dtype=dtype)
+        heights = np.ascontiguousarray(heights.reshape(len(rows), len(samples)))
+
+    return Export(
+        metadata=metadata,
+        heights=heights,
+        samples=samples,
+        sample_info=sample_information(top, header_row, first_sample, last_sample),
+        header_rows=header_row,
+        version=detect_version(columns),
+        file_format=file_format(file_location))
+
+
+def export_frame(export, columns=None, samples=None, restore_integers=False):
+    """ combines metadata and heights of an export into one data-frame, metadata columns first
+
+    Parameters:
+            export (Export): MS-Dial export from read_export
+            columns (list): metadata columns to keep, all if None
+            samples (list): sample columns to keep in the order they are kept, all in export order if None
+            restore_integers (bool): store sample columns holding only whole numbers as int64, as pandas would infer
+
+    Returns:
+            pandas data-frame
+
+    """
+
+    metadata = export.metadata if columns is None else export.metadata[columns]
+
+    heights = export.heights
+    if samples is not None:
+
+        position_of = {sample: position for position, sample in enumerate(export.samples)}
+        heights = heights[:, [position_of[sample] for sample in samples]]
+
+    heights = pd.DataFrame(
+        heights, columns=export.samples if samples is None else samples, index=export.metadata.index, copy=False)
+
+    if restore_integers:
+
+        values = heights.to_numpy()
+        integral = np.isfinite(values).all(axis=0) & (values == np.round(values)).all(axis=0)
+        heights = heights.astype({sample: np.int64 for sample in heights.columns[integral]})
+
+    return pd.concat([metadata, heights], axis=1)
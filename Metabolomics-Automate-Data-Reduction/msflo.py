@@ -4,100 +4,372 @@
 
 __author__ = "Bryan Roberts"
 
+import contextlib
 import os
-import time
+import queue
+import shutil
+import tempfile
+import threading
 import zipfile
-import pandas as pd
-from selenium import webdriver
-from selenium.webdriver.chrome.options import Options
+import excel  # local source
+import folder_events
+import msdial
 
 
-def msflo(file_path, CHROME_DRIVER_DIRECTORY, DOWNLOADS_DIRECTORY):
+# ms-flo submit page, a local stand-in server (msflo_stand_in.py) can be used instead
+MSFLO_URL = "https://msflo.fiehnlab.ucdavis.edu/#/submit"
+
+# seconds to wait for the submit page and its form to load
+PAGE_TIMEOUT = 60
+
+# seconds to wait for ms-flo to return the processed .zip file
+DOWNLOAD_TIMEOUT = 900
+
+# values typed into the ms-flo form as (xpath, value), checkboxes are clicked when value is None
+FORM_FIELDS = (
+    # ms-dial button
+    ("/html/body/div/div/form/div[2]/div/div[2]/label/input", None),
+    # unclick contaminant ion removal button
+    ("/html/body/div/div/form/div[5]/div[2]/label/input", None),
+    # unclick adducts button
+    ("/html/body/div/div/form/div[5]/div[15]/label/input", None),
+    # duplicates peak height, rt tolerance, mz tolerance, and minimum peak match ratio
+    ("/html/body/div/div/form/div[5]/div[8]/input", "500"),
+    ("/html/body/div/div/form/div[5]/div[7]/input", "0.05"),
+    ("/html/body/div/div/form/div[5]/div[6]/input", "0.005"),
+    ("/html/body/div/div/form/div[5]/div[9]/input", "0.7"),
+    # isotope match
+    ("/html/body/div/div/form/div[5]/div[13]/input", "0.7"))
+FILE_INPUT = "/html/body/div/div/form/div[3]/div/span/span/input"
+SUBMIT_BUTTON = "/html/body/div/div/form/div[6]/input"
+
+
+def msflo(file_path, CHROME_DRIVER_DIRECTORY, DOWNLOADS_DIRECTORY, overwrite=False, pool=None):
     """ puts file through online Fiehn lab ms-flo software
     Parameters:
             file_path (str): Full directory path of file to be analyzed
             CHROME_DRIVER_DIRECTORY (str): Full directory path to Chrome driver
             DOWNLOADS_DIRECTORY (str): Full directory path to downloads folder
+            overwrite (bool): replace ms-flo .zip file left in downloads folder by a previous run
+            pool (dict): browser session pool from open_pool to reuse, a single session is started and closed if None
     Returns:
             None
     """
 
-    # open ms-flo in chrome browser
-    browser = webdriver.Chrome(
-        executable_path=CHROME_DRIVER_DIRECTORY)
-    browser.get("https://msflo.fiehnlab.ucdavis.edu/#/submit")
+    if pool is None:
 
-    # select ms-dial button
-    msdial_button = browser.find_element_by_xpath(
-        "/html/body/div/div/form/div[2]/div/div[2]/label/input")
-    msdial_button.click()
+        with session_pool(CHROME_DRIVER_DIRECTORY, sessions=1) as pool:
 
-    # input file
-    browse = browser.find_element_by_xpath(
-        "/html/body/div/div/form/div[3]/div/span/span/input")
-    browse.send_keys(file_path)
+            status = submit_files(pool, [file_path], DOWNLOADS_DIRECTORY, overwrite=overwrite)
 
-    # unclick contaminant ion removal button
-    contaminant_ion_removal_button = browser.find_element_by_xpath(
-        "/html/body/div/div/form/div[5]/div[2]/label/input")
-    contaminant_ion_removal_button.click()
+    else:
 
-    # unclick adducts button
-    adducts_button = browser.find_element_by_xpath(
-        "/html/body/div/div/form/div[5]/div[15]/label/input")
-    adducts_button.click()
+        status = submit_files(pool, [file_path], DOWNLOADS_DIRECTORY, overwrite=overwrite)
+
+    if status[file_path] != "complete":
+
+        raise RuntimeError(f"ms-flo {status[file_path]}")
+
+
+def start_browser(chrome_driver_directory, headless=True):
+    """ starts chrome session for ms-flo submissions
+    Parameters:
+            chrome_driver_directory (str): Full directory path to Chrome driver
+            headless (bool): run chrome without a window
+    Returns:
+            browser (selenium webdriver): chrome session
+    """
+
+    # selenium is only imported when a file is submitted, runs without ms-flo never load it
+    from selenium import webdriver
+    from selenium.webdriver.chrome.options import Options
+
+    options = Options()
+    if headless:
+
+        options.add_argument("--headless")
+        options.add_argument("--window-size=1280,1024")
+
+    options.add_experimental_option("prefs", {"download.prompt_for_download": False})
+
+    browser = webdriver.Chrome(executable_path=chrome_driver_directory, options=options)
+    browser.set_page_load_timeout(PAGE_TIMEOUT)
+
+    return browser
+
+
+def open_pool(chrome_driver_directory, sessions=2, headless=True, start_session=None):
+    """ creates pool of browser sessions, sessions are started when first needed and reused for later files
+    Parameters:
+            chrome_driver_directory (str): Full directory path to Chrome driver
+            sessions (int): largest number of browsers running at the same time
+            headless (bool): run chrome without a window
+            start_session (callable): start_session() returns a browser, start_browser if None
+    Returns:
+            pool (dict): pool passed to submit_files and close_pool
+    """
+
+    assert (sessions >= 1), "sessions must be at least 1"
+
+    if start_session is None:
+
+        start_session = lambda: start_browser(chrome_driver_directory, headless)
+
+    return {
+        "start_session": start_session,
+        "sessions": sessions,
+        "idle": queue.LifoQueue(),
+        "slots": threading.BoundedSemaphore(sessions),
+        "browsers": [],
+        "lock": threading.Lock()}
+
+
+def close_pool(pool):
+    """ quits every browser session of the pool, including sessions that failed """
+
+    with pool["lock"]:
+
+        browsers, pool["browsers"] = pool["browsers"], []
+
+    for browser in browsers:
+
+        try:
+
+            browser.quit()
+
+        except Exception as error:
+
+            print(f"browser did not quit cleanly: {error}")
+
+
+@contextlib.contextmanager
+def session_pool(chrome_driver_directory, sessions=2, headless=True, start_session=None):
+    """ browser session pool that is always shut down when the with block ends, see open_pool """
+
+    pool = open_pool(chrome_driver_directory, sessions, headless, start_session)
+
+    try:
+
+        yield pool
+
+    finally:
+
+        close_pool(pool)
+
+
+def borrow_session(pool):
+    """ waits for a free job slot, then reuses an idle browser or starts a new one
+
+    Browsers are only started when no idle browser is left, so running browsers never exceed pool sessions.
+
+    """
+
+    pool["slots"].acquire()
+
+    try:
+
+        return pool["idle"].get_nowait()
+
+    except queue.Empty:
+
+        pass
+
+    try:
+
+        browser = pool["start_session"]()
+
+    except BaseException:
+
+        pool["slots"].release()
+        raise
+
+    with pool["lock"]:
+
+        pool["browsers"].append(browser)
+
+    return browser
+
+
+def return_session(pool, browser):
+    """ puts a browser that finished its job back in the pool for the next file """
+
+    pool["idle"].put(browser)
+    pool["slots"].release()
 
-    # update duplicates form
-    dup_peak_height = browser.find_element_by_xpath(
-        "/html/body/div/div/form/div[5]/div[8]/input")
-    dup_peak_height.send_keys('500')
 
-    dup_rt_tolerance = browser.find_element_by_xpath(
-        "/html/body/div/div/form/div[5]/div[7]/input")
-    dup_rt_tolerance.send_keys('0.05')
+def discard_session(pool, browser):
+    """ quits a browser that failed so the next job starts a fresh session """
 
-    dup_mz_tolerance = browser.find_element_by_xpath(
-        "/html/body/div/div/form/div[5]/div[6]/input")
-    dup_mz_tolerance.send_keys('0.005')
+    with pool["lock"]:
 
-    dup_min_peak_match_ratio = browser.find_element_by_xpath(
-        "/html/body/div/div/form/div[5]/div[9]/input")
-    dup_min_peak_match_ratio.send_keys('0.7')
+        if browser in pool["browsers"]:
 
-    # update isotope form
-    isotope_match = browser.find_element_by_xpath(
-        "/html/body/div/div/form/div[5]/div[13]/input")
-    isotope_match.send_keys('0.7')
+            pool["browsers"].remove(browser)
 
-    # create download file path with ms-flo created filename concatenated onto
-    # folder directory
-    download_file_path = create_download_file_path(
-        file_path, DOWNLOADS_DIRECTORY)
+    try:
+
+        browser.quit()
+
+    except Exception:
+
+        pass
+
+    pool["slots"].release()
+
+
+def submit_files(pool, file_paths, downloads_directory, url=MSFLO_URL, timeout=DOWNLOAD_TIMEOUT, overwrite=False):
+    """ puts files through ms-flo at the same time, one file per browser session of the pool
+    Parameters:
+            pool (dict): browser session pool from open_pool
+            file_paths (list): Full directory paths of toBeProcessed .txt files
+            downloads_directory (str): Full directory path to downloads folder, each job downloads to its own folder in it
+            url (str): ms-flo submit page
+            timeout (float): seconds to wait for each processed .zip file
+            overwrite (bool): replace processed files left by a previous run
+    Returns:
+            status (dict): file path to "complete" or the error that stopped the job
+    """
+
+    assert (os.path.isdir(downloads_directory)), "downloads_directory is not a directory"
+
+    jobs = queue.Queue()
+    for file_path in file_paths:
+
+        jobs.put(file_path)
+
+    status = {}
+
+    def worker():
+
+        while True:
+
+            try:
+
+                file_path = jobs.get_nowait()
+
+            except queue.Empty:
+
+                return
+
+            browser = None
+            job_directory = tempfile.mkdtemp(prefix="msflo-", dir=downloads_directory)
+
+            try:
+
+                browser = borrow_session(pool)
+                submit_file(browser, file_path, job_directory, url, timeout, overwrite)
+                return_session(pool, browser)
+                status[file_path] = "complete"
+
+            except Exception as error:
+
+                # a session that failed mid-job may be left on any page or hung, it is replaced
+                if browser is not None:
+
+                    discard_session(pool, browser)
+
+                status[file_path] = f"failed: {type(error).__name__}: {error}"
+                print(f"ms-flo {status[file_path]}: {file_path}")
+
+            finally:
+
+                shutil.rmtree(job_directory, ignore_errors=True)
+
+    threads = [threading.Thread(target=worker, daemon=True) for _ in range(min(pool["sessions"], len(file_paths)))]
+    for thread in threads:
+
+        thread.start()
+
+    for thread in threads:
+
+        thread.join()
+
+    return status
+
+
+def submit_file(browser, file_path, job_directory, url=MSFLO_URL, timeout=DOWNLOAD_TIMEOUT, overwrite=False):
+    """ fills ms-flo form in one browser session, waits for the processed .zip file, and unzips it next to file_path
+    Parameters:
+            browser (selenium webdriver): chrome session from the pool
+            file_path (str): Full directory path of file to be analyzed
+            job_directory (str): empty folder the .zip file is downloaded to
+            url (str): ms-flo submit page
+            timeout (float): seconds to wait for the processed .zip file
+            overwrite (bool): replace processed files left by a previous run
+    Returns:
+            None
+    """
+
+    from selenium.webdriver.support.ui import WebDriverWait
+
+    # downloads of this job go to its own folder, set through devtools so a running session can be reused
+    browser.execute_cdp_cmd(
+        "Page.setDownloadBehavior", {"behavior": "allow", "downloadPath": os.path.abspath(job_directory)})
+
+    # open ms-flo and wait for the form
+    browser.get(url)
+    WebDriverWait(browser, PAGE_TIMEOUT).until(lambda page: page.find_elements_by_xpath(SUBMIT_BUTTON))
+
+    # input file
+    browser.find_element_by_xpath(FILE_INPUT).send_keys(os.path.abspath(file_path))
+
+    # ms-dial input, duplicate and isotope settings, no contaminant or adduct removal
+    for xpath, value in FORM_FIELDS:
+
+        element = browser.find_element_by_xpath(xpath)
+
+        if value is None:
+
+            element.click()
+
+        else:
+
+            element.clear()
+            element.send_keys(value)
+
+    # create download file path with ms-flo created filename concatenated onto job folder
+    download_file_path = create_download_file_path(file_path, job_directory, overwrite)
 
     # click submit button
-    submit_button = browser.find_element_by_xpath(
-        "/html/body/div/div/form/div[6]/input")
-    submit_button.click()
+    browser.find_element_by_xpath(SUBMIT_BUTTON).click()
 
-    # will not close chrome browser until file is finished downloading
-    wait_for_downloads(download_file_path)
+    # will not reuse the session until file is finished downloading
+    wait_for_downloads(download_file_path, timeout)
 
     # unzip downloaded file and send to original filepath
+    if overwrite:
+
+        remove_processed_files(download_file_path, os.path.dirname(file_path))
+
     unzip_msflo_file(download_file_path, os.path.dirname(file_path))
     print(f"ms-flo complete: {os.path.dirname(file_path)}")
 
 
-def wait_for_downloads(final_download_file_path):
-    """ keeps chrome open while files download from ms-flo
+def wait_for_downloads(final_download_file_path, timeout=None):
+    """ keeps chrome session busy while files download from ms-flo
     Parameters:
             download_file_path (str): downloads folder for system being used
+            timeout (float): seconds to wait, forever if None
     Returns:
             None
     """
 
-    # while the file does not exist in the directory, keep the browser open
-    while not os.path.exists(final_download_file_path):
-        time.sleep(1)
+    # wait until the file appears in the directory, woken by file system events
+    if not folder_events.wait_for_file(final_download_file_path, timeout):
+
+        raise TimeoutError(f"{final_download_file_path} not downloaded after {timeout} seconds")
+
+
+def remove_processed_files(download_file_path, send_to_file_path):
+    """ deletes files a previous run unzipped so the new .zip file replaces them """
+
+    with zipfile.ZipFile(download_file_path, 'r') as zip_ref:
+
+        for name in zip_ref.namelist():
+
+            if os.path.isfile(os.path.join(send_to_file_path, name)):
+
+                os.remove(os.path.join(send_to_file_path, name))
 
 
 def unzip_msflo_file(download_file_path, send_to_file_path):
@@ -113,11 +385,12 @@ def unzip_msflo_file(download_file_path, send_to_file_path):
         zip_ref.extractall(send_to_file_path)
 
 
-def create_download_file_path(file_path, download_file_path):
+def create_download_file_path(file_path, download_file_path, overwrite=False):
     """ creates filepath in downloads directory with correct file name concatenated
     Parameters:
             file_path (str): Full directory path of file to be analyzed
             download_file_path (str): downloads folder for system being used
+            overwrite (bool): delete .zip file left by a previous run instead of stopping
     Returns:
             final_download_path (str): download folder path with ms-flo .zip file name concatenated
     """
@@ -133,6 +406,10 @@ def create_download_file_path(file_path, download_file_path):
     final_download_path = os.path.join(download_file_path, file_name_zip)
 
     # make sure file path is valid
+    if overwrite and os.path.exists(final_download_path):
+
+        os.remove(final_download_path)
+
     assert(not os.path.exists(final_download_path)
            ), f"{final_download_path} already exists"
 
@@ -150,7 +427,7 @@ def create_excel_file(file_path):
     processed_name = file_path[:len(file_path) - 4] + "_processed.txt"
 
     # read in msflo processed file
-    file = pd.read_csv(processed_name, sep='\t')
+    file = msdial.read_table(processed_name)
     
     # update name to get rid of "_" characters from duplicate combination
     new_name = [name[:-1] if type(name) == str and name[-1] == "_" else name for name in file['Metabolite name']]
@@ -181,7 +458,7 @@ def create_single_point_file (file_path, file):
             file_path (str): Full directory path of file to be analyzed
             file (data_frame): currated file to be put into format for single point quant
     Returns:
-            None
+            file_name (str): Full directory path of single point quant excel file
     """
 
     # create data frame exculding unknowns
@@ -317,6 +594,8 @@ def create_single_point_file (file_path, file):
     file.insert(9, 'iSTD Type', iSTD_match)
     file.insert(8, 'Keep for iSTD Single Point Quant', drop)
 
-    # create excel file and output to console completion of task
-    file.to_excel(file_name, index=False)
+    # create excel file and output to console completion of task, rows are streamed so large studies fit in memory
+    excel.write_excel(file, file_name)
     print(f"file saved: {file_name}")
+
+    return file_name
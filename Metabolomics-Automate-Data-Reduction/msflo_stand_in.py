@@ -0,0 +1,133 @@
+#!/usr/bin/env python
+
+""" msflo_stand_in.py: Local stand-in for the ms-flo submit form that returns the uploaded file as a processed .zip """
+
+__author__ = "Bryan Roberts"
+
+import argparse
+import email.parser
+import email.policy
+import io
+import os
+import threading
+import time
+import zipfile
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+# form laid out so the xpaths in msflo.FORM_FIELDS, FILE_INPUT, and SUBMIT_BUTTON find the same inputs
+SETTINGS = "".join(
+    "<div><label><input type=\"checkbox\" name=\"setting{0}\" checked></label></div>".format(number)
+    if number in (2, 15) else "<div><input type=\"text\" name=\"setting{0}\"></div>".format(number)
+    for number in range(1, 16))
+
+FORM_PAGE = (
+    "<!DOCTYPE html><html><head><title>MS-FLO stand-in</title></head><body><div><div>"
+    "<form action=\"/submit\" method=\"post\" enctype=\"multipart/form-data\">"
+    "<div>Input type</div>"
+    "<div><div><div><label><input type=\"radio\" name=\"type\" value=\"mzmine\"></label></div>"
+    "<div><label><input type=\"radio\" name=\"type\" value=\"msdial\"></label></div></div></div>"
+    "<div><div><span><span><input type=\"file\" name=\"file\"></span></span></div></div>"
+    "<div>Settings</div>"
+    f"<div>{SETTINGS}</div>"
+    "<div><input type=\"submit\" value=\"Submit\"></div>"
+    "</form></div></div></body></html>")
+
+
+def processed_zip(file_name, contents):
+    """ zips uploaded contents as <name>_processed.txt, the file ms-flo returns """
+
+    buffer = io.BytesIO()
+    with zipfile.ZipFile(buffer, "w", zipfile.ZIP_DEFLATED) as zip_file:
+
+        zip_file.writestr(os.path.splitext(file_name)[0] + "_processed.txt", contents)
+
+    return buffer.getvalue()
+
+
+def read_form(headers, body):
+    """ parses multipart form body into {field name: (file name, contents)} """
+
+    message = email.parser.BytesParser(policy=email.policy.HTTP).parsebytes(
+        b"Content-Type: " + headers["Content-Type"].encode() + b"\r\n\r\n" + body)
+
+    return {
+        part.get_param("name", header="content-disposition"): (part.get_filename(), part.get_payload(decode=True))
+        for part in message.iter_parts()}
+
+
+class StandInHandler(BaseHTTPRequestHandler):
+    """ serves the submit form and answers submissions with a processed .zip after the server delay """
+
+    delay = 0.0
+
+    def do_GET(self):
+
+        self.send_response(200)
+        self.send_header("Content-Type", "text/html; charset=utf-8")
+        self.end_headers()
+        self.wfile.write(FORM_PAGE.encode())
+
+    def do_POST(self):
+
+        body = self.rfile.read(int(self.headers.get("Content-Length", 0)))
+        form = read_form(self.headers, body)
+        file_name, contents = form.get("file", (None, None))
+
+        if not file_name:
+
+            self.send_error(400, "no file uploaded")
+            return
+
+        # ms-flo takes a while to process a file
+        time.sleep(self.delay)
+
+        file_name = os.path.basename(file_name)
+        zip_name = os.path.splitext(file_name)[0].replace('"', '') + ".zip"
+        self.send_response(200)
+        self.send_header("Content-Type", "application/zip")
+        self.send_header("Content-Disposition", f"attachment; filename=\"{zip_name}\"")
+        self.end_headers()
+        self.wfile.write(processed_zip(file_name, contents))
+
+    def log_message(self, format, *args):
+
+        pass
+
+
+def start_server(port=0, delay=0.0):
+    """ starts stand-in server in a background thread
+
+    Parameters:
+            port (int): port to listen on, any free port if 0
+            delay (float): seconds each submission takes, used to try download timeouts
+
+    Returns:
+            server (ThreadingHTTPServer): call server.shutdown() to stop
+            url (str): submit page url to pass to msflo.submit_files
+
+    """
+
+    handler = type("Handler", (StandInHandler,), {"delay": delay})
+    server = ThreadingHTTPServer(("127.0.0.1", port), handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+
+    return server, f"http://127.0.0.1:{server.server_address[1]}/#/submit"
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--port", type=int, default=8765, help="port to listen on")
+    parser.add_argument("--delay", type=float, default=0.0, help="seconds each submission takes")
+    args = parser.parse_args()
+
+    server, url = start_server(args.port, args.delay)
+    print(f"ms-flo stand-in running: {url}")
+
+    try:
+
+        threading.Event().wait()
+
+    except KeyboardInterrupt:
+
+        server.shutdown()
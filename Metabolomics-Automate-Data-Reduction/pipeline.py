@@ -0,0 +1,879 @@
+#!/usr/bin/env python
+
+""" pipeline.py: Data reduction stages as a resumable DAG with content-addressed cached artifacts """
+
+__author__ = "Bryan Roberts"
+
+import hashlib
+import json
+import os
+import pickle
+from collections import namedtuple
+
+# stage modules are imported inside the stages that use them, so a run only loads pandas, plotly, and selenium when
+# a stage needing them is not cached
+import profiling  # local source
+
+# included in every stage key, increase when stage code changes results so cached artifacts are rebuilt
+PIPELINE_VERSION = 9
+
+# folder next to the input file holding cached artifacts and the pipeline state
+CACHE_FOLDER = ".pipeline_cache"
+
+# bytes read at a time when hashing files
+HASH_BLOCK_SIZE = 1024 * 1024
+
+# files written next to the input file by the stages through output_path, ex: Client_MX123456_posHILIC_report.html
+OUTPUT_SUFFIXES = (
+    "_report.html", "_reduced.txt", "_toBeProcessed.txt", "_statistics.txt", "_registry.txt",
+    "_toBeProcessed_processed.txt", "_processed.xlsx")
+
+Stage = namedtuple("Stage", ["name", "inputs", "parameters", "outputs", "run"])
+Stage.__doc__ = """ pipeline stage
+
+    name (str): stage name, also used in run manifest
+    inputs (tuple): names of upstream stages whose outputs this stage reads
+    parameters (tuple): keys of pipeline parameters that change this stage's outputs
+    outputs (callable): outputs(context, key) returns list of files the stage writes
+    run (callable): run(context, key) runs the stage and writes its outputs
+"""
+
+
+def file_hash(file_path):
+    """ sha256 of file contents
+
+    Parameters:
+            file_path (str): Full directory path of file to hash
+
+    Returns:
+            str: hex digest
+
+    """
+
+    digest = hashlib.sha256()
+    with open(file_path, "rb") as hashed_file:
+
+        for block in iter(lambda: hashed_file.read(HASH_BLOCK_SIZE), b""):
+
+            digest.update(block)
+
+    return digest.hexdigest()
+
+
+def stage_key(stage, parameters, input_hashes):
+    """ content address of a stage from its name, parameters, and the contents of everything it reads
+
+    Parameters:
+            stage (Stage): pipeline stage
+            parameters (dict): pipeline parameters
+            input_hashes (dict): file path to sha256 of every upstream output and source file
+
+    Returns:
+            str: hex digest
+
+    """
+
+    description = {
+        "version": PIPELINE_VERSION,
+        "stage": stage.name,
+        "parameters": {key: parameters[key] for key in stage.parameters},
+        "inputs": sorted(input_hashes.values())}
+
+    return hashlib.sha256(json.dumps(description, sort_keys=True).encode()).hexdigest()
+
+
+def cache_path(context, stage_name, key, extension):
+    """ content-addressed artifact path inside the cache folder """
+
+    return os.path.join(context["cache_folder"], f"{stage_name}-{key[:16]}{extension}")
+
+
+def read_state(state_path):
+    """ reads stage keys and output hashes of the last run, empty if there was none """
+
+    if not os.path.exists(state_path):
+
+        return {}
+
+    with open(state_path) as state_file:
+
+        return json.load(state_file)
+
+
+def write_state(state_path, state):
+    """ writes stage keys and output hashes, through a temporary file so an interrupted write keeps the old state """
+
+    with open(state_path + ".tmp", "w") as state_file:
+
+        json.dump(state, state_file, indent=2)
+
+    os.replace(state_path + ".tmp", state_path)
+
+
+def is_fresh(recorded, key):
+    """ stage is fresh when its key is unchanged and every output still exists with the recorded contents """
+
+    if recorded is None or recorded["key"] != key:
+
+        return False
+
+    return all(
+        os.path.exists(path) and file_hash(path) == digest for path, digest in recorded["outputs"].items())
+
+
+def remove_stale_artifacts(context, recorded, outputs):
+    """ deletes cached artifacts of the previous run of a stage that were replaced by new outputs """
+
+    if recorded is None:
+
+        return
+
+    for path in recorded["outputs"]:
+
+        if path not in outputs and os.path.dirname(path) == context["cache_folder"] and os.path.exists(path):
+
+            os.remove(path)
+
+
+def run_pipeline(stages, context, parameters, state_path):
+    """ runs stages in order, skipping stages whose key and outputs are unchanged since the last run
+
+    Stages must be listed after the stages they read from.  A stage is stale when its parameters, the source file,
+    or any upstream output changed, so a rerun resumes from the first stale stage.
+
+    Parameters:
+            stages (list): Stage list in dependency order
+            context (dict): shared values for stage functions, "source" is the input file
+            parameters (dict): pipeline parameters
+            state_path (str): Full directory path of pipeline state .json file
+
+    Returns:
+            None
+
+    """
+
+    state = read_state(state_path)
+    output_hashes = {"source": {context["source"]: file_hash(context["source"])}}
+    finished = set()
+
+    for stage in stages:
+
+        assert all(name in finished or name == "source" for name in stage.inputs), \
+            f"{stage.name} is listed before one of its inputs {stage.inputs}"
+
+        input_hashes = {}
+        for name in stage.inputs:
+
+            input_hashes.update(output_hashes[name])
+
+        key = stage_key(stage, parameters, input_hashes)
+        outputs = stage.outputs(context, key)
+
+        if is_fresh(state.get(stage.name), key):
+
+            print(f"{stage.name}: unchanged, using cached outputs")
+            profiling.cached(context["run"], stage.name)
+
+        else:
+
+            stage.run(context, key)
+            remove_stale_artifacts(context, state.get(stage.name), outputs)
+
+        output_hashes[stage.name] = {path: file_hash(path) for path in outputs}
+        for path in output_hashes[stage.name]:
+
+            if os.path.dirname(path) != context["cache_folder"]:
+
+                profiling.add_output(context["run"], path)
+
+        state[stage.name] = {"key": key, "outputs": output_hashes[stage.name]}
+        write_state(state_path, state)
+        finished.add(stage.name)
+
+
+def load_reduced(context):
+    """ loads reduced artifact of the reduce stage, kept in context after the first load """
+
+    if "reduced" not in context:
+
+        with open(context["reduced_path"], "rb") as reduced_file:
+
+            context["reduced"] = pickle.load(reduced_file)
+
+        context["name"] = context["reduced"]["sample_information_name"]
+
+    return context["reduced"]
+
+
+def feature_groups(reduced):
+    """ internal standards, knowns, and unknowns of the reduced features as row slices, no rows are copied """
+
+    istd_count, known_count, _ = reduced["group_sizes"]
+    features = reduced["features"]
+
+    return (
+        features.iloc[:istd_count],
+        features.iloc[istd_count:istd_count + known_count],
+        features.iloc[istd_count + known_count:])
+
+
+def output_path(context, suffix):
+    """ path next to the input file named from the sample information, ex: Client_MX123456_posHILIC_report.html
+
+    Suffixes must be listed in OUTPUT_SUFFIXES so watch.py never treats a stage output as a new export.
+
+    """
+
+    assert suffix in OUTPUT_SUFFIXES, f"{suffix} is not in pipeline.OUTPUT_SUFFIXES"
+
+    load_reduced(context)
+
+    return os.path.join(context["output_folder"], context["name"] + suffix)
+
+
+def read_source(context, sample_order=None):
+    """ curated data frame of the export, only the samples of context["study"] when the export holds several studies
+
+    The export is read by the first study needing it and kept in context["shared"] for the others.  Sample columns
+    are kept in sample_order, every study of an export uses the same order.
+
+    """
+
+    import reduce
+    import sample_names
+
+    if context["study"] is None:
+
+        return reduce.filter_file(context["source"], compact=True, sample_order=sample_order)
+
+    shared = context["shared"]
+    if "frame" not in shared:
+
+        shared["frame"] = reduce.filter_file(context["source"], compact=True, sample_order=sample_order)
+
+    frame = shared["frame"]
+
+    return frame[sample_names.study_columns(frame.columns, context["study"])].copy()
+
+
+def sample_batches(file_location):
+    """ Batch ID of every sample column from the header rows of an export, None when the export has no Batch ID row """
+
+    import msdial
+
+    sample_info = msdial.read_sample_info(file_location)
+    if "Batch ID" not in sample_info.columns:
+
+        return None
+
+    return sample_info["Batch ID"].astype(str)
+
+
+def acquisition_order(context):
+    """ acquisition time and run order of every sample column of the export from file_times.csv next to it
+
+    The join is made once per export and kept in context["shared"] for every study.
+
+    Returns:
+            run_order (pandas data-frame): Acquired and Run Order of every sample column, see run_order.join_file_times
+            unmatched (list): sample columns without a raw data file in file_times.csv
+
+    """
+
+    import batches
+    import msdial
+    import run_order
+
+    shared = context["shared"]
+    if "acquisition" not in shared:
+
+        times_path = os.path.join(context["output_folder"], batches.FILE_TIMES_NAME)
+        assert os.path.exists(times_path), f"{times_path} does not exist, run agilent_date_time_extractor.py"
+
+        shared["acquisition"] = run_order.read_run_order(
+            times_path, msdial.read_sample_info(context["source"]).index.tolist())
+
+        unmatched = shared["acquisition"][1]
+        if unmatched:
+
+            print(f"{len(unmatched)} sample columns without an acquisition time in {times_path}: "
+                  f"{', '.join(unmatched[:10])}{', ...' if len(unmatched) > 10 else ''}")
+
+    return shared["acquisition"]
+
+
+def injection_batches(context, columns):
+    """ batch of every injection column from the batch parameter, None when the export is one batch
+
+    The batch parameter is "batch_id" for the Batch ID row of the export, "acquisition_time" for gaps in the times of
+    file_times.csv next to the export, or the number of injections of each batch in injection order.
+
+    """
+
+    import batches
+
+    batch = context["parameters"]["batch"]
+    if batch is None:
+
+        return None
+
+    if batch == "batch_id":
+
+        batch_ids = sample_batches(context["source"])
+        assert batch_ids is not None, f"{context['source']} has no Batch ID row"
+
+        return batches.from_batch_ids(columns, batch_ids)
+
+    if batch == "acquisition_time":
+
+        return batches.from_acquisition_times(columns, acquisition_order(context)[0]["Acquired"])
+
+    return batches.from_injection_order(columns, int(batch))
+
+
+def export_studies(file_location):
+    """ studies of the sample columns of an export, read from its header rows only """
+
+    import msdial
+    import sample_names
+
+    rows = msdial.read_rows(file_location, msdial.HEADER_SEARCH_ROWS)
+    columns = rows[msdial.find_header_row(rows)]
+
+    return sample_names.studies(sample_names.parse([column for column in columns if column is not None]))
+
+
+def reduce_outputs(context, key):
+
+    context["reduced_path"] = cache_path(context, "reduce", key, ".pkl")
+
+    return [context["reduced_path"]]
+
+
+def reduce_stage(context, key):
+    """ reads MS-Dial export, corrects drift, adds reduction columns, and filters features
+
+    Parameters:
+            context (dict): pipeline context with "source", "run", and "parameters"
+            key (str): stage key naming the cached reduced artifact
+
+    Returns:
+            None
+
+    """
+
+    import reduce
+    import drift
+    import qc_metrics
+    import run_order
+    import spectra
+
+    run = context["run"]
+    parameters = context["parameters"]
+
+    # acquisition time and run order of every sample column, joined from file_times.csv by sample name
+    acquisition = None
+    sample_order = None
+    if parameters["run_order"]:
+
+        with profiling.stage(run, "run order") as stage:
+
+            acquisition, _ = acquisition_order(context)
+            sample_order = run_order.ordered_columns(acquisition)
+            profiling.set_shape(stage, acquisition)
+
+    # make data frame from excel sheet, exports holding several studies are read once for all of them, height columns
+    # are read in run order when it is known
+    with profiling.stage(run, "read") as stage:
+
+        df = read_source(context, sample_order)
+        profiling.set_shape(stage, df)
+
+    # determine feature type and find columns with matching names
+    with profiling.stage(run, "feature typing") as stage:
+
+        reduce.determine_feature_type(df)
+
+        blanks = []
+        biorecs = []
+        pools = []
+        samples = []
+        reduce.filter_samples(df, blanks, biorecs, pools, samples)
+        profiling.set_shape(stage, df)
+
+    # run order of this study's injections for drift correction and the report
+    if acquisition is not None:
+
+        acquisition = acquisition.loc[blanks + biorecs + pools + samples]
+
+    # imputed height counts and drift summary are charted by the report stage
+    imputed = None
+    drift_cv = None
+
+    # fill missing, zero, and near-zero heights before drift correction and reduction columns
+    if parameters["imputation"]:
+
+        import imputation
+
+        with profiling.stage(run, "imputation") as stage:
+
+            imputed = imputation.impute(df, blanks + biorecs + pools + samples, parameters["imputation"], blanks)
+            profiling.set_shape(stage, df)
+
+    # correct signal drift of all injections using pool qc fits in injection order
+    if parameters["drift_correction"]:
+
+        with profiling.stage(run, "drift correction") as stage:
+
+            if acquisition is None:
+
+                injection_order = drift.injection_order(blanks + biorecs + pools + samples)
+
+            else:
+
+                injection_order = run_order.ordered_columns(acquisition)
+
+            drift_cv = drift.correct_drift(df, pools, injection_order)
+            profiling.set_shape(stage, df)
+
+    # Fold 2 and blank subtraction use the blanks of each injection's own batch, computed before subtraction
+    fold2 = None
+    batch_summary = None
+    if parameters["batch"] is not None or parameters["blank_subtraction"]:
+
+        with profiling.stage(run, "batch blanks") as stage:
+
+            subtract = biorecs + pools + samples if parameters["blank_subtraction"] else ()
+            fold2, batch_summary = reduce.batch_blanks(
+                df, blanks, samples, injection_batches(context, blanks + biorecs + pools + samples), subtract)
+            profiling.set_shape(stage, batch_summary)
+
+    # qc metrics for every feature and injection, shared by reduction columns and report
+    with profiling.stage(run, "reduction columns") as stage:
+
+        metrics = qc_metrics.feature_metrics(df, blanks, biorecs, pools, samples)
+        injections = qc_metrics.injection_metrics(df, blanks, biorecs, pools, samples, df['Type'] == 'iSTD')
+
+        # add reduction columns
+        reduce.add_reduction_columns(df, blanks, samples, pools, metrics, fold2=fold2)
+        profiling.set_shape(stage, df)
+
+    with profiling.stage(run, "filtering") as stage:
+
+        # update Metabolite name, InChiKey, Species
+        names = df['Metabolite name'].str.split("[", n = 1, expand = True)
+        inchikey = names[1].str.split("_", n = 1, expand = True)
+        species = inchikey[0]
+        inchikey = inchikey[1]
+        name = names[0]
+
+        #update inchikey
+        inchi = []
+        for mzrt, msdial in zip(inchikey, df['INCHIKEY']):
+
+            if isinstance(mzrt, str):
+
+                inchi.append(mzrt)
+
+            else:
+
+                inchi.append(msdial)
+
+        #update species
+        adduct = []
+        for mzrt, msdial in zip(species, df['Adduct type']):
+
+            if isinstance(mzrt, str):
+
+                adduct.append("[" + mzrt)
+
+            else:
+
+                adduct.append(msdial)
+
+        for i in range(len(name)):
+
+            if name[i][-1] == "_":
+
+                name[i] = name[i][:-1]
+
+            if name[i][-2] == ";":
+
+                name[i] = name[i][:-2]
+
+
+        # update values in columns
+        df['INCHIKEY'] = inchi
+        df['Metabolite name'] = name
+        df['Adduct type'] = adduct
+
+        # rows are selected by label in name order and taken from df once, instead of copying df for the sort and
+        # for every filter
+        order = df['Metabolite name'].sort_values().index
+        feature_type = df['Type'].reindex(order).to_numpy()
+        fold2 = df['Fold 2'].reindex(order).to_numpy()
+
+        # create index for each type of annotated feature
+        internal_standards = order[feature_type == 'iSTD']
+
+        # reduce annotated features
+        knowns_before_reduction = int((feature_type == 'known').sum())
+        knowns = order[
+            (feature_type == 'known')
+            & (fold2 > parameters["known_fold2"])
+            & (df['Sample Max'].reindex(order).to_numpy() > parameters["known_sample_max"])]
+
+        # reduce unknowns
+        unknowns_before_reduction = int((feature_type == 'unknown').sum())
+        unknowns = order[
+            (feature_type == 'unknown')
+            & (fold2 > parameters["unknown_fold2"])
+            & (df['Sample Average'].reindex(order).to_numpy() > parameters["unknown_sample_average"])]
+        unknown_adducts = df.loc[unknowns, 'Adduct type'].copy()
+        df.loc[unknowns, ['Metabolite name', 'INCHIKEY', 'Adduct type']] = ""
+
+        # internal standards, knowns, then unknowns, each a slice of features
+        features = df.loc[internal_standards.append([knowns, unknowns])]
+
+        # len of knowns and unknowns after reduction
+        knowns_after_reduction = len(knowns)
+        unknowns_after_reduction = len(unknowns)
+        profiling.set_shape(stage, features)
+
+    # reduced features ms-flo is likely to merge, scored by MS/MS similarity for the report
+    with profiling.stage(run, "duplicate features") as stage:
+
+        duplicates = spectra.duplicate_candidates(features)
+        profiling.set_shape(stage, duplicates)
+
+    # reduced artifact read by report and export stages
+    context["reduced"] = {
+        "features": features,
+        "group_sizes": (len(internal_standards), knowns_after_reduction, unknowns_after_reduction),
+        "samples": samples,
+        "sample_information_name": reduce.extract_sample_information(samples),
+        "feature_counts": (
+            knowns_before_reduction, knowns_after_reduction, unknowns_before_reduction, unknowns_after_reduction),
+        "batches": sample_batches(context["source"]),
+        "imputed": imputed,
+        "batch_summary": batch_summary,
+        "unknown_adducts": unknown_adducts,
+        "drift_cv": drift_cv,
+        "run_order": acquisition,
+        "metrics": metrics,
+        "injections": injections,
+        "duplicates": duplicates}
+    context["name"] = context["reduced"]["sample_information_name"]
+
+    with open(context["reduced_path"], "wb") as reduced_file:
+
+        pickle.dump(context["reduced"], reduced_file, protocol=pickle.HIGHEST_PROTOCOL)
+
+
+def projection_outputs(context, key):
+
+    context["projection_path"] = cache_path(context, "projection", key, ".pkl")
+
+    return [context["projection_path"]]
+
+
+def projection_stage(context, key):
+    """ principal component scores of the biorec, pool, and sample injections of the reduced features """
+
+    import projection
+
+    reduced = load_reduced(context)
+
+    with profiling.stage(context["run"], "qc projection") as stage:
+
+        scores, explained = projection.qc_projection(reduced["features"], reduced["batches"])
+        profiling.set_shape(stage, scores)
+
+    with open(context["projection_path"], "wb") as projection_file:
+
+        pickle.dump({"scores": scores, "explained": explained}, projection_file, protocol=pickle.HIGHEST_PROTOCOL)
+
+
+def report_outputs(context, key):
+
+    return [output_path(context, "_report.html")]
+
+
+def report_stage(context, key):
+    """ writes static html report next to the original file """
+
+    import report
+    import spectra
+
+    reduced = load_reduced(context)
+
+    with profiling.stage(context["run"], "report"):
+
+        report_sections = []
+        if reduced["drift_cv"] is not None:
+
+            report_sections.append(report.chart_drift_correction(reduced["drift_cv"]))
+
+        if reduced["imputed"] is not None:
+
+            report_sections.append(report.chart_imputation(reduced["imputed"], reduced["features"]))
+
+        if reduced["run_order"] is not None:
+
+            report_sections.append(report.chart_run_order(reduced["run_order"]))
+
+        if reduced["batch_summary"] is not None:
+
+            report_sections.append(report.chart_batches(reduced["batch_summary"]))
+
+        report_sections.append(report.chart_qc_metrics(reduced["metrics"], reduced["injections"]))
+
+        with open(context["projection_path"], "rb") as projection_file:
+
+            qc_projection = pickle.load(projection_file)
+
+        report_sections.append(report.chart_projection(qc_projection["scores"], qc_projection["explained"]))
+        report_sections.append(report.number_of_features_changed(*reduced["feature_counts"]))
+        internal_standards, knowns, _ = feature_groups(reduced)
+        report_sections.append(report.chart_feature_cv(internal_standards, "Internal Standards"))
+        report_sections.append(report.chart_feature_cv(knowns, "Knowns"))
+        report_sections.append(report.chart_duplicates(reduced["duplicates"], spectra.DUPLICATE_MATCH_RATIO))
+
+        report.write_report(report_outputs(context, key)[0], context["name"], report_sections)
+
+
+def export_outputs(context, key):
+
+    return [output_path(context, "_reduced.txt"), output_path(context, "_toBeProcessed.txt")]
+
+
+def export_stage(context, key):
+    """ creates text file of all reduced features for ms-flo analysis """
+
+    import reduce
+
+    reduced = load_reduced(context)
+
+    with profiling.stage(context["run"], "export"):
+
+        reduce.create_to_be_processed_txt(
+            *feature_groups(reduced),
+            context["source"],
+            reduced["samples"],
+            overwrite=True)
+
+
+def statistics_outputs(context, key):
+
+    return [output_path(context, "_statistics.txt")]
+
+
+def statistics_stage(context, key):
+    """ writes fold change, p-value, and FDR of every reduced feature between the sample groups of the sample names """
+
+    import univariate
+
+    reduced = load_reduced(context)
+
+    with profiling.stage(context["run"], "statistics") as stage:
+
+        features = reduced["features"]
+        design = univariate.design_from_names(reduced["samples"])
+        statistics = univariate.feature_statistics(features, design)
+        statistics.to_csv(statistics_outputs(context, key)[0], sep="\t", index=False)
+
+        if statistics.empty:
+
+            print("statistics: fewer than two sample groups in the Sample IDs, statistics file has no rows")
+
+        profiling.set_shape(stage, statistics)
+
+
+def registry_outputs(context, key):
+
+    return [output_path(context, "_registry.txt")]
+
+
+def registry_stage(context, key):
+    """ matches reduced features against features of earlier studies in the registry, then registers them """
+
+    import registry
+    import sample_names
+
+    reduced = load_reduced(context)
+
+    with profiling.stage(context["run"], "registry") as stage:
+
+        modes = sample_names.parse(reduced["samples"])["Mode"].dropna()
+        table, summary = registry.match_and_register(
+            context["parameters"]["registry"], context["name"], modes.iloc[0] if len(modes) else "",
+            reduced["features"], reduced["unknown_adducts"], context["source"])
+        table.to_csv(registry_outputs(context, key)[0], sep="\t", index=False)
+
+        print(f"registry: {summary['matched']} of {summary['features']} features match features of "
+              f"{summary['studies']} studies")
+        profiling.set_shape(stage, table)
+
+
+def msflo_outputs(context, key):
+
+    return [output_path(context, "_toBeProcessed_processed.txt")]
+
+
+def msflo_stage(context, key):
+    """ performs online ms-flo analysis of the toBeProcessed file """
+
+    import msflo
+
+    with profiling.stage(context["run"], "ms-flo"):
+
+        msflo.msflo(
+            output_path(context, "_toBeProcessed.txt"),
+            context["chrome_driver_directory"],
+            context["downloads_directory"],
+            overwrite=True,
+            pool=context["browser_pool"])
+
+
+def single_point_outputs(context, key):
+
+    return [output_path(context, "_processed.xlsx")]
+
+
+def single_point_stage(context, key):
+    """ creates excel file for manual curation and single point quant file """
+
+    import msflo
+
+    with profiling.stage(context["run"], "single point file") as stage:
+
+        file_path = output_path(context, "_toBeProcessed.txt")
+        after_msflo_file = msflo.create_excel_file(file_path)
+        msflo.create_single_point_file(file_path, after_msflo_file)
+        profiling.set_shape(stage, after_msflo_file)
+
+
+REDUCTION_PARAMETERS = ("known_fold2", "unknown_fold2", "known_sample_max", "unknown_sample_average",
+                        "drift_correction", "imputation", "batch", "blank_subtraction", "run_order", "file_times",
+                        "study")
+
+STAGES = [
+    Stage("reduce", ("source",), REDUCTION_PARAMETERS, reduce_outputs, reduce_stage),
+    Stage("projection", ("reduce",), (), projection_outputs, projection_stage),
+    Stage("report", ("reduce", "projection"), (), report_outputs, report_stage),
+    Stage("export", ("reduce",), (), export_outputs, export_stage),
+    Stage("statistics", ("reduce",), (), statistics_outputs, statistics_stage),
+    Stage("registry", ("reduce",), ("registry",), registry_outputs, registry_stage),
+    Stage("ms-flo", ("export",), (), msflo_outputs, msflo_stage),
+    Stage("single point file", ("ms-flo",), (), single_point_outputs, single_point_stage)]
+
+
+def with_inputs(names):
+    """ names of stages with every stage they read from, directly or through other stages
+
+    Parameters:
+            names (iterable): stage names, ex: ["report"]
+
+    Returns:
+            set: stage names, ex: {"reduce", "projection", "report"}
+
+    """
+
+    inputs = {stage.name: stage.inputs for stage in STAGES}
+    unknown = set(names) - set(inputs)
+    assert not unknown, f"unknown stages {sorted(unknown)}, stages are {list(inputs)}"
+
+    required = set()
+    pending = list(names)
+    while pending:
+
+        name = pending.pop()
+        if name not in required and name != "source":
+
+            required.add(name)
+            pending.extend(inputs[name])
+
+    return required
+
+
+def run(file_location, parameters, chrome_driver_directory, downloads_directory, stages=None, browser_pool=None):
+    """ runs data reduction pipeline for one MS-Dial export, resuming from the first stale stage
+
+    Exports holding samples of several studies (MX numbers) are split, every study gets its own outputs, cache state,
+    and manifest, and the export is read once for all of them.
+
+    Parameters:
+            file_location (str): Full directory path of MS-Dial export
+            parameters (dict): known_fold2, unknown_fold2, known_sample_max, unknown_sample_average, drift_correction,
+            imputation (imputation.STRATEGIES, None or left out for no imputation), batch (see injection_batches, None
+            or left out for one batch), blank_subtraction (bool, False if left out), run_order (bool, heights read and
+            drift corrected in the acquisition order of file_times.csv next to the export, False if left out), and
+            registry (registry .sqlite file features are matched against and stored in, None or left out to skip the
+            registry stage)
+            chrome_driver_directory (str): Full directory path to Chrome driver
+            downloads_directory (str): Full directory path to downloads folder
+            stages (list): names of stages to run with the stages they read from, all stages if None, upstream stages
+            with unchanged cached outputs are not rerun, ex: ["report"] only rebuilds the report
+            browser_pool (dict): ms-flo browser session pool from msflo.open_pool, reused across files if given
+
+    Returns:
+            contexts (list): pipeline context of each study including "name" and the run record
+
+    """
+
+    output_folder = os.path.dirname(os.path.abspath(file_location))
+    cache_folder = os.path.join(output_folder, CACHE_FOLDER)
+    os.makedirs(cache_folder, exist_ok=True)
+
+    stem = os.path.splitext(os.path.basename(file_location))[0]
+    # the registry stage only runs with a registry file
+    requested = None if stages is None else with_inputs(stages)
+    selected = [
+        stage for stage in STAGES
+        if (requested is None or stage.name in requested) and (stage.name != "registry" or parameters.get("registry"))]
+
+    # single study exports keep the file names they always had
+    studies = export_studies(file_location)
+    if len(studies) > 1:
+
+        print(f"{len(studies)} studies in {file_location}: {', '.join(studies)}")
+
+    else:
+
+        studies = [None]
+
+    # contents of file_times.csv are part of the reduce key when acquisition times are read
+    file_times = None
+    if parameters.get("run_order") or parameters.get("batch") == "acquisition_time":
+
+        import batches
+
+        times_path = os.path.join(output_folder, batches.FILE_TIMES_NAME)
+        file_times = file_hash(times_path) if os.path.exists(times_path) else None
+
+    shared = {}
+    contexts = []
+    for study in studies:
+
+        suffix = "" if study is None else "_" + study
+        study_parameters = dict(
+            {"imputation": None, "batch": None, "blank_subtraction": False, "run_order": False, "registry": None},
+            **parameters, study=study, file_times=file_times)
+        context = {
+            "source": file_location,
+            "study": study,
+            "shared": shared,
+            "parameters": study_parameters,
+            "output_folder": output_folder,
+            "cache_folder": cache_folder,
+            "chrome_driver_directory": chrome_driver_directory,
+            "downloads_directory": downloads_directory,
+            "browser_pool": browser_pool,
+            "run": profiling.start_run(
+                file_location, os.path.splitext(file_location)[0] + suffix + "_manifest.json", study_parameters)}
+
+        run_pipeline(selected, context, study_parameters, os.path.join(cache_folder, stem + suffix + "_state.json"))
+        profiling.write_manifest(context["run"])
+        contexts.append(context)
+
+    return contexts
@@ -6,10 +6,9 @@ __author__ = "Bryan Roberts"
 
 import os
 
-import reduce  # local source
-import msflo
-import instruments
-import report
+# only light modules are imported before the questions, stages import pandas, plotly, and selenium when they run
+import instruments  # local source
+import pipeline
 
 if __name__ == "__main__":
 
@@ -17,12 +16,15 @@ if __name__ == "__main__":
     file_location = input("Enter full file directory including file: ")
 
     # validate file location input
-    file_location = reduce.validate_file_location(file_location)
+    file_location = instruments.validate_file_location(file_location)
 
     # default values for user directory locations
     CHROME_DRIVER_DIRECTORY = ""
     DOWNLOADS_DIRECTORY = ""
 
+    # registry .sqlite file reduced features are matched against and stored in, "" skips the registry
+    REGISTRY_FILE = ""
+
     # get locations of Chrome Driver if default is not correct
     if not (os.path.exists(CHROME_DRIVER_DIRECTORY)):
 
@@ -75,125 +77,43 @@ if __name__ == "__main__":
     # use defualt values
     else:
 
-        known_fold2 = 5
-        unknown_fold2 = 5
-
         # Agilent QTOF or Sciex TTOF
         if instruments.choose_instrument():
 
-            known_sample_max = 1000
-            unknown_sample_average = 3000
+            preset = instruments.PRESETS["qtof"]
 
         # Thermo QEHF
         else:
 
-            known_sample_max = 10000
-            unknown_sample_average = 50000
-
-    # make data frame from excel sheet and determine feature type
-    df = reduce.filter_file(file_location)
-    reduce.determine_feature_type(df)
-
-    # find columns with matching names
-    blanks = []
-    biorecs = []
-    pools = []
-    samples = []
-    reduce.filter_samples(df, blanks, biorecs, pools, samples)
-
-    # add reduction columns
-    reduce.add_reduction_columns(df, blanks, samples, pools)
-
-    # update Metabolite name, InChiKey, Species
-    names = df['Metabolite name'].str.split("[", n = 1, expand = True)
-    inchikey = names[1].str.split("_", n = 1, expand = True)
-    species = inchikey[0]
-    inchikey = inchikey[1]
-    name = names[0]
-    
-    #update inchikey
-    inchi = []
-    for mzrt, msdial in zip(inchikey, df['INCHIKEY']):
-    
-        if mzrt != None:
-        
-            inchi.append(mzrt)
-        
-        else:
-        
-            inchi.append(msdial)
-    
-    #update species
-    adduct = []        
-    for mzrt, msdial in zip(species, df['Adduct type']):
-    
-        if mzrt != None:
-        
-            adduct.append("[" + mzrt)
-        
-        else:
-        
-            adduct.append(msdial)
-            
-    for i in range(len(name)):
-    
-        if name[i][-1] == "_":
-            
-            name[i] = name[i][:-1]
-            
-        if name[i][-2] == ";":
-            
-            name[i] = name[i][:-2]
-            
-     
-    # update values in columns
-    df['INCHIKEY'] = inchi
-    df['Metabolite name'] = name
-    df['Adduct type'] = adduct
-    df.sort_values(by=['Metabolite name'], inplace=True)
-
-    # create data frame for each type of annotated feature
-    internal_standards = df[(df['Type'] == 'iSTD')]
-    knowns = df[(df['Type'] == 'known')]
-    unknowns = df[(df['Type'] == 'unknown')]
-
-    # reduce annotated features
-    knowns_before_reduction = len(knowns.index)
-    knowns = knowns[(knowns['Fold 2'] > known_fold2)]
-    knowns = knowns[(knowns['Sample Max'] > known_sample_max)]
-    
-    # reduce unknowns
-    unknowns_before_reduction = len(unknowns.index)
-    unknowns = unknowns[(unknowns['Fold 2'] > unknown_fold2)]
-    unknowns = unknowns[(unknowns['Sample Average'] > unknown_sample_average)]
-    unknowns['Metabolite name'] = ""
-    unknowns['INCHIKEY'] = ""
-    unknowns['Adduct type'] = ""
-
-    # len of knowns and unknowns after reduction
-    knowns_after_reduction = len(knowns.index)
-    unknowns_after_reduction = len(unknowns.index)
-
-    # make report figures
-    report.number_of_features_changed(
-        knowns_before_reduction,
-        knowns_after_reduction,
-        unknowns_before_reduction,
-        unknowns_after_reduction)
-    report.chart_feature_cv(internal_standards)
-    report.chart_feature_cv(knowns)
-    
-    # create text file of all reduced feature for ms-flo analysis
-    file_path = reduce.create_to_be_processed_txt(
-        internal_standards, knowns, unknowns, file_location, samples)
-
-    # perform online ms-flo analysis
-    msflo.msflo(file_path, CHROME_DRIVER_DIRECTORY, DOWNLOADS_DIRECTORY)
-
-    # creat excel file for manual curation
-    after_msflo_file = msflo.create_excel_file(file_path)
-
-    # create single point quant file 
-    msflo.create_single_point_file(file_path, after_msflo_file)
-
-
+            preset = instruments.PRESETS["qehf"]
+
+        known_fold2 = preset["known_fold2"]
+        unknown_fold2 = preset["unknown_fold2"]
+        known_sample_max = preset["known_sample_max"]
+        unknown_sample_average = preset["unknown_sample_average"]
+
+    # ask if user would like pool qc drift correction before reduction
+    correct_drift = instruments.choose_drift_correction()
+
+    # ask if injections are ordered by acquisition time instead of injection number
+    run_order = instruments.choose_run_order()
+
+    # ask how missing heights are filled before reduction
+    imputation = instruments.choose_imputation()
+
+    # ask how injections are batched for blank averages and Fold 2, and whether batch blanks are subtracted
+    batch = instruments.choose_batches()
+    blank_subtraction = instruments.choose_blank_subtraction()
+
+    # run reduction, report, export, statistics, ms-flo, and single point stages, reusing cached outputs of unchanged stages
+    pipeline.run(file_location, {
+        "known_fold2": known_fold2,
+        "unknown_fold2": unknown_fold2,
+        "known_sample_max": known_sample_max,
+        "unknown_sample_average": unknown_sample_average,
+        "drift_correction": correct_drift,
+        "run_order": run_order,
+        "imputation": imputation,
+        "batch": batch,
+        "blank_subtraction": blank_subtraction,
+        "registry": REGISTRY_FILE or None}, CHROME_DRIVER_DIRECTORY, DOWNLOADS_DIRECTORY)
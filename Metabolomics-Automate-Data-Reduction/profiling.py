@@ -0,0 +1,254 @@
+#!/usr/bin/env python
+
+""" profiling.py: Per-stage wall time, cpu time, peak memory, and table size instrumentation with json run manifest """
+
+__author__ = "Bryan Roberts"
+
+import contextlib
+import cProfile
+import datetime
+import io
+import json
+import os
+import platform
+import pstats
+import sys
+import time
+
+# environment variable switching on cProfile for a whole run, ex: set PIPELINE_PROFILE=1
+PROFILE_VARIABLE = "PIPELINE_PROFILE"
+
+# number of functions listed in the text profile summary
+PROFILE_LINES = 40
+
+
+def peak_rss_mb():
+    """ peak resident memory of this process in MB since it started or since reset_peak_rss, None if it cannot be
+    measured
+
+    Parameters:
+            None
+
+    Returns:
+            float: peak resident set size in MB
+
+    """
+
+    try:
+
+        import resource
+
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+        # linux reports kilobytes, macOS reports bytes
+        return round(peak / (1024 * 1024 if sys.platform == "darwin" else 1024), 1)
+
+    except ImportError:
+
+        pass
+
+    # windows has no resource module, psutil reports the peak working set
+    try:
+
+        import psutil
+
+        return round(psutil.Process().memory_info().peak_wset / (1024 * 1024), 1)
+
+    except (ImportError, AttributeError):
+
+        return None
+
+
+def reset_peak_rss():
+    """ starts a new peak resident memory measurement by clearing the peak the kernel keeps, linux only
+
+    Parameters:
+            None
+
+    Returns:
+            bool: True if the peak was reset, False where peak_rss_mb keeps measuring from the start of the process
+
+    """
+
+    try:
+
+        with open("/proc/self/clear_refs", "w") as clear_refs:
+
+            clear_refs.write("5")
+
+    except OSError:
+
+        return False
+
+    return True
+
+
+def start_run(input_file, manifest_path, parameters=None, profile=None):
+    """ creates run record that stages are added to
+
+    Parameters:
+            input_file (str): Full directory path of file being processed
+            manifest_path (str): Full directory path of manifest .json file, also written if a stage fails
+            parameters (dict): reduction parameters used for the run
+            profile (bool): collect cProfile statistics for the run, read from PIPELINE_PROFILE if None
+
+    Returns:
+            run (dict): run record passed to stage and write_manifest
+
+    """
+
+    if profile is None:
+
+        profile = os.environ.get(PROFILE_VARIABLE, "") not in ("", "0")
+
+    run = {
+        "input_file": input_file,
+        "input_size_mb": round(os.path.getsize(input_file) / (1024 * 1024), 2) if os.path.exists(input_file) else None,
+        "parameters": parameters or {},
+        "started": datetime.datetime.now().isoformat(timespec="seconds"),
+        "python": platform.python_version(),
+        "machine": platform.node(),
+        "stages": [],
+        "outputs": [],
+        "status": "running",
+        "_manifest_path": manifest_path,
+        "_start": time.perf_counter(),
+        "_profiler": None}
+
+    # peak memory of the run, not of earlier files processed by the same worker process where the peak can be reset
+    reset_peak_rss()
+    run["_peak_rss_mb"] = peak_rss_mb()
+
+    if profile:
+
+        run["_profiler"] = cProfile.Profile()
+        run["_profiler"].enable()
+
+    return run
+
+
+@contextlib.contextmanager
+def stage(run, name):
+    """ records wall time, cpu time, and peak memory of the code inside the with block
+
+    stage_peak_rss_mb is the peak resident memory during the stage where the peak can be reset (linux), None
+    elsewhere.  peak_rss_rise_mb is how far the stage raised the peak of the run, 0 for stages staying below the peak
+    of an earlier stage.  Stages are not nested, an inner stage would reset the peak of the outer one.
+
+    Parameters:
+            run (dict): run record from start_run
+            name (str): stage name
+
+    Returns:
+            record (dict): stage record, rows and columns are added with set_shape
+
+    """
+
+    record = {"stage": name, "rows": None, "columns": None, "status": "running"}
+    run["stages"].append(record)
+
+    wall_start = time.perf_counter()
+    cpu_start = time.process_time()
+    run_peak = run["_peak_rss_mb"]
+    reset = reset_peak_rss()
+
+    try:
+
+        yield record
+        record["status"] = "complete"
+
+    except BaseException as error:
+
+        record["status"] = f"failed: {type(error).__name__}: {error}"
+        run["status"] = f"failed in {name}"
+        raise
+
+    finally:
+
+        record["wall_s"] = round(time.perf_counter() - wall_start, 4)
+        record["cpu_s"] = round(time.process_time() - cpu_start, 4)
+        peak = peak_rss_mb()
+        record["stage_peak_rss_mb"] = peak if reset else None
+        record["peak_rss_rise_mb"] = None
+        if peak is not None and run_peak is not None:
+
+            record["peak_rss_rise_mb"] = round(max(peak - run_peak, 0.0), 1)
+            run["_peak_rss_mb"] = max(peak, run_peak)
+
+        # failed runs still leave a manifest showing where the time went
+        if record["status"] != "complete":
+
+            write_manifest(run)
+
+
+def cached(run, name):
+    """ records stage skipped because its cached outputs are up to date """
+
+    run["stages"].append({"stage": name, "rows": None, "columns": None, "status": "cached", "wall_s": 0.0,
+                          "cpu_s": 0.0, "stage_peak_rss_mb": None, "peak_rss_rise_mb": None})
+
+
+def set_shape(record, data_frame):
+    """ stores number of rows and columns of a data frame in stage record
+
+    Parameters:
+            record (dict): stage record from stage
+            data_frame (pandas data-frame): table produced by the stage
+
+    Returns:
+            None
+
+    """
+
+    record["rows"], record["columns"] = (int(size) for size in data_frame.shape)
+
+
+def add_output(run, file_path):
+    """ adds file written by the run to the manifest """
+
+    run["outputs"].append(file_path)
+
+
+def write_manifest(run):
+    """ writes run manifest as json, with cProfile statistics next to it when profiling was on
+
+    Parameters:
+            run (dict): run record from start_run
+
+    Returns:
+            None
+
+    """
+
+    file_path = run["_manifest_path"]
+    if run["status"] == "running":
+
+        run["status"] = "complete"
+
+    manifest = {key: value for key, value in run.items() if not key.startswith("_")}
+    manifest["total_wall_s"] = round(time.perf_counter() - run["_start"], 4)
+    peak = peak_rss_mb()
+    manifest["run_peak_rss_mb"] = None if peak is None else max(peak, run["_peak_rss_mb"] or 0.0)
+
+    profiler = run["_profiler"]
+    if profiler is not None:
+
+        profiler.disable()
+
+        # binary profile for snakeviz or pstats, and a text summary of the slowest functions
+        profile_path = os.path.splitext(file_path)[0] + ".prof"
+        profiler.dump_stats(profile_path)
+
+        summary = io.StringIO()
+        pstats.Stats(profiler, stream=summary).sort_stats("cumulative").print_stats(PROFILE_LINES)
+        with open(os.path.splitext(file_path)[0] + "_profile.txt", "w") as summary_file:
+
+            summary_file.write(summary.getvalue())
+
+        manifest["profile"] = profile_path
+
+    with open(file_path, "w") as manifest_file:
+
+        json.dump(manifest, manifest_file, indent=2)
+
+    print(f"file saved: {file_path}")
@@ -0,0 +1,191 @@
+#!/usr/bin/env python
+
+""" projection.py: Principal component scores of injections from log scaled heights by randomized SVD """
+
+__author__ = "Bryan Roberts"
+
+import numpy as np
+import pandas as pd
+
+import sample_names  # local source
+
+# principal components kept for the report
+COMPONENTS = 5
+
+# extra random directions sampled beyond the kept components, makes the leading components accurate
+OVERSAMPLES = 10
+
+# power iterations of the range finder, separate components whose variances are close
+POWER_ITERATIONS = 2
+
+# feature rows log transformed and scaled at a time
+BLOCK_ROWS = 4096
+
+# scaling of log heights, auto divides by the standard deviation and pareto by its square root
+SCALINGS = ("auto", "pareto")
+
+# sample types projected, blanks are left out so they do not take the first component
+PROJECTED_TYPES = ("BioRec", "Pool", "Sample")
+
+
+def scale_heights(heights, scaling="auto", block_rows=BLOCK_ROWS):
+    """ log2 transforms, centers, and scales every feature row of heights in place
+
+    Heights that are missing or not positive are set to the feature mean, zero after centering.  Features with fewer
+    than two heights or no variance become rows of zeros and do not add to any component.
+
+    Parameters:
+            heights (numpy array): float32 heights, one row per feature, modified in place
+            scaling (str): "auto" or "pareto"
+            block_rows (int): rows transformed at a time, bounds memory of the masks
+
+    Returns:
+            total (float): sum of squares of the scaled matrix, the total variance times injections - 1
+
+    """
+
+    assert scaling in SCALINGS, f"scaling must be one of {SCALINGS}"
+
+    total = 0.0
+    for start in range(0, len(heights), block_rows):
+
+        block = heights[start:start + block_rows]
+
+        with np.errstate(invalid="ignore"):
+
+            present = block > 0
+
+        np.log2(block, out=block, where=present)
+        block[~present] = 0
+
+        counts = present.sum(axis=1)
+
+        with np.errstate(divide="ignore", invalid="ignore"):
+
+            mean = block.sum(axis=1, dtype=np.float64) / counts
+            block -= np.nan_to_num(mean).astype(np.float32)[:, None]
+            block[~present] = 0
+
+            deviation = np.sqrt(np.einsum("ij,ij->i", block, block, dtype=np.float64) / (counts - 1))
+            divisor = deviation if scaling == "auto" else np.sqrt(deviation)
+            factor = np.where((counts >= 2) & (deviation > 0), 1 / divisor, 0.0)
+
+        block *= factor.astype(np.float32)[:, None]
+        total += float(np.einsum("ij,ij->", block, block, dtype=np.float64))
+
+    return total
+
+
+def randomized_pca(scaled, components=COMPONENTS, oversamples=OVERSAMPLES, iterations=POWER_ITERATIONS, seed=0):
+    """ leading principal components of the columns of scaled by randomized SVD
+
+    The range of the injections is found by multiplying scaled with a few random directions, sharpened by power
+    iterations, and the small projected matrix is decomposed exactly.  Only products of scaled with thin matrices
+    are computed, so time and memory grow with the size of scaled and not with its square.
+
+    Parameters:
+            scaled (numpy array): float32 centered and scaled heights from scale_heights, one row per feature and one
+            column per injection
+            components (int): components returned
+            oversamples (int): extra random directions
+            iterations (int): power iterations
+            seed (int): seed of the random directions, the same seed gives the same scores
+
+    Returns:
+            scores (numpy array): injections x components scores
+            singular_values (numpy array): singular value of each component, squares are the variance explained times
+            injections - 1
+
+    """
+
+    features, injections = scaled.shape
+    components = min(components, features, injections)
+    width = min(components + oversamples, features, injections)
+
+    # float32 thin matrices keep every product in single precision blas without copying scaled to float64
+    random = np.random.RandomState(seed).standard_normal((features, width)).astype(np.float32)
+    basis, _ = np.linalg.qr(scaled.T.dot(random).astype(np.float64))
+
+    for _ in range(iterations):
+
+        row_basis, _ = np.linalg.qr(scaled.dot(basis.astype(np.float32)).astype(np.float64))
+        basis, _ = np.linalg.qr(scaled.T.dot(row_basis.astype(np.float32)).astype(np.float64))
+
+    # scaled is close to projected.T times basis.T, its decomposition gives the components
+    projected = scaled.dot(basis.astype(np.float32)).astype(np.float64)
+    _, singular_values, right = np.linalg.svd(projected, full_matrices=False)
+
+    scores = basis.dot(right.T[:, :components]) * singular_values[:components]
+
+    # component signs are arbitrary, the largest score of each component is made positive so reruns match
+    signs = np.sign(scores[np.abs(scores).argmax(axis=0), np.arange(components)])
+    signs[signs == 0] = 1
+
+    return scores * signs, singular_values[:components]
+
+
+def qc_projection(data_frame, batches=None, components=COMPONENTS, scaling="auto", types=PROJECTED_TYPES):
+    """ principal component scores of the biorec, pool, and study sample injections of a reduced table
+
+    Parameters:
+            data_frame (pandas data-frame): reduced features with one column per injection
+            batches (pandas series): batch of each injection column, from the Batch ID row of the export
+            components (int): components computed
+            scaling (str): "auto" or "pareto"
+            types (tuple): sample types projected
+
+    Returns:
+            scores (pandas data-frame): PC1, PC2, ... with Sample Type and Batch of each projected injection, indexed
+            by column
+            explained (numpy array): fraction of the total variance explained by each component
+
+    """
+
+    index = sample_names.parse(data_frame.columns)
+    index = index[index["Parsed"].to_numpy() & index["Type"].isin(types).to_numpy()]
+    injections = index.index.tolist()
+
+    if len(injections) < 2 or not len(data_frame):
+
+        return pd.DataFrame(index=pd.Index(injections, name="Sample"), columns=["Sample Type", "Batch"]), np.zeros(0)
+
+    # one float32 copy of the heights is scaled in place, half the memory of the float64 heights
+    heights = data_frame[injections].to_numpy(dtype=np.float32, copy=True)
+    total = scale_heights(heights, scaling)
+
+    scores, singular_values = randomized_pca(heights, components)
+    explained = singular_values ** 2 / total if total > 0 else np.zeros(len(singular_values))
+
+    projection = pd.DataFrame(
+        scores, index=pd.Index(injections, name="Sample"),
+        columns=[f"PC{number}" for number in range(1, scores.shape[1] + 1)])
+    projection["Sample Type"] = index["Type"].to_numpy()
+    projection["Batch"] = (
+        batches.reindex(injections).astype(object).to_numpy() if batches is not None else None)
+
+    return projection, explained
+
+
+def dispersion(scores, sample_types):
+    """ root mean square distance of the injections of each sample type to their centroid, in component space
+
+    Parameters:
+            scores (pandas data-frame): PC columns from qc_projection
+            sample_types (pandas series): sample type of each injection
+
+    Returns:
+            dict: sample type to distance, types with one injection are left out
+
+    """
+
+    values = scores.to_numpy(dtype=np.float64)
+    spread = {}
+    for sample_type in pd.unique(sample_types):
+
+        in_type = (sample_types == sample_type).to_numpy()
+        if in_type.sum() > 1:
+
+            centered = values[in_type] - values[in_type].mean(axis=0)
+            spread[sample_type] = float(np.sqrt(np.mean(np.sum(centered ** 2, axis=1))))
+
+    return spread
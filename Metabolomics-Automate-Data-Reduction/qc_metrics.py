@@ -0,0 +1,329 @@
+#!/usr/bin/env python
+
+""" qc_metrics.py: Vectorized per-feature and per-injection qc metrics for blanks, biorecs, pools, and samples """
+
+__author__ = "Bryan Roberts"
+
+import concurrent.futures
+import multiprocessing
+import os
+import tempfile
+import warnings
+
+import numpy as np
+import pandas as pd
+
+# shared memory blocks need python 3.8, older pythons share a memory-mapped file instead
+try:
+    from multiprocessing import shared_memory
+except ImportError:
+    shared_memory = None
+
+# heights in a matrix before feature metrics are computed by worker processes, smaller matrices are faster serially
+PARALLEL_MIN_CELLS = 20000000
+
+# fewest feature rows given to each worker
+PARALLEL_MIN_ROWS = 2000
+
+# row ranges per worker, smaller ranges even out workers finishing at different times
+PARALLEL_TASKS_PER_WORKER = 4
+
+# columns copied into the shared height matrix at a time
+PARALLEL_COPY_COLUMNS = 100
+
+
+def group_blocks(blanks, biorecs, pools, samples):
+    """ pairs each sample type name with its list of columns
+
+    Parameters:
+            blanks (list): List of all negative control samples from row 1
+            biorecs (list): List of all biorec human plasma qc samples from row 1
+            pools (list): List of all matrix matched pool qc samples from row 1
+            samples (list): List of all study samples from row 1
+
+    Returns:
+            list of (group name, columns) tuples
+
+    """
+
+    return [('Blank', blanks), ('BioRec', biorecs), ('Pool', pools), ('Sample', samples)]
+
+
+def feature_metrics(data_frame, blanks, biorecs, pools, samples, workers=None):
+    """ computes mean, max, stdev, %CV, missing value rate, and blank ratio of every feature for each sample type
+
+    Heights are read into one matrix and each sample type is reduced as a column block, so every statistic is
+    computed for all features at once.  Large matrices are placed in shared memory once and split by feature rows
+    across worker processes, every row is reduced exactly as the serial path reduces it so results are bit-identical.
+
+    Parameters:
+            data_frame (pandas data-frame): Currated data-frame containing peak heights for all samples and features
+            blanks (list): List of all negative control samples from row 1
+            biorecs (list): List of all biorec human plasma qc samples from row 1
+            pools (list): List of all matrix matched pool qc samples from row 1
+            samples (list): List of all study samples from row 1
+            workers (int): worker processes, all cores for matrices over PARALLEL_MIN_CELLS heights if None, 1 is serial
+
+    Returns:
+            metrics (pandas data-frame): one row per feature with '<Type> Mean', '<Type> Max', '<Type> stdev',
+            '<Type> %CV', '<Type> Missing', and '<Type> Blank Ratio' columns for Blank, BioRec, Pool, and Sample
+
+    """
+
+    blocks = group_blocks(blanks, biorecs, pools, samples)
+    columns = [col for name, group in blocks for col in group]
+    sizes = [(name, len(group)) for name, group in blocks]
+
+    if workers is None:
+
+        workers = (os.cpu_count() or 1) if len(data_frame) * len(columns) >= PARALLEL_MIN_CELLS else 1
+
+    # daemon processes cannot start workers of their own
+    if multiprocessing.current_process().daemon:
+
+        workers = 1
+
+    workers = min(workers, max(len(data_frame) // PARALLEL_MIN_ROWS, 1))
+
+    if workers > 1:
+
+        metrics = parallel_block_metrics(data_frame, columns, sizes, workers)
+
+    else:
+
+        metrics = block_metrics(np.asfortranarray(data_frame[columns].to_numpy(dtype=np.float64)), sizes)
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+
+        # ratio of each sample type average to blank average
+        for name, group in blocks[1:]:
+
+            metrics[f'{name} Blank Ratio'] = metrics[f'{name} Mean'] / metrics['Blank Mean']
+
+    return pd.DataFrame(metrics, index=data_frame.index)
+
+
+def block_metrics(heights, sizes):
+    """ statistics of each sample type column block for the rows of heights
+
+    Parameters:
+            heights (numpy array): float64 heights, columns ordered by sample type
+            sizes (list): (group name, number of columns) of each sample type
+
+    Returns:
+            metrics (dict): '<Type> <metric>' to numpy array with one value per row
+
+    """
+
+    metrics = {}
+    start = 0
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+
+        for name, size in sizes:
+
+            block = heights[:, start:start + size]
+            start += size
+
+            # empty sample types produce nan columns so downstream code can rely on every column existing
+            if size == 0:
+
+                for metric in ('Mean', 'Max', 'stdev', '%CV', 'Missing'):
+
+                    metrics[f'{name} {metric}'] = np.full(len(heights), np.nan)
+
+                continue
+
+            mean = block.mean(axis=1)
+            stdev = block.std(axis=1, ddof=1) if size > 1 else np.full(len(block), np.nan)
+
+            metrics[f'{name} Mean'] = mean
+            metrics[f'{name} Max'] = block.max(axis=1)
+            metrics[f'{name} stdev'] = stdev
+            metrics[f'{name} %CV'] = np.round(stdev / mean * 100, 2)
+            metrics[f'{name} Missing'] = ((block == 0) | np.isnan(block)).mean(axis=1)
+
+    return metrics
+
+
+def parallel_block_metrics(data_frame, columns, sizes, workers):
+    """ block_metrics of row ranges computed in worker processes from one shared copy of the height matrix
+
+    Heights are copied once into shared memory, or a memory-mapped temporary file where shared memory is not
+    available, and each worker maps the same buffer instead of receiving its own copy.
+
+    Parameters:
+            data_frame (pandas data-frame): Currated data-frame containing peak heights for all samples and features
+            columns (list): height columns ordered by sample type
+            sizes (list): (group name, number of columns) of each sample type
+            workers (int): number of worker processes
+
+    Returns:
+            metrics (dict): '<Type> <metric>' to numpy array with one value per feature
+
+    """
+
+    shape = (len(data_frame), len(columns))
+    buffer = open_height_buffer(shape)
+
+    try:
+
+        # filled in column chunks so the only full copy of the heights is the shared one
+        heights = buffer_array(buffer, shape)
+        for start in range(0, shape[1], PARALLEL_COPY_COLUMNS):
+
+            heights[:, start:start + PARALLEL_COPY_COLUMNS] = (
+                data_frame[columns[start:start + PARALLEL_COPY_COLUMNS]].to_numpy(dtype=np.float64))
+
+        del heights
+
+        bounds = np.linspace(0, shape[0], workers * PARALLEL_TASKS_PER_WORKER + 1).astype(int)
+        ranges = [(start, stop) for start, stop in zip(bounds[:-1], bounds[1:]) if stop > start]
+
+        with concurrent.futures.ProcessPoolExecutor(max_workers=workers) as executor:
+
+            parts = list(executor.map(
+                row_range_metrics,
+                [buffer_location(buffer)] * len(ranges),
+                [shape] * len(ranges),
+                [sizes] * len(ranges),
+                ranges))
+
+    finally:
+
+        close_height_buffer(buffer, unlink=True)
+
+    return {metric: np.concatenate([part[metric] for part in parts]) for metric in parts[0]}
+
+
+def row_range_metrics(location, shape, sizes, row_range):
+    """ worker side of parallel_block_metrics, maps the shared heights and reduces one row range """
+
+    buffer = attach_height_buffer(location, shape)
+
+    try:
+
+        heights = buffer_array(buffer, shape)
+        start, stop = row_range
+        metrics = block_metrics(heights[start:stop], sizes)
+        del heights
+
+    finally:
+
+        close_height_buffer(buffer)
+
+    return metrics
+
+
+def open_height_buffer(shape):
+    """ creates a float64 buffer for shape, shared memory when available otherwise a temporary file to memory-map
+
+    Returns:
+            SharedMemory block, or str path of the temporary file
+
+    """
+
+    size = max(int(np.prod(shape)) * 8, 1)
+
+    if shared_memory is not None:
+
+        return shared_memory.SharedMemory(create=True, size=size)
+
+    handle, file_path = tempfile.mkstemp(suffix=".heights")
+    os.ftruncate(handle, size)
+    os.close(handle)
+
+    return file_path
+
+
+def attach_height_buffer(location, shape):
+    """ opens a buffer created by open_height_buffer in a worker process """
+
+    if shared_memory is not None:
+
+        return shared_memory.SharedMemory(name=location)
+
+    return location
+
+
+def buffer_location(buffer):
+    """ name of shared memory block or path of memory-mapped file """
+
+    return buffer.name if shared_memory is not None else buffer
+
+
+def buffer_array(buffer, shape):
+    """ float64 array view of a height buffer, the mapping is released when the view is deleted
+
+    Heights are column-major like the matrix pandas returns, so the rows of a worker's range are summed across sample
+    columns in the same order as the serial path and give bit-identical means and stdevs.
+
+    """
+
+    if shared_memory is not None:
+
+        return np.ndarray(shape, dtype=np.float64, buffer=buffer.buf, order="F")
+
+    return np.memmap(buffer, dtype=np.float64, mode="r+", shape=shape, order="F")
+
+
+def close_height_buffer(buffer, unlink=False):
+    """ releases a height buffer, unlink removes it once the creating process is done """
+
+    if shared_memory is not None:
+
+        buffer.close()
+        if unlink:
+
+            buffer.unlink()
+
+    elif unlink:
+
+        os.remove(buffer)
+
+
+def injection_metrics(data_frame, blanks, biorecs, pools, samples, internal_standards):
+    """ computes total ion signal, detected features, and iSTD recovery for every injection
+
+    Parameters:
+            data_frame (pandas data-frame): Currated data-frame containing peak heights for all samples and features
+            blanks (list): List of all negative control samples from row 1
+            biorecs (list): List of all biorec human plasma qc samples from row 1
+            pools (list): List of all matrix matched pool qc samples from row 1
+            samples (list): List of all study samples from row 1
+            internal_standards (pandas series): True for rows of type iSTD
+
+    Returns:
+            metrics (pandas data-frame): one row per injection with 'Sample Type', 'Total Ion Signal',
+            'Detected Features', and 'iSTD Recovery' (median % of each iSTD's reference height) columns
+
+    """
+
+    blocks = group_blocks(blanks, biorecs, pools, samples)
+    columns = [col for name, group in blocks for col in group]
+    sample_type = [name for name, group in blocks for col in group]
+    heights = data_frame[columns].to_numpy(dtype=np.float64)
+
+    # reference height of each iSTD is its median in pools, or in all injections when there are no pools
+    istd_heights = heights[np.asarray(internal_standards, dtype=bool)]
+    reference_columns = slice(len(blanks) + len(biorecs), len(blanks) + len(biorecs) + len(pools))
+    if len(pools) == 0:
+
+        reference_columns = slice(None)
+
+    # iSTDs missing from every reference injection give all-nan slices, reported as nan recovery
+    with warnings.catch_warnings(), np.errstate(divide='ignore', invalid='ignore'):
+
+        warnings.simplefilter('ignore', RuntimeWarning)
+
+        reference = np.nanmedian(istd_heights[:, reference_columns], axis=1)
+        recovery = istd_heights / reference[:, np.newaxis] * 100
+        recovery[~np.isfinite(recovery)] = np.nan
+        istd_recovery = np.round(np.nanmedian(recovery, axis=0), 2)
+
+    return pd.DataFrame({
+        'Sample Type': sample_type,
+        'Total Ion Signal': np.nansum(heights, axis=0),
+        'Detected Features': (heights > 0).sum(axis=0),
+        'iSTD Recovery': istd_recovery},
+        index=pd.Index(columns, name='Sample'))
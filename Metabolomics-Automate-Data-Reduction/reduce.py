@@ -4,61 +4,138 @@
 
 __author__ = "Bryan Roberts"
 
+import bz2
+import concurrent.futures
+import functools
+import gzip
+import lzma
 import os
 
 import numpy as np
 import pandas as pd
-from statistics import stdev
 
-
-def filter_file(file_location):
+import batches  # local source
+import msdial
+import qc_metrics
+import sample_names
+
+# metadata columns kept by filter_file for data curation, every other column of the curated frame except Type is a
+# sample column
+CURATED_COLUMNS = [
+    "Average Rt(min)",
+    "Average Mz",
+    "Metabolite name",
+    "Adduct type",
+    "MS/MS assigned",
+    "INCHIKEY",
+    "MSI level",
+    "Reverse dot product",
+    "Spectrum reference file name",
+    "MS/MS spectrum"]
+
+# statistics columns in the reduced file that are left out of the toBeProcessed file for ms-flo
+STATISTICS_COLUMNS = [
+    "Blank Average",
+    "Sample Average",
+    "Sample Max",
+    "Fold 2",
+    "Sample stdev",
+    "Sample %CV",
+    "Pool stdev",
+    "Pool %CV"]
+
+# rows formatted at a time when writing text files
+EXPORT_CHUNK_ROWS = 2000
+
+# file openers and extensions of compression options for the reduced file, levels favour speed over size
+COMPRESSION_OPENERS = {
+    "gzip": functools.partial(gzip.open, compresslevel=6),
+    "bz2": bz2.open,
+    "xz": functools.partial(lzma.open, preset=1)}
+COMPRESSION_EXTENSIONS = {None: "", "gzip": ".gz", "bz2": ".bz2", "xz": ".xz"}
+
+# object columns with at most this fraction of distinct values are stored as categoricals by compact_frame
+CATEGORY_RATIO = 0.5
+
+
+def filter_file(file_location, compact=False, sample_order=None):
     """ Takes in .txt file and returns data-frame with extraneous rows and columns removed
 
     Parameters:
             file_location (str): Full directory path of file to be analyzed
+            compact (bool): store heights and repeated metadata in smaller dtypes with compact_frame
+            sample_order (list): every sample column of the export in the order they are kept, ex: run order from
+            run_order.ordered_columns, export order if None
 
     Returns:
             data_frame (pandas data-frame): Currated data-frame containing peak heights for all samples and features
 
     """
 
-    # read in .txt file and make data frame
-    data_frame = pd.read_csv(file_location, sep='\t', skiprows=4)
+    # read in MS-Dial export, heights kept as float64 so values are written back exactly
+    export = msdial.read_export(file_location, dtype=np.float64)
+
+    # delete columns not needed for data curration and columns relating to MSMS files, only the height columns are
+    # reordered when a sample order is given
+    if sample_order is None:
+
+        sample_order = export.samples
+
+    data_frame = msdial.export_frame(
+        export,
+        columns=[column for column in export.metadata.columns if column in CURATED_COLUMNS],
+        samples=[sample for sample in sample_order if "MSMS" not in sample],
+        restore_integers=True)
+
+    if compact:
+
+        compact_frame(data_frame, export.samples)
+
+    return data_frame
+
+
+def compact_frame(data_frame, samples):
+    """ stores heights and repeated metadata in smaller dtypes without changing any value written to file
 
-    # find row right before first samples
-    msms_column = 1
-    while (data_frame.columns[msms_column] != "MS/MS spectrum"):
+    Whole number heights become int32 when they fit, the same 4 bytes per height as float32 but exact and written
+    without a decimal point.  Other heights stay float64 so they are written exactly as read.  Metadata columns
+    repeating few values across rows (Adduct type, MSI level, Spectrum reference file name) become categoricals.
+
+    Parameters:
+            data_frame (pandas data-frame): data-frame from filter_file
+            samples (list): sample columns of data_frame, columns not in data_frame are ignored
 
-        msms_column += 1
+    Returns:
+            None
 
-    # columns to keep for data currations
-    columns_to_keep = [
-        "Average Rt(min)",
-        "Average Mz",
-        "Metabolite name",
-        "Adduct type",
-        "MS/MS assigned",
-        "INCHIKEY",
-        "MSI level",
-        "Reverse dot product",
-        "Spectrum reference file name",
-        "MS/MS spectrum"]
+    """
 
-    # delete columns not needed for data curration
-    for column in data_frame.columns[: msms_column + 1]:
+    heights = [sample for sample in samples if sample in data_frame.columns]
+    int32 = np.iinfo(np.int32)
+    downcast = {}
+    for sample in heights:
 
-        if column not in columns_to_keep:
+        column = data_frame[sample]
+        if column.dtype == np.int64 and (len(column) == 0 or int32.min <= column.min() <= column.max() <= int32.max):
 
-            data_frame.drop(column, axis=1, inplace=True)
+            downcast[sample] = np.int32
 
-    # delete columns relating to MSMS files
     for column in data_frame.columns:
 
-        if "MSMS" in column:
+        dtype = data_frame[column].dtype
+        if column not in heights and pd.api.types.is_string_dtype(dtype) and is_repetitive(data_frame[column]):
 
-            data_frame.drop(column, axis=1, inplace=True)
+            downcast[column] = "category"
 
-    return data_frame
+    for column, dtype in downcast.items():
+
+        data_frame[column] = data_frame[column].astype(dtype)
+
+
+def is_repetitive(column, ratio=CATEGORY_RATIO):
+    """ column has few enough distinct values that a categorical is smaller than repeated strings """
+
+    return column.nunique(dropna=False) <= ratio * len(column)
 
 
 def filter_samples(data_frame, blanks, biorecs, pools, samples):
@@ -76,23 +153,15 @@ def filter_samples(data_frame, blanks, biorecs, pools, samples):
 
     """
 
-    for col in data_frame.columns[11:]:
-
-        if "MtdBlank" in col:
-
-            blanks.append(col)
-
-        elif "Biorec" in col:
-
-            biorecs.append(col)
+    # sample type of every sample column from one parse of the column names, the number of metadata columns depends
+    # on the MS-Dial version so they are left out by name
+    index = sample_names.parse(
+        [column for column in data_frame.columns if column not in CURATED_COLUMNS and column != "Type"])
 
-        elif "PoolQC" in col:
-
-            pools.append(col)
-
-        else:
-
-            samples.append(col)
+    blanks.extend(sample_names.columns_of_type(index, "Blank"))
+    biorecs.extend(sample_names.columns_of_type(index, "BioRec"))
+    pools.extend(sample_names.columns_of_type(index, "Pool"))
+    samples.extend(sample_names.columns_of_type(index, "Sample"))
 
 
 def determine_feature_type(data_frame):
@@ -125,91 +194,95 @@ def determine_feature_type(data_frame):
     data_frame.insert(2, 'Type', feature_type)
 
 
-def add_reduction_columns(data_frame, blanks, samples, pools):
-    """ Add blank average, sample averae, sample max, sample stdev, and sample %cv columns to data-frame
+def batch_blanks(data_frame, blanks, samples, injection_batches=None, subtract=()):
+    """ Fold 2 of every feature using the blanks of each sample's own batch, and optional batch blank subtraction
+
+    Blank means of every batch come from one grouped pass over the blank columns, so the cost does not grow with the
+    number of batches.  Batches without blanks use the mean of all blanks.  Fold 2 is computed before subtraction.
 
     Parameters:
-            data_frame (pandas data-frame):Currated data-frame containing peak heights for all samples and features
+            data_frame (pandas data-frame): Currated data-frame containing peak heights for all samples and features
             blanks (list): List of all negative control samples from row 1
             samples (list): List of all study samples from row 1
+            injection_batches (pandas series): batch of each injection column from batches.py, one batch if None
+            subtract (list): columns whose heights are replaced by heights minus their batch blank mean, not below 0
 
     Returns:
-            None
+            fold2 (pandas series): Fold 2 of each feature, indexed like data_frame
+            summary (pandas data-frame): Injections, Blanks, and Median Blank Average of each batch
 
     """
 
-    # lists for calculations to add to data frame
-    blank_values = []
-    blank_average = []
-    sample_values = []
-    sample_max = []
-    sample_avg = []
-    sample_stdev = []
-    sample_cv = []
-    fold2 = []
-    pool_values = []
-    pool_avg = []
-    pool_stdev = []
-    pool_cv = []
+    columns = list(dict.fromkeys(list(blanks) + list(samples) + list(subtract)))
 
-    # add needed information to above lists
-    for i in range(0, len(data_frame.index)):
+    # batch number of every column, batches are numbered in order of first appearance
+    if injection_batches is None:
 
-        for col in data_frame.columns[11:]:
+        labels = pd.Series("1", index=columns)
 
-            if col in blanks:
+    else:
 
-                blank_values.append(data_frame.at[i, col])
+        labels = injection_batches.reindex(columns).fillna("unknown").astype(str)
 
-            elif col in samples:
+    codes, names = pd.factorize(labels)
+    codes = pd.Series(codes, index=columns)
 
-                sample_values.append(data_frame.at[i, col])
+    blank_heights = data_frame[list(blanks)].apply(pd.to_numeric, errors="coerce").to_numpy(dtype=np.float64)
+    sample_heights = data_frame[list(samples)].apply(pd.to_numeric, errors="coerce").to_numpy(dtype=np.float64)
 
-            elif col in pools:
+    means = batches.blank_means(blank_heights, codes[list(blanks)].to_numpy(), len(names))
+    fold2 = batches.batch_fold2(sample_heights, codes[list(samples)].to_numpy(), means)
 
-                pool_values.append(data_frame.at[i, col])
+    if len(subtract):
 
-        # blank average column
-        blank_average.append(sum(blank_values) / len(blank_values))
+        heights = data_frame[list(subtract)].apply(pd.to_numeric, errors="coerce").to_numpy(dtype=np.float64)
+        data_frame[list(subtract)] = pd.DataFrame(
+            batches.subtract_means(heights, codes[list(subtract)].to_numpy(), means),
+            index=data_frame.index, columns=list(subtract))
 
-        # sample max column
-        sample_max.append(max(sample_values))
+    with np.errstate(invalid="ignore"):
 
-        # sample average column
-        sample_avg.append(sum(sample_values) / len(sample_values))
+        median_blank = np.nanmedian(means, axis=0) if len(means) else np.full(len(names), np.nan)
 
-        # sample stdev column
-        sample_stdev.append(stdev(sample_values))
+    summary = pd.DataFrame({
+        "Injections": np.bincount(codes.to_numpy(), minlength=len(names)),
+        "Blanks": np.bincount(codes[list(blanks)].to_numpy(), minlength=len(names)),
+        "Median Blank Average": median_blank},
+        index=pd.Index(list(names), name="Batch"))
 
-        # sample %CV columns
-        sample_cv.append(round((sample_stdev[i] / sample_avg[i]) * 100, 2))
+    return pd.Series(fold2, index=data_frame.index, name="Fold 2"), summary
 
-        # Fold 2 column
-        fold2.append(sample_max[i - 1] / blank_average[i - 1])
 
-        # pool average column
-        pool_avg.append(sum(pool_values) / len(pool_values))
+def add_reduction_columns(data_frame, blanks, samples, pools, metrics=None, workers=None, fold2=None):
+    """ Add blank average, sample averae, sample max, sample stdev, and sample %cv columns to data-frame
 
-        # pool stdev column
-        pool_stdev.append(stdev(pool_values))
+    Parameters:
+            data_frame (pandas data-frame):Currated data-frame containing peak heights for all samples and features
+            blanks (list): List of all negative control samples from row 1
+            samples (list): List of all study samples from row 1
+            pools (list): List of all matrix matched pool qc samples from row 1
+            metrics (pandas data-frame): feature metrics from qc_metrics.feature_metrics, computed if not given
+            workers (int): worker processes computing metrics, see qc_metrics.feature_metrics
+            fold2 (pandas series): per-batch Fold 2 from batch_blanks, Sample Max / Blank Average if None
 
-        # pool %CV column
-        pool_cv.append(round(pool_stdev[i] / pool_avg[i] * 100, 2))
+    Returns:
+            None
+
+    """
 
-        # clear lists for next iteration of loop
-        blank_values.clear()
-        sample_values.clear()
-        pool_values.clear()
+    if metrics is None:
+
+        metrics = qc_metrics.feature_metrics(data_frame, blanks, [], pools, samples, workers)
 
     # add columns to data frame
-    data_frame['Blank Average'] = blank_average
-    data_frame['Sample Average'] = sample_avg
-    data_frame['Sample Max'] = sample_max
-    data_frame['Fold 2'] = fold2
-    data_frame['Sample stdev'] = sample_stdev
-    data_frame['Sample %CV'] = sample_cv
-    data_frame['Pool stdev'] = pool_stdev
-    data_frame['Pool %CV'] = pool_cv
+    data_frame['Blank Average'] = metrics['Blank Mean']
+    data_frame['Sample Average'] = metrics['Sample Mean']
+    data_frame['Sample Max'] = metrics['Sample Max']
+    data_frame['Fold 2'] = metrics['Sample Max'] / metrics['Blank Mean'] if fold2 is None else fold2
+    data_frame['Sample stdev'] = metrics['Sample stdev']
+    data_frame['Sample %CV'] = metrics['Sample %CV']
+    data_frame['Pool stdev'] = metrics['Pool stdev']
+    data_frame['Pool %CV'] = metrics['Pool %CV']
 
 
 def create_to_be_processed_txt(
@@ -217,18 +290,28 @@ def create_to_be_processed_txt(
         knowns,
         unknowns,
         file_location,
-        samples):
+        samples,
+        overwrite=False,
+        threads=False,
+        compression=None):
     """ recombines reduced data-frames and creates .txt file to be put through ms-flo in current directory
 
+    Both the reduced file and the toBeProcessed file are written in one pass over the rows, each cell is formatted
+    once and shared by both files.
+
     Parameters:
             internal_standards (pandas data-frame): Only contains rows of type iSTD
             knowns (pandas data-frame): Only contains rows of type knowns
             unknowns (pandas data-frame): Only contains rows of type unknowns
             file_location (str): file location of original excel file to save feature reduced .txt file
             samples (list): List of all study samples from row 1
+            overwrite (bool): replace reduced and toBeProcessed files left by a previous run
+            threads (bool): write the two files from separate threads while the next rows are formatted
+            compression (str): "gzip", "bz2", or "xz" to compress the reduced file, toBeProcessed stays plain text
+            for ms-flo
 
     Returns:
-            None
+            to_be_processed_path (str): Full directory path of toBeProcessed .txt file
 
     """
 
@@ -238,101 +321,196 @@ def create_to_be_processed_txt(
     # extract sample information name for use in file name
     sample_information_name = extract_sample_information(samples)
 
-    # write current concatenated data frame to file
+    # reduced file for user review, keeps statistics columns
     reduced_path = os.path.join(
         os.path.dirname(file_location),
         sample_information_name +
-        '_reduced.txt')
+        '_reduced.txt' +
+        COMPRESSION_EXTENSIONS[compression])
 
-    # make sure reduced_path file does not already exist
-    assert(not os.path.exists(reduced_path)
-           ), f"{reduced_path} already exists"
+    # toBeProcessed file for ms-flo, statistics columns deleted
+    to_be_processed_path = os.path.join(
+        os.path.dirname(file_location),
+        sample_information_name +
+        '_toBeProcessed.txt')
 
-    # save file as .txt for user review
-    to_be_processed.to_csv(
-        reduced_path,
-        header=True,
-        index=False,
-        sep='\t',
-        mode='a')
+    # make sure files do not already exist
+    remove_existing(reduced_path, overwrite)
+    remove_existing(to_be_processed_path, overwrite)
+
+    write_text_tables(
+        to_be_processed,
+        [(reduced_path, [], compression), (to_be_processed_path, STATISTICS_COLUMNS, None)],
+        threads)
 
     print(f"file saved: {reduced_path}")
+    print(f"file saved: {to_be_processed_path}")
 
-    # delete extraneous columns to put in format for MS-FLO
-    delete_columns = [
-        "Blank Average",
-        "Sample Average",
-        "Sample Max",
-        "Fold 2",
-        "Sample stdev",
-        "Sample %CV",
-        "Pool stdev",
-        "Pool %CV"]
+    return to_be_processed_path
 
-    for column in to_be_processed:
 
-        if column in delete_columns:
+def write_text_tables(data_frame, outputs, threads=False, chunk_rows=EXPORT_CHUNK_ROWS):
+    """ writes tab separated files of data_frame with the same text pandas to_csv writes, formatting each cell once
 
-            to_be_processed.drop(column, axis=1, inplace=True)
+    Parameters:
+            data_frame (pandas data-frame): rows and columns to write
+            outputs (list): (file path, columns left out, compression) of each file
+            threads (bool): write files from separate threads while the next rows are formatted
+            chunk_rows (int): rows formatted at a time, bounds memory of formatted text
 
-    # create to_be_processed path name
-    to_be_processed_path = os.path.join(
-        os.path.dirname(file_location),
-        sample_information_name +
-        '_toBeProcessed.txt')
+    Returns:
+            None
+
+    """
 
-    # make sure to_be_processed file does not already exist
-    assert(not os.path.exists(to_be_processed_path)
-           ), f"{to_be_processed_path} already exists"
+    positions = [
+        [position for position, column in enumerate(data_frame.columns) if column not in left_out]
+        for _, left_out, _ in outputs]
+    header = np.array([format_text(pd.Series(data_frame.columns, dtype=object))], dtype=object)
+    files = [open_text(file_path, compression) for file_path, _, compression in outputs]
 
-    # save file as .txt for ms-flo analysis
-    to_be_processed.to_csv(
-        to_be_processed_path,
-        header=True,
-        index=False,
-        sep='\t',
-        mode='a')
+    def write(text_file, cells):
 
-    print(f"file saved: {to_be_processed_path}")
+        text_file.write("".join("\t".join(row) + os.linesep for row in cells.tolist()))
 
-    return to_be_processed_path
+    try:
 
+        with concurrent.futures.ThreadPoolExecutor(len(files) if threads else 1) as executor:
 
-def extract_sample_information(samples):
-    """ extract client name, minix, and analysis type from first sample file name
+            writing = []
+            for start in [None] + list(range(0, len(data_frame), chunk_rows)):
+
+                # header is written as the first chunk
+                cells = header if start is None else format_cells(data_frame.iloc[start:start + chunk_rows])
+
+                # a file writes its chunks in order, next chunk is formatted while the last one is written
+                concurrent.futures.wait(writing)
+                for future in writing:
+
+                    future.result()
+
+                writing = [
+                    executor.submit(write, text_file, cells[:, columns]) if threads else write(text_file, cells[:, columns])
+                    for text_file, columns in zip(files, positions)]
+                writing = [future for future in writing if future is not None]
+
+            for future in writing:
+
+                future.result()
+
+    finally:
+
+        for text_file in files:
+
+            text_file.close()
+
+
+def open_text(file_path, compression=None):
+    """ opens text file for writing, line endings are written as given """
+
+    if compression is None:
+
+        return open(file_path, "w", newline="", encoding="utf-8")
+
+    return COMPRESSION_OPENERS[compression](file_path, "wt", newline="", encoding="utf-8")
+
+
+def format_cells(data_frame):
+    """ formats every cell of data_frame as pandas to_csv would, numeric columns of one dtype are formatted together
 
     Parameters:
-            samples (list): List of all study samples from row 1
+            data_frame (pandas data-frame): rows to format
 
     Returns:
-            str in form of client_name + "_" + client_minix + "_" + analysis
+            cells (numpy array): 2-D object array of str
 
     """
 
-    first_sample = samples[0].split('_')
-    client_name = first_sample[0][0:len(first_sample[0]) - 3]
-    client_minix = first_sample[1]
-    analysis = first_sample[2]
+    cells = np.empty(data_frame.shape, dtype=object)
+    numeric = {}
+    for position, dtype in enumerate(data_frame.dtypes):
 
-    return client_name + "_" + client_minix + "_" + analysis
+        if isinstance(dtype, np.dtype) and dtype.kind in "biuf":
 
+            numeric.setdefault(dtype, []).append(position)
 
-def validate_file_location(file_location):
-    """ validates file location exists and delete quotation marks if user copied them into string
+        else:
+
+            cells[:, position] = format_text(data_frame.iloc[:, position])
+
+    for dtype, columns in numeric.items():
+
+        values = data_frame.iloc[:, columns].to_numpy(dtype=dtype)
+
+        # python repr of float64 is the same shortest text as numpy str and several times faster, float32 is not
+        if dtype.kind == "f" and dtype.itemsize != 8:
+
+            text = values.astype(str).astype(object)
+
+        else:
+
+            text = np.array(list(map(repr, values.ravel().tolist())), dtype=object).reshape(values.shape)
+
+        # missing heights are written as empty cells
+        if dtype.kind == "f":
+
+            text[np.isnan(values)] = ""
+
+        cells[:, columns] = text
+
+    return cells
+
+
+def format_text(column):
+    """ formats text or categorical column as csv cells, quoting values containing tabs, quotes, or line breaks """
+
+    if isinstance(column.dtype, pd.CategoricalDtype):
+
+        # categories are formatted once and looked up by code
+        categories = np.append(format_text(pd.Series(column.cat.categories, dtype=object)), "")
+
+        return categories[column.cat.codes.to_numpy()]
+
+    values = column.to_numpy(dtype=object)
+    text = np.array(["" if pd.isna(value) else str(value) for value in values], dtype=object)
+
+    special = pd.Series(text, dtype=object).str.contains('[\t"\r\n]', regex=True).to_numpy(dtype=bool)
+    if special.any():
+
+        text[special] = ['"' + value.replace('"', '""') + '"' for value in text[special]]
+
+    return text
+
+
+def remove_existing(file_path, overwrite):
+    """ deletes file left by a previous run when overwriting, otherwise asserts it does not exist
 
     Parameters:
-            file_location (list): Full directory path of file to be analyzed
+            file_path (str): Full directory path of file about to be written
+            overwrite (bool): delete existing file instead of stopping
 
     Returns:
-            file_location (str): Full directory path of file to be analyzed
+            None
 
     """
 
-    # if user pastes file location with quotation marks, delete quotation marks
-    if file_location[0] == "\"":
+    if overwrite and os.path.exists(file_path):
+
+        os.remove(file_path)
 
-        file_location = file_location[1:len(file_location) - 1]
+    assert(not os.path.exists(file_path)
+           ), f"{file_path} already exists"
+
+
+def extract_sample_information(samples):
+    """ extract client name, minix, and analysis type from first sample file name
 
-    assert (os.path.isfile(file_location)), "File location invalid"
+    Parameters:
+            samples (list): List of all study samples from row 1
+
+    Returns:
+            str in form of client_name + "_" + client_minix + "_" + analysis
+
+    """
 
-    return file_location
+    return sample_names.study_name(sample_names.parse(samples[:1]))
@@ -0,0 +1,373 @@
+#!/usr/bin/env python
+
+""" registry.py: SQLite registry of the reduced features of every study, matched across studies by m/z and RT ranges """
+
+__author__ = "Bryan Roberts"
+
+import argparse
+import datetime
+import hashlib
+import os
+import sqlite3
+
+import numpy as np
+import pandas as pd
+
+import msdial  # local source
+import sample_names
+import spectra
+
+# m/z (Da) and retention time (min) tolerances of a match, retention times move more between studies than within one
+MZ_TOLERANCE = 0.005
+RT_TOLERANCE = 0.1
+
+# most intense MS/MS peaks in the spectrum hash and decimals their m/z are rounded to
+HASH_PEAKS = 5
+HASH_MZ_DECIMALS = 2
+
+# rows sent to sqlite per executemany call
+INSERT_CHUNK_SIZE = 50000
+
+# features are stored once per study and mode, the range index serves m/z and retention time windows of one mode
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS studies (
+    study TEXT PRIMARY KEY,
+    mode TEXT,
+    source TEXT,
+    registered TEXT,
+    features INTEGER);
+CREATE TABLE IF NOT EXISTS features (
+    feature_id INTEGER PRIMARY KEY,
+    study TEXT NOT NULL,
+    mode TEXT NOT NULL,
+    mz REAL NOT NULL,
+    rt REAL NOT NULL,
+    type TEXT,
+    name TEXT,
+    adduct TEXT,
+    inchikey TEXT,
+    spectrum_hash TEXT);
+CREATE INDEX IF NOT EXISTS features_range ON features (mode, mz, rt);
+CREATE INDEX IF NOT EXISTS features_study ON features (study);
+"""
+
+# columns of a registry record, in the order of the features table
+RECORD_COLUMNS = ["mz", "rt", "type", "name", "adduct", "inchikey", "spectrum_hash"]
+
+# columns of the match table written next to the reduced file
+MATCH_COLUMNS = [
+    "Metabolite name",
+    "Type",
+    "Average Mz",
+    "Average Rt(min)",
+    "Adduct type",
+    "Registry Study",
+    "Registry Name",
+    "Registry INCHIKEY",
+    "Registry Adduct",
+    "m/z Error",
+    "RT Error",
+    "Same Adduct",
+    "Same Spectrum"]
+
+
+def connect(file_location):
+    """ opens the registry, creating the tables and range index of a new registry
+
+    Parameters:
+            file_location (str): Full directory path of registry .sqlite file
+
+    Returns:
+            sqlite3 connection
+
+    """
+
+    connection = sqlite3.connect(file_location)
+    connection.executescript(SCHEMA)
+
+    return connection
+
+
+def spectrum_hashes(spectrum_strings, peaks=HASH_PEAKS, decimals=HASH_MZ_DECIMALS):
+    """ hash of the rounded m/z of the most intense MS/MS peaks of every spectrum, "" without a spectrum
+
+    The same compound fragments alike in every study, so equal hashes back up an m/z and retention time match.
+
+    Parameters:
+            spectrum_strings (iterable): MS/MS spectrum column
+            peaks (int): most intense peaks hashed
+            decimals (int): decimals of the hashed m/z
+
+    Returns:
+            numpy array: object array of str hashes
+
+    """
+
+    parsed = spectra.parse_spectra(spectrum_strings)
+    counts = spectra.peak_counts(parsed)
+    if not len(counts):
+
+        return np.zeros(0, dtype=object)
+
+    owner = np.repeat(np.arange(len(counts)), counts)
+
+    # peaks sorted by spectrum then intensity, the first peaks of each spectrum are kept
+    order = np.lexsort((-parsed.intensity, owner))
+    rank = np.arange(len(order)) - parsed.offsets[:-1][owner[order]]
+    kept = order[rank < peaks]
+
+    # kept peaks sorted by spectrum then m/z so the hash does not depend on intensity order
+    mz = np.round(parsed.mz[kept].astype(np.float64), decimals)
+    order = np.lexsort((mz, owner[kept]))
+    mz = mz[order]
+    bounds = np.cumsum(np.minimum(counts, peaks))[:-1]
+
+    return np.array([
+        hashlib.sha1(" ".join(f"{value:.{decimals}f}" for value in group).encode()).hexdigest()[:16]
+        if len(group) else ""
+        for group in np.split(mz, bounds)], dtype=object)
+
+
+def text_column(data_frame, column):
+    """ column as stripped str values, "" where missing or when data_frame has no such column """
+
+    if column not in data_frame.columns:
+
+        return np.full(len(data_frame), "", dtype=object)
+
+    return data_frame[column].astype(object).fillna("").astype(str).str.strip().to_numpy(dtype=object)
+
+
+def feature_records(features, adducts=None):
+    """ registry records of reduced features
+
+    Parameters:
+            features (pandas data-frame): reduced features with Average Mz, Average Rt(min), Type, Metabolite name,
+            Adduct type, INCHIKEY, and MS/MS spectrum columns, columns other than m/z and retention time may be missing
+            adducts (pandas series): adduct of features whose Adduct type was cleared (unknowns), indexed like features
+
+    Returns:
+            pandas data-frame: RECORD_COLUMNS, indexed like features
+
+    """
+
+    mz = next(column for column in msdial.MZ_COLUMNS + (None,) if column is None or column in features.columns)
+    rt = next(column for column in msdial.RT_COLUMNS + (None,) if column is None or column in features.columns)
+    assert mz is not None and rt is not None, "features have no m/z or retention time column"
+
+    records = pd.DataFrame({
+        "mz": pd.to_numeric(features[mz], errors="coerce").to_numpy(dtype=np.float64),
+        "rt": pd.to_numeric(features[rt], errors="coerce").to_numpy(dtype=np.float64),
+        "type": text_column(features, "Type"),
+        "name": text_column(features, "Metabolite name"),
+        "adduct": text_column(features, "Adduct type"),
+        "inchikey": text_column(features, "INCHIKEY"),
+        "spectrum_hash": (
+            spectrum_hashes(features["MS/MS spectrum"].to_numpy()) if "MS/MS spectrum" in features.columns
+            else np.full(len(features), "", dtype=object))},
+        index=features.index)
+
+    if adducts is not None and len(adducts):
+
+        restored = adducts.reindex(records.index).astype(object).fillna("").astype(str)
+        records["adduct"] = np.where(restored != "", restored, records["adduct"])
+
+    return records[np.isfinite(records["mz"]) & np.isfinite(records["rt"])]
+
+
+def register(connection, study, mode, records, source=""):
+    """ stores the records of a study, replacing the records of an earlier registration of the same study
+
+    Parameters:
+            connection (sqlite3 connection): registry from connect
+            study (str): study name, ex: Client_MX123456_posCSH
+            mode (str): mode of the study, ex: posCSH
+            records (pandas data-frame): records from feature_records
+            source (str): file the study was reduced from
+
+    Returns:
+            int: records stored
+
+    """
+
+    rows = list(zip(
+        [study] * len(records), [mode] * len(records),
+        *(records[column].tolist() for column in RECORD_COLUMNS)))
+
+    with connection:
+
+        connection.execute("DELETE FROM features WHERE study = ?", (study,))
+        for start in range(0, len(rows), INSERT_CHUNK_SIZE):
+
+            connection.executemany(
+                "INSERT INTO features (study, mode, mz, rt, type, name, adduct, inchikey, spectrum_hash) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)", rows[start:start + INSERT_CHUNK_SIZE])
+
+        connection.execute(
+            "INSERT OR REPLACE INTO studies VALUES (?, ?, ?, ?, ?)",
+            (study, mode, source, datetime.datetime.now().isoformat(timespec="seconds"), len(rows)))
+
+    return len(rows)
+
+
+def match(connection, records, mode, study=None, mz_tolerance=MZ_TOLERANCE, rt_tolerance=RT_TOLERANCE):
+    """ stored features of other studies within m/z and retention time tolerance of each record
+
+    The windows of all records are loaded into a temporary table and joined to the features table in one query, every
+    window is a range scan of the (mode, mz, rt) index, so matching does not grow with records x stored features.
+
+    Parameters:
+            connection (sqlite3 connection): registry from connect
+            records (pandas data-frame): records from feature_records
+            mode (str): mode of the records, only features of the same mode match
+            study (str): study of the records, its own stored features do not match
+            mz_tolerance (float): largest m/z difference of a match
+            rt_tolerance (float): largest retention time difference of a match
+
+    Returns:
+            pandas data-frame: one row per match with "record" (position in records), the stored feature columns, and
+            mz_error, rt_error, same_adduct, and same_spectrum, closest matches of each record first
+
+    """
+
+    mz = records["mz"].to_numpy()
+    rt = records["rt"].to_numpy()
+
+    connection.execute("DROP TABLE IF EXISTS temp.windows")
+    connection.execute(
+        "CREATE TEMP TABLE windows (record INTEGER, mz_low REAL, mz_high REAL, rt_low REAL, rt_high REAL)")
+    connection.executemany(
+        "INSERT INTO temp.windows VALUES (?, ?, ?, ?, ?)",
+        zip(range(len(records)), (mz - mz_tolerance).tolist(), (mz + mz_tolerance).tolist(),
+            (rt - rt_tolerance).tolist(), (rt + rt_tolerance).tolist()))
+
+    matches = pd.read_sql_query(
+        "SELECT w.record, f.feature_id, f.study, f.mz, f.rt, f.type, f.name, f.adduct, f.inchikey, f.spectrum_hash "
+        "FROM temp.windows AS w CROSS JOIN features AS f INDEXED BY features_range "
+        "ON f.mode = ? AND f.mz BETWEEN w.mz_low AND w.mz_high AND f.rt BETWEEN w.rt_low AND w.rt_high "
+        "WHERE f.study IS NOT ?",
+        connection, params=(mode, study))
+    connection.execute("DROP TABLE temp.windows")
+
+    # a query without matches has no rows to infer the record dtype from
+    matches["record"] = matches["record"].astype(np.int64)
+    record = matches["record"].to_numpy()
+    adduct = records["adduct"].to_numpy()[record]
+    spectrum_hash = records["spectrum_hash"].to_numpy()[record]
+
+    matches["mz_error"] = np.round(matches["mz"].to_numpy() - mz[record], 5)
+    matches["rt_error"] = np.round(matches["rt"].to_numpy() - rt[record], 3)
+    matches["same_adduct"] = (adduct != "") & (adduct == matches["adduct"].to_numpy())
+    matches["same_spectrum"] = (spectrum_hash != "") & (spectrum_hash == matches["spectrum_hash"].to_numpy())
+
+    # closest first, distances relative to the tolerances so m/z and retention time count alike
+    distance = np.abs(matches["mz_error"]) / mz_tolerance + np.abs(matches["rt_error"]) / rt_tolerance
+    order = np.lexsort((distance.to_numpy(), ~matches["same_spectrum"].to_numpy(), record))
+
+    return matches.iloc[order].reset_index(drop=True)
+
+
+def match_table(features, records, matches):
+    """ match table of reduced features, MATCH_COLUMNS with one row per match
+
+    Parameters:
+            features (pandas data-frame): reduced features the records were made from
+            records (pandas data-frame): records from feature_records
+            matches (pandas data-frame): matches from match
+
+    Returns:
+            pandas data-frame
+
+    """
+
+    rows = features.loc[records.index[matches["record"].to_numpy()]]
+
+    return pd.DataFrame({
+        "Metabolite name": text_column(rows, "Metabolite name"),
+        "Type": records["type"].to_numpy()[matches["record"].to_numpy()],
+        "Average Mz": records["mz"].to_numpy()[matches["record"].to_numpy()],
+        "Average Rt(min)": records["rt"].to_numpy()[matches["record"].to_numpy()],
+        "Adduct type": records["adduct"].to_numpy()[matches["record"].to_numpy()],
+        "Registry Study": matches["study"].to_numpy(),
+        "Registry Name": matches["name"].to_numpy(),
+        "Registry INCHIKEY": matches["inchikey"].to_numpy(),
+        "Registry Adduct": matches["adduct"].to_numpy(),
+        "m/z Error": matches["mz_error"].to_numpy(),
+        "RT Error": matches["rt_error"].to_numpy(),
+        "Same Adduct": matches["same_adduct"].to_numpy(),
+        "Same Spectrum": matches["same_spectrum"].to_numpy()}, columns=MATCH_COLUMNS)
+
+
+def match_and_register(file_location, study, mode, features, adducts=None, source="", store=True):
+    """ matches reduced features of a study against the registry, then stores them
+
+    Parameters:
+            file_location (str): Full directory path of registry .sqlite file
+            study (str): study name, ex: Client_MX123456_posCSH
+            mode (str): mode of the study, ex: posCSH
+            features (pandas data-frame): reduced features
+            adducts (pandas series): adduct of features whose Adduct type was cleared, see feature_records
+            source (str): file the study was reduced from
+            store (bool): register the features after matching
+
+    Returns:
+            table (pandas data-frame): match table from match_table
+            summary (dict): features, features matched, and studies matched
+
+    """
+
+    records = feature_records(features, adducts)
+    connection = connect(file_location)
+
+    try:
+
+        matches = match(connection, records, mode, study)
+        if store:
+
+            register(connection, study, mode, records, source)
+
+    finally:
+
+        connection.close()
+
+    summary = {
+        "features": int(len(records)),
+        "matched": int(matches["record"].nunique()),
+        "studies": int(matches["study"].nunique())}
+
+    return match_table(features, records, matches), summary
+
+
+def main():
+
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("registry", help="registry .sqlite file, created if it does not exist")
+    parser.add_argument("files", nargs="+", help="_reduced.txt files to match")
+    parser.add_argument("--register", action="store_true", help="store the features of each file after matching")
+    args = parser.parse_args()
+
+    for file_location in args.files:
+
+        assert os.path.exists(file_location), f"{file_location} does not exist"
+
+    for file_location in args.files:
+
+        features = msdial.read_table(file_location)
+        study = os.path.basename(file_location).replace("_reduced.txt", "")
+        index = sample_names.parse(features.columns)
+        modes = index.loc[index["Parsed"].to_numpy(), "Mode"]
+        assert len(modes), f"no sample columns found in {file_location}"
+
+        table, summary = match_and_register(
+            args.registry, study, modes.iloc[0], features, source=file_location, store=args.register)
+
+        table_path = os.path.splitext(file_location)[0] + "_registry.txt"
+        table.to_csv(table_path, sep="\t", index=False)
+        print(f"{study}: {summary['matched']} of {summary['features']} features match features of "
+              f"{summary['studies']} studies")
+        print(f"file saved: {table_path}")
+
+
+if __name__ == "__main__":
+
+    main()
@@ -1,37 +1,187 @@
 #!/usr/bin/env python
 
-""" report.py: Functions to generate graphs displaying qc information about data """
+""" report.py: Functions to generate a static html report displaying qc information about data """
 
 __author__ = "Bryan Roberts"
 
-import plotly.graph_objects as go
+import html
+import json
 
+import numpy as np
 
-def chart_feature_cv(df):
+# plotly takes longer to import than the rest of the pipeline, it is imported by the functions that build figures
+
+# %CV at or above this value is flagged red in tables
+CV_LIMIT = 20
+
+# number of highest pool %CV features shown in the top offenders chart
+TOP_OFFENDERS = 25
+
+# rows shown per page in feature tables
+ROWS_PER_PAGE = 100
+
+PAGE_STYLE = """
+body {font-family: Arial, sans-serif; margin: 20px;}
+table {border-collapse: collapse; margin-bottom: 10px;}
+th {background-color: paleturquoise; border: 1px solid black; padding: 4px 8px; text-align: left;}
+td {border: 1px solid black; padding: 2px 8px;}
+td.red {background-color: red;}
+td.green {background-color: green;}
+"""
+
+# renders one page of a feature table from rows embedded as json, so large tables never become dom nodes at once
+PAGE_SCRIPT = """
+var tableData = {};
+function renderPage(id, page) {
+    var table = document.getElementById(id);
+    if (!(id in tableData)) { tableData[id] = JSON.parse(document.getElementById(id + '-data').textContent); }
+    var data = tableData[id];
+    var filter = document.getElementById(id + '-filter').value.toLowerCase();
+    var rows = data.rows.filter(function (row) { return String(row[0]).toLowerCase().indexOf(filter) !== -1; });
+    var pages = Math.max(1, Math.ceil(rows.length / data.perPage));
+    page = Math.min(Math.max(page, 0), pages - 1);
+    table.dataset.page = page;
+    var body = '';
+    rows.slice(page * data.perPage, (page + 1) * data.perPage).forEach(function (row) {
+        body += '<tr>';
+        row.forEach(function (value, i) {
+            var cls = (i > 0 && value !== null && data.limit !== null) ? (value >= data.limit ? ' class="red"' : ' class="green"') : '';
+            var text = String(value === null ? '' : value).replace(/&/g, '&amp;').replace(/</g, '&lt;');
+            body += '<td' + cls + '>' + text + '</td>';
+        });
+        body += '</tr>';
+    });
+    table.tBodies[0].innerHTML = body;
+    document.getElementById(id + '-page').textContent = 'page ' + (page + 1) + ' of ' + pages + ' (' + rows.length + ' features)';
+}
+function turnPage(id, step) {
+    renderPage(id, parseInt(document.getElementById(id).dataset.page) + step);
+}
+"""
+
+
+def figure_html(fig):
+    """ converts plotly figure into html div using the plotly.js embedded once in the report
+    Parameters:
+            fig (plotly figure): figure to convert
+
+    Returns:
+            str: html div for figure
+
+    """
+
+    import plotly.io as pio
+
+    return pio.to_html(fig, full_html=False, include_plotlyjs=False)
+
+
+def html_table(header, rows):
+    """ creates small static html table
+    Parameters:
+            header (list): column names
+            rows (list): list of row values
+
+    Returns:
+            str: html table
+
+    """
+
+    head = "".join(f"<th>{html.escape(str(value))}</th>" for value in header)
+    body = "".join(
+        "<tr>" + "".join(f"<td>{html.escape(str(value))}</td>" for value in row) + "</tr>" for row in rows)
+
+    return f"<table><thead><tr>{head}</tr></thead><tbody>{body}</tbody></table>"
+
+
+def paged_table(table_id, df, columns, limit=CV_LIMIT):
+    """ creates paginated html table with %CV cells coloured red or green
+    Parameters:
+            table_id (str): unique html id for table
+            df (data-frame): data frame from process.py
+            columns (list): columns to display, first column is the feature name and the rest %CV values
+            limit (float): values at or above limit are coloured red, no cells are coloured if None
+
+    Returns:
+            str: html for table, filter box, and page controls
+
+    """
+
+    # rows are serialized in one pass, nan values become null
+    rows = json.loads(df[columns].to_json(orient='values'))
+    data = json.dumps({'rows': rows, 'perPage': ROWS_PER_PAGE, 'limit': limit}).replace("</", "<\\/")
+    head = "".join(f"<th>{html.escape(column)}</th>" for column in columns)
+
+    return (
+        f'<input id="{table_id}-filter" placeholder="filter by name" oninput="renderPage(\'{table_id}\', 0)"> '
+        f'<button onclick="turnPage(\'{table_id}\', -1)">previous</button> '
+        f'<button onclick="turnPage(\'{table_id}\', 1)">next</button> '
+        f'<span id="{table_id}-page"></span>'
+        f'<table id="{table_id}" data-page="0"><thead><tr>{head}</tr></thead><tbody></tbody></table>'
+        f'<script type="application/json" id="{table_id}-data">{data}</script>'
+        f'<script>renderPage(\'{table_id}\', 0);</script>')
+
+
+def chart_feature_cv(df, title):
     """ charts cv of features in samples and pools
     Parameters:
             df (data-frame): data frame from process.py
+            title (str): name of feature group for section heading
 
     Returns:
-            None
+            str: html section with %CV distribution, %CV vs intensity, top offenders, and feature table
 
     """
 
-    fig = go.Figure(
-        data=[
-            go.Table(
-                header=dict(
-                    values=(
-                        'Metabolite name', 'Sample %CV', 'Pool %CV'), fill_color='paleturquoise', line_color='black', font=dict(
-                        color='black', size=14), align='left'), cells=dict(
-                            values=[
-                                df['Metabolite name'], df['Sample %CV'], df['Pool %CV']], align='left', font=dict(
-                                    color='black', size=12), line_color='black', fill_color=(
-                                        'white', [
-                                            'red' if val >= 20 else 'green' for val in df['Sample %CV']], [
-                                                'red' if val >= 20 else 'green' for val in df['Pool %CV']])))])
+    import plotly.graph_objects as go
+
+    sample_cv = df['Sample %CV'].to_numpy(dtype=np.float64)
+    pool_cv = df['Pool %CV'].to_numpy(dtype=np.float64)
 
-    fig.show()
+    # %CV distributions are binned here so the figure size does not grow with number of features
+    fig_distribution = go.Figure()
+    bins = np.arange(0, 205, 5)
+    for name, cv in (('Sample %CV', sample_cv), ('Pool %CV', pool_cv)):
+
+        counts, edges = np.histogram(np.clip(cv[np.isfinite(cv)], 0, 200), bins=bins)
+        fig_distribution.add_trace(go.Bar(x=edges[:-1] + 2.5, y=counts, width=5, name=name, opacity=0.6))
+
+    fig_distribution.update_layout(
+        title=f"{title} %CV distribution", barmode='overlay', xaxis_title='%CV (200 = 200 or greater)',
+        yaxis_title='features')
+
+    # webgl scatter handles tens of thousands of points
+    fig_intensity = go.Figure(
+        data=[go.Scattergl(
+            x=np.log10(np.clip(df['Sample Average'].to_numpy(dtype=np.float64), 1, None)),
+            y=pool_cv,
+            mode='markers',
+            marker=dict(
+                size=4, color=(pool_cv >= CV_LIMIT).astype(np.int8), cmin=0, cmax=1,
+                colorscale=[[0, 'green'], [1, 'red']]),
+            text=df['Metabolite name'].astype(str).to_numpy())])
+    fig_intensity.update_layout(
+        title=f"{title} pool %CV vs intensity", xaxis_title='log10 sample average height', yaxis_title='Pool %CV')
+
+    # highest pool %CV features
+    offenders = df.assign(_cv=pool_cv).dropna(subset=['_cv']).nlargest(TOP_OFFENDERS, '_cv')
+    fig_offenders = go.Figure(
+        data=[go.Bar(
+            x=offenders['_cv'].to_numpy(),
+            y=offenders['Metabolite name'].astype(str).to_numpy(),
+            orientation='h',
+            marker_color='red')])
+    fig_offenders.update_layout(
+        title=f"{title} top {TOP_OFFENDERS} pool %CV", xaxis_title='Pool %CV', yaxis=dict(autorange='reversed'),
+        height=max(400, 20 * len(offenders)))
+
+    table_id = "table-" + "".join(c for c in title.lower() if c.isalnum())
+
+    return (
+        f"<h2>{html.escape(title)}</h2>"
+        + figure_html(fig_distribution)
+        + figure_html(fig_intensity)
+        + figure_html(fig_offenders)
+        + paged_table(table_id, df, ['Metabolite name', 'Sample %CV', 'Pool %CV']))
 
 
 def number_of_features_changed(
@@ -47,7 +197,7 @@ def number_of_features_changed(
             unknown_before (int): number of unknown features after reduction
 
     Returns:
-            None
+            str: html section with table of feature counts
 
     """
 
@@ -55,30 +205,283 @@ def number_of_features_changed(
     before_reduction = [known_before, unknown_before, known_before + unknown_before]
     after_reduction = [known_after, unknown_after, known_after + unknown_after]
 
-    fig = go.Figure(
-        data=[
-            go.Table(
-                header=dict(
-                    values=(
-                        'Feature Type',
-                        'Features Before Reduction',
-                        'Features After Reduction'),
-                    fill_color='paleturquoise',
-                    line_color='black',
-                    font=dict(
-                        color='black',
-                        size=14),
-                    align='left'),
-                cells=dict(
-                    values=[
-                        feature_type,
-                        before_reduction,
-                        after_reduction],
-                    align='left',
-                    font=dict(
-                        color='black',
-                        size=12),
-                    line_color='black',
-                    fill_color='white'))])
-
-    fig.show()
+    return "<h2>Data Reduction</h2>" + html_table(
+        ['Feature Type', 'Features Before Reduction', 'Features After Reduction'],
+        zip(feature_type, before_reduction, after_reduction))
+
+
+def chart_duplicates(duplicates, match_ratio):
+    """ charts feature pairs within ms-flo duplicate tolerances and the similarity of their MS/MS spectra
+    Parameters:
+            duplicates (data-frame): feature pairs from spectra.duplicate_candidates
+            match_ratio (float): cosine similarity above which ms-flo is likely to merge a pair
+
+    Returns:
+            str: html section with duplicate summary and table of pairs
+
+    """
+
+    similar = int((duplicates['Cosine Similarity'] >= match_ratio).sum())
+
+    return (
+        "<h2>Duplicate Features</h2>"
+        + html_table(
+            ['Feature Pairs', f'Cosine Similarity >= {match_ratio}'], [[len(duplicates), similar]])
+        + paged_table(
+            'duplicates',
+            duplicates.sort_values('Cosine Similarity', ascending=False),
+            ['Feature 1', 'Feature 2', 'm/z Difference', 'RT Difference', 'Cosine Similarity'],
+            limit=None))
+
+
+def chart_drift_correction(cv):
+    """ charts pool %CV summary of all features before and after drift correction
+    Parameters:
+            cv (data-frame): 'Pool %CV Before Correction' and 'Pool %CV After Correction' from drift.py
+
+    Returns:
+            str: html section with table of pool %CV summary
+
+    """
+
+    before = cv['Pool %CV Before Correction']
+    after = cv['Pool %CV After Correction']
+
+    return "<h2>Drift Correction</h2>" + html_table(
+        ['Pool %CV', 'Before Correction', 'After Correction'],
+        [['Median %CV', round(before.median(), 2), round(after.median(), 2)],
+         [f'Features < {CV_LIMIT} %CV', int((before < CV_LIMIT).sum()), int((after < CV_LIMIT).sum())],
+         [f'Features >= {CV_LIMIT} %CV', int((before >= CV_LIMIT).sum()), int((after >= CV_LIMIT).sum())]])
+
+
+def chart_qc_metrics(metrics, injections):
+    """ charts %CV and missing value summary of each sample type and signal of each injection
+    Parameters:
+            metrics (data-frame): feature metrics from qc_metrics.feature_metrics
+            injections (data-frame): injection metrics from qc_metrics.injection_metrics
+
+    Returns:
+            str: html section with sample type summary table, total ion signal, and iSTD recovery charts
+
+    """
+
+    import plotly.graph_objects as go
+
+    rows = []
+    for sample_type in ('Blank', 'BioRec', 'Pool', 'Sample'):
+
+        count = int((injections['Sample Type'] == sample_type).sum())
+        if count:
+
+            rows.append([
+                sample_type,
+                count,
+                round(metrics[f'{sample_type} %CV'].median(), 2),
+                round(metrics[f'{sample_type} Missing'].mean() * 100, 2)])
+
+    fig_signal = go.Figure()
+    fig_recovery = go.Figure()
+    order = np.arange(1, len(injections) + 1)
+    for sample_type in ('Blank', 'BioRec', 'Pool', 'Sample'):
+
+        in_type = (injections['Sample Type'] == sample_type).to_numpy()
+        if in_type.any():
+
+            names = injections.index.to_numpy()[in_type]
+            fig_signal.add_trace(go.Scattergl(
+                x=order[in_type], y=injections['Total Ion Signal'].to_numpy()[in_type], mode='markers',
+                name=sample_type, text=names))
+            fig_recovery.add_trace(go.Scattergl(
+                x=order[in_type], y=injections['iSTD Recovery'].to_numpy()[in_type], mode='markers',
+                name=sample_type, text=names))
+
+    fig_signal.update_layout(title="Total ion signal", xaxis_title='injection', yaxis_title='sum of heights')
+    fig_recovery.update_layout(title="iSTD recovery", xaxis_title='injection', yaxis_title='median % of pool height')
+
+    return (
+        "<h2>QC Metrics</h2>"
+        + html_table(['Sample Type', 'Injections', 'Median %CV', 'Missing Values %'], rows)
+        + figure_html(fig_signal)
+        + figure_html(fig_recovery))
+
+
+def chart_imputation(imputed, features):
+    """ charts number of imputed heights of every injection and reduced feature
+    Parameters:
+            imputed (dict): strategy and imputed height counts per feature and sample from imputation.impute
+            features (data-frame): reduced features
+
+    Returns:
+            str: html section with imputation summary table, imputed heights per injection, and feature table
+
+    """
+
+    import plotly.graph_objects as go
+
+    per_feature = imputed['features']
+    per_sample = imputed['samples']
+    heights = len(per_feature) * len(per_sample)
+    total = int(per_sample.sum())
+
+    fig_samples = go.Figure(data=[go.Bar(
+        x=np.arange(1, len(per_sample) + 1), y=per_sample.to_numpy(), text=per_sample.index.to_numpy())])
+    fig_samples.update_layout(title="Imputed heights per injection", xaxis_title='injection', yaxis_title='heights')
+
+    reduced = features[['Metabolite name']].assign(Imputed=per_feature.reindex(features.index).to_numpy())
+
+    return (
+        "<h2>Imputation</h2>"
+        + html_table(
+            ['Strategy', 'Heights Imputed', 'Heights Imputed %', 'Features With Imputed Heights'],
+            [[imputed['strategy'], total, round(total / heights * 100, 2) if heights else 0,
+              int((per_feature > 0).sum())]])
+        + figure_html(fig_samples)
+        + paged_table('table-imputed', reduced.sort_values('Imputed', ascending=False), ['Metabolite name', 'Imputed'],
+                      limit=None))
+
+
+def chart_batches(summary):
+    """ charts injections, blanks, and median blank average of every batch Fold 2 is computed in
+    Parameters:
+            summary (data-frame): Injections, Blanks, and Median Blank Average of each batch from reduce.batch_blanks
+
+    Returns:
+            str: html section with batch table and median blank average per batch
+
+    """
+
+    import plotly.graph_objects as go
+
+    fig_blanks = go.Figure(data=[go.Bar(
+        x=summary.index.astype(str).to_numpy(), y=summary['Median Blank Average'].to_numpy(),
+        text=summary['Blanks'].to_numpy())])
+    fig_blanks.update_layout(title="Median blank average per batch", xaxis_title='batch', yaxis_title='height')
+
+    return (
+        "<h2>Batches</h2>"
+        + html_table(
+            ['Batch', 'Injections', 'Blanks', 'Median Blank Average'],
+            [[batch, int(row['Injections']), int(row['Blanks']), round(float(row['Median Blank Average']), 2)]
+             for batch, row in summary.iterrows()])
+        + figure_html(fig_blanks))
+
+
+def chart_run_order(acquisition):
+    """ charts acquisition time of every injection in run order and lists injections without a raw data file
+    Parameters:
+            acquisition (data-frame): Acquired and Run Order of each injection from run_order.join_file_times
+
+    Returns:
+            str: html section with run order summary, acquisition times, and unmatched injections
+
+    """
+
+    import plotly.graph_objects as go
+
+    timed = acquisition[acquisition['Run Order'] > 0].sort_values('Run Order')
+    unmatched = acquisition.index[acquisition['Run Order'] == 0].tolist()
+
+    fig_times = go.Figure(data=[go.Scatter(
+        x=timed['Run Order'].to_numpy(), y=timed['Acquired'].to_numpy(), text=timed.index.to_numpy(),
+        mode='markers')])
+    fig_times.update_layout(title="Acquisition time in run order", xaxis_title='run order', yaxis_title='acquired')
+
+    first = str(timed['Acquired'].iloc[0]) if len(timed) else ''
+    last = str(timed['Acquired'].iloc[-1]) if len(timed) else ''
+
+    return (
+        "<h2>Run Order</h2>"
+        + html_table(
+            ['Injections', 'With Acquisition Time', 'Without Acquisition Time', 'First Acquired', 'Last Acquired'],
+            [[len(acquisition), len(timed), len(unmatched), first, last]])
+        + figure_html(fig_times)
+        + (html_table(['Injection Without Acquisition Time'], [[column] for column in unmatched]) if unmatched else ''))
+
+
+def chart_projection(scores, explained):
+    """ charts first two principal component scores of injections by sample type and by batch
+    Parameters:
+            scores (data-frame): PC, Sample Type, and Batch columns from projection.qc_projection
+            explained (numpy array): fraction of variance explained by each component
+
+    Returns:
+            str: html section with explained variance and spread tables and score plots
+
+    """
+
+    import plotly.graph_objects as go
+
+    import projection
+
+    components = [column for column in scores.columns if column.startswith('PC')]
+    if len(components) < 2:
+
+        return "<h2>QC Projection</h2><p>fewer than two injections or features to project</p>"
+
+    spread = projection.dispersion(scores[components], scores['Sample Type'])
+    sample_spread = spread.get('Sample')
+    spread_rows = [
+        [sample_type, int((scores['Sample Type'] == sample_type).sum()), round(distance, 2),
+         round(distance / sample_spread, 2) if sample_spread else '']
+        for sample_type, distance in spread.items()]
+
+    axis_titles = {
+        'xaxis_title': f'PC1 ({explained[0] * 100:.1f}%)',
+        'yaxis_title': f'PC2 ({explained[1] * 100:.1f}%)'}
+
+    figures = []
+    for column, title in (('Sample Type', 'Scores by sample type'), ('Batch', 'Scores by batch')):
+
+        labels = scores[column]
+        if labels.isna().all():
+
+            continue
+
+        fig = go.Figure()
+        for label in dict.fromkeys(labels.dropna().tolist()):
+
+            in_label = (labels == label).to_numpy()
+            fig.add_trace(go.Scattergl(
+                x=scores['PC1'].to_numpy()[in_label], y=scores['PC2'].to_numpy()[in_label], mode='markers',
+                name=str(label), text=scores.index.to_numpy()[in_label]))
+
+        fig.update_layout(title=title, **axis_titles)
+        figures.append(figure_html(fig))
+
+    return (
+        "<h2>QC Projection</h2>"
+        + html_table(
+            ['Component', 'Variance Explained %'],
+            [[component, round(value * 100, 2)] for component, value in zip(components, explained)])
+        + html_table(['Sample Type', 'Injections', 'Spread', 'Spread / Sample Spread'], spread_rows)
+        + "".join(figures))
+
+
+def write_report(file_path, title, sections):
+    """ writes self-contained html report, does not open a browser
+    Parameters:
+            file_path (str): Full directory path of report .html file
+            title (str): report title
+            sections (list): html sections from chart functions in report order
+
+    Returns:
+            None
+
+    """
+
+    from plotly.offline import get_plotlyjs
+
+    with open(file_path, 'w', encoding='utf-8') as report_file:
+
+        report_file.write(
+            f"<!DOCTYPE html><html><head><meta charset=\"utf-8\"><title>{html.escape(title)}</title>"
+            f"<style>{PAGE_STYLE}</style><script>{get_plotlyjs()}</script><script>{PAGE_SCRIPT}</script>"
+            f"</head><body><h1>{html.escape(title)}</h1>")
+
+        for section in sections:
+
+            report_file.write(section)
+
+        report_file.write("</body></html>")
+
+    print(f"file saved: {file_path}")
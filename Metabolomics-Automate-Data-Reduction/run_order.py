@@ -0,0 +1,102 @@
+#!/usr/bin/env python
+
+""" run_order.py: Acquisition time and run order of every sample column joined from file_times.csv by sample name """
+
+__author__ = "Bryan Roberts"
+
+import numpy as np
+import pandas as pd
+
+import batches  # local source
+
+# raw data extensions removed from file names before they are compared with sample columns
+RAW_EXTENSIONS = r"\.(d|raw|wiff|abf|mzml|mzxml)$"
+
+
+def normalize_names(names):
+    """ sample or file names in the form they are compared in, without raw data extension, spaces, or case
+
+    Parameters:
+            names (iterable): sample column or raw data file names
+
+    Returns:
+            pandas index: normalized names
+
+    """
+
+    text = pd.Series(list(names), dtype=object).fillna("").astype(str).str.strip()
+
+    return pd.Index(text.str.replace(RAW_EXTENSIONS, "", case=False, regex=True).str.casefold())
+
+
+def join_file_times(columns, times):
+    """ acquisition time and run order of each sample column from the times of the raw data files
+
+    File names are normalized once into a hash index and every column is looked up in it, so the join is one pass over
+    the columns whatever their number.  Files acquired more than once under the same name keep their last acquisition.
+
+    Parameters:
+            columns (list): sample columns of the export
+            times (pandas series): acquisition datetime of each raw data file indexed by file name, from
+            batches.read_file_times
+
+    Returns:
+            run_order (pandas data-frame): Acquired and Run Order (1, 2, ... in acquisition order, 0 for columns without
+            a file) of every column, indexed by column
+            unmatched (list): columns without a raw data file, in column order
+
+    """
+
+    files = pd.Series(pd.to_datetime(times).to_numpy(), index=normalize_names(times.index))
+    files = files.sort_values(kind="stable")
+    files = files[~files.index.duplicated(keep="last")]
+
+    positions = files.index.get_indexer(normalize_names(columns))
+    matched = positions >= 0
+
+    acquired = np.full(len(columns), np.datetime64("NaT"), dtype="datetime64[ns]")
+    acquired[matched] = files.to_numpy(dtype="datetime64[ns]")[positions[matched]]
+
+    # run order of the matched columns, ties keep column order
+    run_order = np.zeros(len(columns), dtype=np.int64)
+    timed = np.flatnonzero(matched)
+    run_order[timed[np.argsort(acquired[timed], kind="stable")]] = np.arange(1, len(timed) + 1)
+
+    joined = pd.DataFrame(
+        {"Acquired": acquired, "Run Order": run_order}, index=pd.Index(list(columns), name="Sample"))
+
+    return joined, [column for column, found in zip(columns, matched) if not found]
+
+
+def ordered_columns(run_order):
+    """ sample columns in run order, columns without a raw data file after them in their original order
+
+    Parameters:
+            run_order (pandas data-frame): run order from join_file_times
+
+    Returns:
+            list: sample columns
+
+    """
+
+    order = run_order["Run Order"].to_numpy()
+    timed = np.flatnonzero(order > 0)
+    untimed = np.flatnonzero(order == 0)
+
+    return run_order.index[np.concatenate((timed[np.argsort(order[timed])], untimed))].tolist()
+
+
+def read_run_order(file_location, columns):
+    """ run order of the sample columns of an export from file_times.csv
+
+    Parameters:
+            file_location (str): Full directory path of file_times.csv written by agilent_date_time_extractor.py
+            columns (list): sample columns of the export
+
+    Returns:
+            run_order (pandas data-frame): see join_file_times
+            unmatched (list): columns without a raw data file
+
+    """
+
+    return join_file_times(columns, batches.read_file_times(file_location))
@@ -0,0 +1,110 @@
+#!/usr/bin/env python
+
+""" sample_names.py: Parser for Name###_MX######_Mode_SampleID-Num sample names and the column metadata index """
+
+__author__ = "Bryan Roberts"
+
+import re
+
+import numpy as np
+import pandas as pd
+
+# one pattern for every tool reading sample names, ex: Biorec001_MX123456_posCSH_p1-001
+# name is letters then the injection number, names with letters after the number have no injection number, the mode
+# may be followed by a sample id after "_" or by any other non-letter suffix, ex: PoolQC001_MX123456_posCSH-1
+SAMPLE_NAME = re.compile(
+    r"^(?P<name>[A-Za-z]*(?P<injection>\d+)|[A-Za-z0-9]+)_"
+    r"(?:(?P<study>[A-Za-z0-9]+)_(?P<mode>[A-Za-z]+)(?:_(?P<sample_id>.*)|[^A-Za-z_].*)?$)?")
+
+# sample type of a column from the text in its name, checked in order, everything else is a study sample
+SAMPLE_TYPES = (("MtdBlank", "Blank"), ("Biorec", "BioRec"), ("PoolQC", "Pool"))
+STUDY_SAMPLE = "Sample"
+
+
+def parse(columns):
+    """ parses every column name with one pass of the compiled sample name pattern
+
+    Parameters:
+            columns (iterable): column names, metadata columns are allowed and come back unparsed
+
+    Returns:
+            index (pandas data-frame): one row per column indexed by column name with Name, Injection (float, nan if
+            the name has no injection number), Study, Mode, Sample ID, Type (Blank, BioRec, Pool, or Sample), and
+            Parsed (True when study and mode were found)
+
+    """
+
+    names = pd.Series([str(column) for column in columns], dtype=object)
+    fields = names.str.extract(SAMPLE_NAME)
+
+    conditions = [names.str.contains(text, regex=False).to_numpy(dtype=bool) for text, _ in SAMPLE_TYPES]
+    sample_type = np.select(conditions, [label for _, label in SAMPLE_TYPES], default=STUDY_SAMPLE)
+
+    index = pd.DataFrame({
+        "Name": fields["name"].to_numpy(dtype=object),
+        "Injection": pd.to_numeric(fields["injection"], errors="coerce").to_numpy(dtype=np.float64),
+        "Study": fields["study"].to_numpy(dtype=object),
+        "Mode": fields["mode"].to_numpy(dtype=object),
+        "Sample ID": fields["sample_id"].to_numpy(dtype=object),
+        "Type": sample_type,
+        "Parsed": fields["study"].notna().to_numpy(dtype=bool)},
+        index=pd.Index(list(columns), name="Column"))
+
+    return index
+
+
+def sample_columns(columns):
+    """ columns whose names follow the sample name convention, in order """
+
+    index = parse(columns)
+
+    return index.index[index["Parsed"].to_numpy()].tolist()
+
+
+def columns_of_type(index, sample_type):
+    """ columns of one sample type in index order, ex: columns_of_type(index, "Pool") """
+
+    return index.index[(index["Type"] == sample_type).to_numpy()].tolist()
+
+
+def study_name(index):
+    """ client name, minix, and analysis of the first sample in index, ex: Client_MX123456_posHILIC
+
+    The last three characters of the name are the injection number.
+
+    """
+
+    first = index.iloc[0]
+
+    # names outside the convention still give their first three underscore separated fields
+    if not first["Parsed"]:
+
+        fields = str(index.index[0]).split("_")
+
+        return fields[0][:len(fields[0]) - 3] + "_" + fields[1] + "_" + fields[2]
+
+    return first["Name"][:len(first["Name"]) - 3] + "_" + first["Study"] + "_" + first["Mode"]
+
+
+def studies(index):
+    """ studies of parsed sample columns in order of first appearance """
+
+    return pd.unique(index.loc[index["Parsed"].to_numpy(), "Study"]).tolist()
+
+
+def study_columns(columns, study):
+    """ columns to keep for one study, metadata columns and the samples of that study
+
+    Parameters:
+            columns (iterable): all column names of an export
+            study (str): study to keep, ex: MX123456
+
+    Returns:
+            list: columns in their original order without the samples of other studies
+
+    """
+
+    index = parse(columns)
+    other = index["Parsed"].to_numpy() & (index["Study"] != study).to_numpy()
+
+    return index.index[~other].tolist()
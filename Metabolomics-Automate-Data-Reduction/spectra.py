@@ -0,0 +1,227 @@
+#!/usr/bin/env python
+
+""" spectra.py: Compact storage of MS-Dial MS/MS spectra and batched spectral similarity of feature pairs """
+
+__author__ = "Bryan Roberts"
+
+from collections import namedtuple
+
+import numpy as np
+import pandas as pd
+
+# m/z width of the bins peaks are matched in, peaks of two spectra in the same bin are counted as a match
+MZ_BIN_WIDTH = 0.01
+
+# ms-flo duplicate settings from msflo.FORM_FIELDS, m/z and retention time tolerance and minimum peak match ratio
+DUPLICATE_MZ_TOLERANCE = 0.005
+DUPLICATE_RT_TOLERANCE = 0.05
+DUPLICATE_MATCH_RATIO = 0.7
+
+# number of feature pairs scored at once, bounds memory of the expanded peak arrays
+PAIR_CHUNK_SIZE = 20000
+
+Spectra = namedtuple("Spectra", ["mz", "intensity", "offsets"])
+Spectra.__doc__ = """ ragged array of spectra, peaks of spectrum i are mz[offsets[i]:offsets[i + 1]]
+
+    mz (numpy array): float32 m/z of every peak of every spectrum, concatenated in feature order
+    intensity (numpy array): float32 intensity of every peak
+    offsets (numpy array): int64 start of each spectrum in mz and intensity, one longer than the number of spectra
+"""
+
+
+def parse_spectra(spectrum_strings):
+    """ parses MS-Dial spectrum strings ("100.0:1000 150.5:250") into concatenated float32 buffers
+
+    Parameters:
+            spectrum_strings (iterable): MS/MS spectrum column, missing spectra as NaN or ""
+
+    Returns:
+            Spectra: mz, intensity, and offsets
+
+    """
+
+    text = pd.Series(spectrum_strings, dtype=object).fillna("").astype(str)
+    peaks = text.str.count(":").to_numpy(dtype=np.int64)
+
+    offsets = np.zeros(len(peaks) + 1, dtype=np.int64)
+    np.cumsum(peaks, out=offsets[1:])
+
+    # one numeric parse of all spectra instead of splitting each peak in python
+    values = np.fromstring(" ".join(text).replace(":", " "), dtype=np.float64, sep=" ")
+    assert (len(values) == 2 * offsets[-1]), "MS/MS spectrum strings are not mz:intensity pairs"
+
+    return Spectra(
+        mz=values[0::2].astype(np.float32),
+        intensity=values[1::2].astype(np.float32),
+        offsets=offsets)
+
+
+def peak_counts(spectra):
+    """ number of peaks of each spectrum """
+
+    return np.diff(spectra.offsets)
+
+
+def get_spectrum(spectra, index):
+    """ m/z and intensity views of one spectrum, no peaks are copied """
+
+    start, end = spectra.offsets[index], spectra.offsets[index + 1]
+
+    return spectra.mz[start:end], spectra.intensity[start:end]
+
+
+def binned_vectors(spectra, bin_width=MZ_BIN_WIDTH):
+    """ sparse unit vectors of all spectra, square root intensities summed in m/z bins
+
+    Parameters:
+            spectra (Spectra): spectra from parse_spectra
+            bin_width (float): m/z width of bins
+
+    Returns:
+            spectrum (numpy array): spectrum index of each nonzero bin, sorted by spectrum then bin
+            bins (numpy array): m/z bin of each nonzero bin
+            weights (numpy array): float64 weight of each bin, each spectrum has unit length
+            starts (numpy array): start of each spectrum in the returned arrays, one longer than the number of spectra
+
+    """
+
+    counts = peak_counts(spectra)
+    spectrum = np.repeat(np.arange(len(counts)), counts)
+    bins = np.floor(spectra.mz.astype(np.float64) / bin_width).astype(np.int64)
+
+    # peaks falling in the same bin of a spectrum are summed, square root keeps large peaks from dominating
+    span = bins.max() + 1 if len(bins) else 1
+    unique, inverse = np.unique(spectrum * span + bins, return_inverse=True)
+    weights = np.bincount(
+        inverse.ravel(), weights=np.sqrt(np.maximum(spectra.intensity, 0)), minlength=len(unique))
+    spectrum, bins = unique // span, unique % span
+
+    norms = np.sqrt(np.bincount(spectrum, weights=weights ** 2, minlength=len(counts)))
+    with np.errstate(divide="ignore", invalid="ignore"):
+
+        weights = np.where(norms[spectrum] > 0, weights / norms[spectrum], 0)
+
+    starts = np.zeros(len(counts) + 1, dtype=np.int64)
+    np.cumsum(np.bincount(spectrum, minlength=len(counts)), out=starts[1:])
+
+    return spectrum, bins, weights, starts
+
+
+def expand(starts, rows):
+    """ positions of every bin of each spectrum in rows and the pair each position belongs to """
+
+    lengths = starts[rows + 1] - starts[rows]
+    pair = np.repeat(np.arange(len(rows)), lengths)
+    position = np.arange(lengths.sum()) - np.repeat(np.cumsum(lengths) - lengths - starts[rows], lengths)
+
+    return pair, position
+
+
+def cosine_scores(spectra, first, second, bin_width=MZ_BIN_WIDTH):
+    """ binned cosine similarity of many spectrum pairs at once
+
+    Parameters:
+            spectra (Spectra): spectra from parse_spectra
+            first (array): spectrum index of the first feature of each pair
+            second (array): spectrum index of the second feature of each pair
+            bin_width (float): m/z width of bins peaks are matched in
+
+    Returns:
+            numpy array: float64 cosine similarity between 0 and 1 of each pair, 0 if either spectrum is empty
+
+    """
+
+    first = np.asarray(first, dtype=np.int64)
+    second = np.asarray(second, dtype=np.int64)
+    _, bins, weights, starts = binned_vectors(spectra, bin_width)
+    scores = np.zeros(len(first))
+
+    for chunk in range(0, len(first), PAIR_CHUNK_SIZE):
+
+        rows = slice(chunk, chunk + PAIR_CHUNK_SIZE)
+        first_pair, first_position = expand(starts, first[rows])
+        second_pair, second_position = expand(starts, second[rows])
+
+        # bins are unique within a spectrum, so a key shared by both sides of a pair is one matching bin
+        span = bins.max() + 1 if len(bins) else 1
+        first_keys = first_pair * span + bins[first_position]
+        second_keys = second_pair * span + bins[second_position]
+        shared, first_match, second_match = np.intersect1d(
+            first_keys, second_keys, assume_unique=True, return_indices=True)
+
+        scores[rows] = np.bincount(
+            shared // span,
+            weights=weights[first_position[first_match]] * weights[second_position[second_match]],
+            minlength=len(first[rows]))
+
+    return np.clip(scores, 0, 1)
+
+
+def candidate_pairs(mz, rt, mz_tolerance, rt_tolerance):
+    """ pairs of features within m/z and retention time tolerance of each other, found from m/z sorted windows
+
+    Parameters:
+            mz (array): m/z of each feature
+            rt (array): retention time of each feature
+            mz_tolerance (float): largest m/z difference of a pair
+            rt_tolerance (float): largest retention time difference of a pair
+
+    Returns:
+            first (numpy array): position of the first feature of each pair
+            second (numpy array): position of the second feature of each pair
+
+    """
+
+    mz = np.asarray(mz, dtype=np.float64)
+    rt = np.asarray(rt, dtype=np.float64)
+    order = np.argsort(mz, kind="stable")
+    sorted_mz = mz[order]
+
+    # each feature is paired with the features after it in m/z order that are within tolerance
+    ends = np.searchsorted(sorted_mz, sorted_mz + mz_tolerance, side="right")
+    lengths = ends - np.arange(len(mz)) - 1
+    first = np.repeat(np.arange(len(mz)), lengths)
+    second = np.arange(lengths.sum()) - np.repeat(np.cumsum(lengths) - lengths, lengths) + first + 1
+
+    first, second = order[first], order[second]
+    close = np.abs(rt[first] - rt[second]) <= rt_tolerance
+
+    return first[close], second[close]
+
+
+def duplicate_candidates(data_frame, mz_tolerance=DUPLICATE_MZ_TOLERANCE, rt_tolerance=DUPLICATE_RT_TOLERANCE):
+    """ feature pairs within duplicate tolerances with cosine similarity of their MS/MS spectra
+
+    Parameters:
+            data_frame (pandas data-frame): features with Average Mz, Average Rt(min), Metabolite name, MS/MS spectrum
+            mz_tolerance (float): largest m/z difference of a pair
+            rt_tolerance (float): largest retention time difference of a pair
+
+    Returns:
+            pandas data-frame: Feature 1, Feature 2, m/z Difference, RT Difference, and Cosine Similarity of each pair
+
+    """
+
+    mz = data_frame['Average Mz'].to_numpy(dtype=np.float64)
+    rt = data_frame['Average Rt(min)'].to_numpy(dtype=np.float64)
+    first, second = candidate_pairs(mz, rt, mz_tolerance, rt_tolerance)
+
+    if 'MS/MS spectrum' in data_frame.columns:
+
+        scores = cosine_scores(parse_spectra(data_frame['MS/MS spectrum'].to_numpy()), first, second)
+
+    else:
+
+        scores = np.full(len(first), np.nan)
+
+    # unknowns have no name after reduction and are labelled by m/z and retention time
+    names = data_frame['Metabolite name'].fillna("").astype(str).to_numpy()
+    positions = [f"{feature_mz:.4f}_{feature_rt:.2f}" for feature_mz, feature_rt in zip(mz, rt)]
+    labels = np.where(names != "", names, positions)
+
+    return pd.DataFrame({
+        'Feature 1': labels[first],
+        'Feature 2': labels[second],
+        'm/z Difference': np.round(np.abs(mz[first] - mz[second]), 4),
+        'RT Difference': np.round(np.abs(rt[first] - rt[second]), 3),
+        'Cosine Similarity': np.round(scores, 3)})
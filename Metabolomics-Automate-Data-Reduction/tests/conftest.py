@@ -0,0 +1,10 @@
+#!/usr/bin/env python
+
+""" conftest.py: Makes the flat data reduction modules importable from the tests """
+
+__author__ = "Bryan Roberts"
+
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
@@ -0,0 +1,39 @@
+#!/usr/bin/env python
+
+""" test_imputation.py: Blank limit of detection imputation leaves blank columns as exported """
+
+__author__ = "Bryan Roberts"
+
+import numpy as np
+import pandas as pd
+
+import imputation  # local source
+import qc_metrics
+import reduce
+
+BLANKS = ["MtdBlank001_MX123456_posCSH_b1", "MtdBlank002_MX123456_posCSH_b2", "MtdBlank003_MX123456_posCSH_b3"]
+POOLS = ["PoolQC004_MX123456_posCSH_p1", "PoolQC005_MX123456_posCSH_p2", "PoolQC006_MX123456_posCSH_p3"]
+SAMPLES = ["Client007_MX123456_posCSH_s1", "Client008_MX123456_posCSH_s2", "Client009_MX123456_posCSH_s3"]
+
+
+def test_blank_lod_keeps_blank_average():
+
+    heights = np.array([
+        [100.0, 120.0, 0.0, 900.0, 950.0, 0.0, 1000.0, 0.0, 1100.0],
+        [50.0, 60.0, 70.0, 400.0, 420.0, 410.0, 500.0, 520.0, 0.0]])
+    data_frame = pd.DataFrame(heights, columns=BLANKS + POOLS + SAMPLES)
+
+    before = qc_metrics.feature_metrics(data_frame, BLANKS, [], POOLS, SAMPLES)["Blank Mean"].to_numpy()
+
+    imputed = imputation.impute(data_frame, BLANKS + POOLS + SAMPLES, "blank_lod", BLANKS)
+    after = data_frame.copy()
+    reduce.add_reduction_columns(after, BLANKS, SAMPLES, POOLS)
+
+    np.testing.assert_array_equal(after["Blank Average"].to_numpy(), before)
+    np.testing.assert_array_equal(data_frame[BLANKS].to_numpy(), heights[:, :3])
+    assert imputed["samples"][BLANKS].tolist() == [0, 0, 0]
+
+    # missing pool and sample heights are filled with the blank limit, mean + 3 stdev of the present blank heights
+    limit = 110.0 + 3 * np.std([100.0, 120.0], ddof=1)
+    assert data_frame.loc[0, POOLS[2]] == limit and data_frame.loc[0, SAMPLES[1]] == limit
+    assert data_frame.loc[1, SAMPLES[2]] == 60.0 + 3 * 10.0
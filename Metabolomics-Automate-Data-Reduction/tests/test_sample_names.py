@@ -0,0 +1,41 @@
+#!/usr/bin/env python
+
+""" test_sample_names.py: Sample name pattern on export columns and raw data folder names """
+
+__author__ = "Bryan Roberts"
+
+import os
+
+import pytest
+
+import sample_names  # local source
+
+
+@pytest.mark.parametrize("name, study, mode, sample_id", [
+    ("Biorec001_MX123456_posCSH_p1-001", "MX123456", "posCSH", "p1-001"),
+    ("MtdBlank001_MX123456_posCSH", "MX123456", "posCSH", None),
+    ("PoolQC001_MX123456_posCSH-1", "MX123456", "posCSH", None),
+    ("Sample1_MX1_posCSH-01", "MX1", "posCSH", None)])
+def test_sample_name_fields(name, study, mode, sample_id):
+
+    found = sample_names.SAMPLE_NAME.match(name)
+
+    assert found is not None
+    assert (found.group("study"), found.group("mode"), found.group("sample_id")) == (study, mode, sample_id)
+
+
+@pytest.mark.parametrize("folder", [
+    "MtdBlank001_MX123456_posCSH.d", "PoolQC001_MX123456_posCSH-1.d", "Biorec001_MX123456_posCSH_p1-001.d"])
+def test_raw_data_folders_match_without_extension(folder):
+
+    found = sample_names.SAMPLE_NAME.match(os.path.splitext(folder)[0])
+
+    assert found is not None and found.group("study") == "MX123456" and found.group("mode") == "posCSH"
+
+
+def test_metadata_columns_are_not_parsed():
+
+    index = sample_names.parse(["Average Mz", "Metabolite name", "PoolQC001_MX123456_posCSH-1"])
+
+    assert index["Parsed"].tolist() == [False, False, True]
+    assert sample_names.columns_of_type(index, "Pool") == ["PoolQC001_MX123456_posCSH-1"]
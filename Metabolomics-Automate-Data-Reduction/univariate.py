@@ -0,0 +1,407 @@
+#!/usr/bin/env python
+
+""" univariate.py: Fold change, Welch t-test or Mann-Whitney p-values, and BH-FDR of every feature between sample groups """
+
+__author__ = "Bryan Roberts"
+
+import argparse
+import itertools
+import os
+
+import numpy as np
+import pandas as pd
+from scipy import special
+
+import msdial  # local source
+import sample_names
+
+# tests comparing two groups
+TESTS = ("welch", "mannwhitney")
+
+# text of a Sample ID before this separator is its group, ex: ABA-01 is in group ABA
+GROUP_SEPARATOR = "-"
+
+# feature rows ranked at a time by the Mann-Whitney test, bounds memory of the sorted copies
+BLOCK_ROWS = 4096
+
+# feature columns copied to the statistics table when the input has them
+FEATURE_COLUMNS = ["Alignment ID", "Metabolite name", "INCHIKEY", "Adduct type", "Average Mz", "Average Rt(min)"]
+
+# statistics columns of each feature and comparison
+STATISTICS_COLUMNS = [
+    "Comparison",
+    "Group",
+    "Reference",
+    "Group Count",
+    "Reference Count",
+    "Group Mean",
+    "Reference Mean",
+    "Fold Change",
+    "Log2 Fold Change",
+    "Statistic",
+    "P-Value",
+    "FDR"]
+
+
+def design_from_names(columns, separator=GROUP_SEPARATOR):
+    """ groups of study samples from the Sample ID of their names, ex: Bryan001_MX123456_posHILIC_ABA-01 is in ABA
+
+    Parameters:
+            columns (iterable): column names of a reduced or quant table
+            separator (str): Sample IDs are split at the last separator, IDs without it are their own group
+
+    Returns:
+            design (pandas series): group of each study sample column, indexed by column
+
+    """
+
+    index = sample_names.parse(columns)
+    index = index[(index["Type"] == sample_names.STUDY_SAMPLE).to_numpy() & index["Parsed"].to_numpy()]
+    index = index[index["Sample ID"].notna().to_numpy()]
+
+    groups = index["Sample ID"].astype(str).str.rsplit(separator, n=1).str[0]
+
+    return pd.Series(groups.to_numpy(dtype=object), index=index.index, name="Group")
+
+
+def read_design(file_location):
+    """ reads a sample group design, first column sample column names and second column groups, with a header row
+
+    Parameters:
+            file_location (str): Full directory path of .csv, .txt, or .xlsx design file
+
+    Returns:
+            design (pandas series): group of each sample column, indexed by column
+
+    """
+
+    table = msdial.read_table(file_location)
+    assert table.shape[1] >= 2, f"{file_location} needs sample and group columns"
+
+    table = table.iloc[:, :2].dropna()
+
+    return pd.Series(
+        table.iloc[:, 1].astype(str).to_numpy(dtype=object), index=table.iloc[:, 0].astype(str), name="Group")
+
+
+def comparisons(groups, reference=None):
+    """ (group, reference) pairs tested, every group against reference or every pair of groups in order
+
+    Parameters:
+            groups (list): group names in design order
+            reference (str): control group, None compares all pairs
+
+    Returns:
+            list of (group, reference) tuples
+
+    """
+
+    if reference is None:
+
+        return [(second, first) for first, second in itertools.combinations(groups, 2)]
+
+    assert reference in groups, f"reference group {reference} is not in the design {groups}"
+
+    return [(group, reference) for group in groups if group != reference]
+
+
+def group_moments(heights):
+    """ count, mean, and sample variance of every row ignoring missing values
+
+    Parameters:
+            heights (numpy array): float64 heights, one row per feature, nan for missing
+
+    Returns:
+            counts (numpy array): heights present in each row
+            mean (numpy array): mean of each row, nan without heights
+            variance (numpy array): variance with one degree of freedom, nan with fewer than two heights
+
+    """
+
+    present = ~np.isnan(heights)
+    counts = present.sum(axis=1)
+
+    with np.errstate(divide="ignore", invalid="ignore"):
+
+        mean = np.where(present, heights, 0.0).sum(axis=1) / counts
+        deviations = np.where(present, heights - mean[:, None], 0.0)
+        variance = np.einsum("ij,ij->i", deviations, deviations) / (counts - 1)
+
+    variance[counts < 2] = np.nan
+
+    return counts, mean, variance
+
+
+def welch_test(group, reference):
+    """ Welch t-test of every row, same statistic and two-sided p-value as scipy.stats.ttest_ind(equal_var=False)
+
+    Parameters:
+            group (numpy array): float64 heights of the group, one row per feature
+            reference (numpy array): float64 heights of the reference group, same rows
+
+    Returns:
+            statistic (numpy array): t of each row, nan with fewer than two heights in either group
+            p_value (numpy array): two-sided p-value of each row
+
+    """
+
+    group_counts, group_mean, group_variance = group_moments(group)
+    reference_counts, reference_mean, reference_variance = group_moments(reference)
+
+    with np.errstate(divide="ignore", invalid="ignore"):
+
+        group_error = group_variance / group_counts
+        reference_error = reference_variance / reference_counts
+        error = group_error + reference_error
+
+        statistic = (group_mean - reference_mean) / np.sqrt(error)
+        freedom = error ** 2 / (
+            group_error ** 2 / (group_counts - 1) + reference_error ** 2 / (reference_counts - 1))
+        p_value = 2 * special.stdtr(freedom, -np.abs(statistic))
+
+    return statistic, p_value
+
+
+def rank_sums(heights, columns):
+    """ sum of the average ranks of the first columns of every row and the tie correction term of each row
+
+    Each row is sorted once, runs of equal heights are found in the flattened sorted rows, and every height gets the
+    mean position of its run.  Ranks are summed in sorted order so they are never scattered back to their columns.
+    Missing heights sort last and do not change the ranks of the others.
+
+    Parameters:
+            heights (numpy array): float64 heights, one row per feature, nan for missing
+            columns (int): leading columns whose ranks are summed
+
+    Returns:
+            sums (numpy array): rank sum of the leading columns of each row, ranks from 1
+            ties (numpy array): sum of t^3 - t over runs of t equal heights in each row
+
+    """
+
+    rows, width = heights.shape
+    order = np.argsort(heights, axis=1)
+    ordered = np.take_along_axis(heights, order, axis=1).ravel()
+
+    # a run starts at the first column of each row and wherever the height changes, nan never equals nan
+    starts = np.ones(ordered.size, dtype=bool)
+    starts[1:] = ordered[1:] != ordered[:-1]
+    starts[::width] = True
+
+    start_positions = np.flatnonzero(starts)
+    lengths = np.diff(np.append(start_positions, ordered.size)).astype(np.float64)
+    average_rank = start_positions % width + (lengths + 1) / 2
+
+    leading = (order.ravel() < columns) & ~np.isnan(ordered)
+    run = np.cumsum(starts) - 1
+    sums = np.bincount(np.flatnonzero(leading) // width, weights=average_rank[run[leading]], minlength=rows)
+    ties = np.bincount(start_positions // width, weights=lengths ** 3 - lengths, minlength=rows)
+
+    return sums, ties
+
+
+def mann_whitney_test(group, reference, block_rows=BLOCK_ROWS):
+    """ Mann-Whitney U test of every row, same U and two-sided p-value as scipy.stats.mannwhitneyu(method="asymptotic")
+
+    Parameters:
+            group (numpy array): float64 heights of the group, one row per feature
+            reference (numpy array): float64 heights of the reference group, same rows
+            block_rows (int): rows ranked at a time
+
+    Returns:
+            statistic (numpy array): U of the group in each row
+            p_value (numpy array): two-sided p-value with tie and continuity correction
+
+    """
+
+    rows = len(group)
+    statistic = np.empty(rows)
+    p_value = np.empty(rows)
+
+    for start in range(0, rows, block_rows):
+
+        block = slice(start, min(start + block_rows, rows))
+        sums, ties = rank_sums(np.hstack((group[block], reference[block])), group.shape[1])
+
+        group_counts = np.sum(~np.isnan(group[block]), axis=1).astype(np.float64)
+        reference_counts = np.sum(~np.isnan(reference[block]), axis=1).astype(np.float64)
+        counts = group_counts + reference_counts
+
+        with np.errstate(divide="ignore", invalid="ignore"):
+
+            u = sums - group_counts * (group_counts + 1) / 2
+            mean = group_counts * reference_counts / 2
+            deviation = np.sqrt(group_counts * reference_counts / 12 * ((counts + 1) - ties / (counts * (counts - 1))))
+            z = (np.maximum(u, group_counts * reference_counts - u) - mean - 0.5) / deviation
+
+            statistic[block] = np.where((group_counts > 0) & (reference_counts > 0), u, np.nan)
+            p_value[block] = np.minimum(2 * special.ndtr(-z), 1.0)
+
+    return statistic, p_value
+
+
+def benjamini_hochberg(p_value):
+    """ Benjamini-Hochberg adjusted p-values, missing p-values are left out of the number of tests
+
+    Parameters:
+            p_value (numpy array): p-value of each feature
+
+    Returns:
+            numpy array: false discovery rate of each feature, nan where p_value is nan
+
+    """
+
+    adjusted = np.full(len(p_value), np.nan)
+    tested = np.flatnonzero(~np.isnan(p_value))
+    if not len(tested):
+
+        return adjusted
+
+    order = np.argsort(p_value[tested], kind="stable")
+    scaled = p_value[tested][order] * len(tested) / np.arange(1, len(tested) + 1)
+
+    # each adjusted p-value is the smallest scaled p-value at its rank or above
+    adjusted[tested[order]] = np.minimum(np.minimum.accumulate(scaled[::-1])[::-1], 1.0)
+
+    return adjusted
+
+
+def feature_statistics(data_frame, design, reference=None, test="welch", log=True):
+    """ fold change, test statistic, p-value, and FDR of every feature for each comparison of design groups
+
+    Heights of each group are read into one matrix and every statistic is computed for all features at once.  Fold
+    changes are ratios of group mean heights.  The Welch t-test is run on log2 heights when log is True, heights that
+    are not positive count as missing.
+
+    Parameters:
+            data_frame (pandas data-frame): reduced table from process.py or results of calculate_results
+            design (pandas series): group of each sample column, from design_from_names or read_design
+            reference (str): control group every other group is compared to, None compares all pairs
+            test (str): "welch" or "mannwhitney"
+            log (bool): log2 transform heights before the Welch t-test
+
+    Returns:
+            statistics (pandas data-frame): FEATURE_COLUMNS present in data_frame and STATISTICS_COLUMNS, one row per
+            feature and comparison
+
+    """
+
+    assert test in TESTS, f"test must be one of {TESTS}"
+
+    design = design[design.index.isin(data_frame.columns)]
+    groups = pd.unique(design.to_numpy()).tolist()
+    features = data_frame[[column for column in FEATURE_COLUMNS if column in data_frame.columns]].reset_index(drop=True)
+
+    pieces = []
+    for group, control in comparisons(groups, reference):
+
+        group_heights = data_frame[design.index[(design == group).to_numpy()]].apply(
+            pd.to_numeric, errors="coerce").to_numpy(dtype=np.float64)
+        reference_heights = data_frame[design.index[(design == control).to_numpy()]].apply(
+            pd.to_numeric, errors="coerce").to_numpy(dtype=np.float64)
+
+        group_counts, group_mean, _ = group_moments(group_heights)
+        reference_counts, reference_mean, _ = group_moments(reference_heights)
+
+        with np.errstate(divide="ignore", invalid="ignore"):
+
+            fold_change = group_mean / reference_mean
+            log_fold_change = np.log2(np.where(fold_change > 0, fold_change, np.nan))
+
+            if test == "welch" and log:
+
+                statistic, p_value = welch_test(
+                    np.log2(np.where(group_heights > 0, group_heights, np.nan)),
+                    np.log2(np.where(reference_heights > 0, reference_heights, np.nan)))
+
+            elif test == "welch":
+
+                statistic, p_value = welch_test(group_heights, reference_heights)
+
+            else:
+
+                statistic, p_value = mann_whitney_test(group_heights, reference_heights)
+
+        piece = features.copy()
+        piece["Comparison"] = f"{group} vs {control}"
+        piece["Group"] = group
+        piece["Reference"] = control
+        piece["Group Count"] = group_counts
+        piece["Reference Count"] = reference_counts
+        piece["Group Mean"] = group_mean
+        piece["Reference Mean"] = reference_mean
+        piece["Fold Change"] = fold_change
+        piece["Log2 Fold Change"] = log_fold_change
+        piece["Statistic"] = statistic
+        piece["P-Value"] = p_value
+        piece["FDR"] = benjamini_hochberg(p_value)
+        pieces.append(piece)
+
+    if not pieces:
+
+        return pd.DataFrame(columns=list(features.columns) + STATISTICS_COLUMNS)
+
+    return pd.concat(pieces, ignore_index=True)
+
+
+def statistics_file(file_location, design_location=None, statistics_path=None, reference=None, test="welch",
+                    log=True):
+    """ computes feature statistics of a reduced or quant table and saves them
+
+    Parameters:
+            file_location (str): Full directory path of _reduced.txt, _processed.xlsx, or _SinglePointQuant.xlsx file
+            design_location (str): design file read by read_design, groups from Sample IDs if None
+            statistics_path (str): .txt or .xlsx file to save, <file>_statistics.txt next to the table if None
+            reference (str): control group, None compares all pairs
+            test (str): "welch" or "mannwhitney"
+            log (bool): log2 transform heights before the Welch t-test
+
+    Returns:
+            statistics_path (str): Full directory path of saved file
+
+    """
+
+    data_frame = msdial.read_table(file_location)
+    design = design_from_names(data_frame.columns) if design_location is None else read_design(design_location)
+    statistics = feature_statistics(data_frame, design, reference, test, log)
+
+    if statistics_path is None:
+
+        statistics_path = os.path.splitext(file_location)[0] + "_statistics.txt"
+
+    if statistics_path.lower().endswith(".xlsx"):
+
+        import excel
+
+        excel.write_excel(statistics, statistics_path)
+
+    else:
+
+        statistics.to_csv(statistics_path, sep="\t", index=False)
+
+    print(f"{len(data_frame)} features, {statistics['Comparison'].nunique()} comparisons, "
+          f"{int((statistics['FDR'] < 0.05).sum())} results with FDR < 0.05")
+    print(f"file saved: {statistics_path}")
+
+    return statistics_path
+
+
+def main():
+
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("file", help="reduced .txt, processed .xlsx, or single point quant .xlsx file")
+    parser.add_argument("--design", help="csv of sample column and group, groups from Sample IDs by default")
+    parser.add_argument("--reference", help="control group compared to every other group, all pairs by default")
+    parser.add_argument("--test", choices=TESTS, default="welch", help="two group test")
+    parser.add_argument("--no-log", action="store_true", help="run the Welch t-test on heights instead of log2 heights")
+    parser.add_argument("--output", help="statistics .txt or .xlsx file, saved next to the table by default")
+    args = parser.parse_args()
+
+    assert os.path.exists(args.file), f"{args.file} does not exist"
+
+    statistics_file(args.file, args.design, args.output, args.reference, args.test, not args.no_log)
+
+
+if __name__ == "__main__":
+
+    main()
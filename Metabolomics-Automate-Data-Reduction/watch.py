@@ -0,0 +1,254 @@
+#!/usr/bin/env python
+
+""" watch.py: Watches a folder for new MS-Dial exports and runs the data reduction pipeline on each one """
+
+__author__ = "Bryan Roberts"
+
+import argparse
+import concurrent.futures
+import datetime
+import os
+import time
+
+import folder_events  # local source
+import instruments
+import pipeline
+
+# file types treated as MS-Dial exports
+WATCH_EXTENSIONS = (".txt", ".xlsx")
+
+# files written next to the export by the pipeline stages, the run profile, registry.py (<export>_registry.txt, in
+# pipeline.OUTPUT_SUFFIXES), and merge.py, never treated as new exports
+OUTPUT_SUFFIXES = pipeline.OUTPUT_SUFFIXES + ("_manifest_profile.txt", "_merged.xlsx", "_merged.txt")
+
+# seconds a file size and modification time must stay unchanged before a partially written export is processed
+SETTLE_SECONDS = 5
+
+# record of every export processed from a folder, keyed by content hash
+LEDGER_NAME = ".watch_ledger.json"
+
+
+def is_candidate(file_name):
+    """ file name looks like an MS-Dial export and not a pipeline output, temporary, or hidden file """
+
+    return (
+        file_name.lower().endswith(WATCH_EXTENSIONS)
+        and not file_name.endswith(OUTPUT_SUFFIXES)
+        and not file_name.startswith((".", "~$")))
+
+
+def file_signature(file_path):
+    """ size and modification time of a file, None if it was removed """
+
+    try:
+
+        status = os.stat(file_path)
+
+    except FileNotFoundError:
+
+        return None
+
+    return status.st_size, status.st_mtime_ns
+
+
+def process_export(file_location, parameters, chrome_driver_directory, downloads_directory, stages):
+    """ runs pipeline on one export in a worker process
+
+    Returns:
+            status (str): "complete" or the error that stopped the pipeline
+
+    """
+
+    try:
+
+        pipeline.run(file_location, parameters, chrome_driver_directory, downloads_directory, stages)
+
+    except Exception as error:
+
+        return f"failed: {type(error).__name__}: {error}"
+
+    return "complete"
+
+
+def watch_folder(folder, parameters, chrome_driver_directory="", downloads_directory="", stages=None, workers=2,
+                 settle=SETTLE_SECONDS, once=False):
+    """ processes every new export in folder once, with at most workers pipelines running at a time
+
+    Files are processed after their size and modification time stay unchanged for settle seconds, so exports still
+    being copied into the folder are not read.  A ledger of content hashes in the folder makes sure an export is never
+    processed twice, including across restarts and under a different file name.
+
+    Parameters:
+            folder (str): Full directory path of folder to watch
+            parameters (dict): reduction parameters, ex: instruments.PRESETS["qtof"] with drift_correction,
+            run_order, imputation, batch, blank_subtraction, and registry
+            chrome_driver_directory (str): Full directory path to Chrome driver
+            downloads_directory (str): Full directory path to downloads folder
+            stages (list): names of pipeline stages to run, all stages if None
+            workers (int): number of exports processed at the same time
+            settle (float): seconds a file must be unchanged before it is processed
+            once (bool): process exports already in folder and return instead of watching forever
+
+    Returns:
+            None
+
+    """
+
+    ledger_path = os.path.join(folder, LEDGER_NAME)
+    ledger = pipeline.read_state(ledger_path)
+    handled = {}
+    pending = {}
+    running = {}
+
+    watch = folder_events.open_watch(folder)
+    print(f"watching {folder} with {'inotify' if watch['fd'] is not None else 'polling'}, {workers} workers")
+
+    # workers are processes, pandas releases little of the gil and exports are processed independently
+    with concurrent.futures.ProcessPoolExecutor(max_workers=workers) as executor:
+
+        try:
+
+            names = None
+            while True:
+
+                # polling and the first pass rescan the folder, inotify only reports changed names
+                if names is None:
+
+                    names = {entry.name for entry in os.scandir(folder) if entry.is_file()}
+
+                now = time.monotonic()
+                for name in names:
+
+                    file_path = os.path.join(folder, name)
+                    if not is_candidate(name):
+
+                        continue
+
+                    signature = file_signature(file_path)
+                    if signature is None or handled.get(file_path) == signature:
+
+                        continue
+
+                    # any change restarts the settle timer
+                    if file_path not in pending or pending[file_path][0] != signature:
+
+                        pending[file_path] = (signature, now)
+
+                # polling never reports unchanged files again, so settled files are checked every pass
+                ready = [path for path, (signature, changed) in pending.items() if now - changed >= settle]
+                for file_path in ready:
+
+                    signature, _ = pending[file_path]
+                    if file_signature(file_path) != signature:
+
+                        pending[file_path] = (file_signature(file_path), now)
+                        continue
+
+                    del pending[file_path]
+                    handled[file_path] = signature
+                    digest = pipeline.file_hash(file_path)
+
+                    if digest in ledger:
+
+                        print(f"already processed: {file_path} ({ledger[digest]['file']})")
+                        continue
+
+                    ledger[digest] = {
+                        "file": file_path,
+                        "status": "running",
+                        "started": datetime.datetime.now().isoformat(timespec="seconds")}
+                    pipeline.write_state(ledger_path, ledger)
+
+                    print(f"processing: {file_path}")
+                    future = executor.submit(
+                        process_export, file_path, parameters, chrome_driver_directory, downloads_directory, stages)
+                    running[future] = digest
+
+                # record finished exports
+                for future in [future for future in running if future.done()]:
+
+                    digest = running.pop(future)
+                    ledger[digest]["status"] = future.result()
+                    ledger[digest]["finished"] = datetime.datetime.now().isoformat(timespec="seconds")
+                    pipeline.write_state(ledger_path, ledger)
+                    print(f"{ledger[digest]['status']}: {ledger[digest]['file']}")
+
+                if once and not pending and not running:
+
+                    break
+
+                # wake for folder changes, when the next pending file settles, or to collect finished workers
+                timeouts = [settle - (time.monotonic() - changed) for _, changed in pending.values()]
+                if running:
+
+                    timeouts.append(1)
+
+                names = folder_events.wait_for_events(watch, max(min(timeouts), 0.05) if timeouts else None)
+
+        except KeyboardInterrupt:
+
+            print("stopping, waiting for running exports to finish")
+
+        finally:
+
+            folder_events.close_watch(watch)
+
+            # exports interrupted mid-run are removed from the ledger so they are processed again on restart
+            for future, digest in running.items():
+
+                try:
+
+                    ledger[digest]["status"] = future.result()
+
+                except (Exception, KeyboardInterrupt):
+
+                    del ledger[digest]
+
+            pipeline.write_state(ledger_path, ledger)
+
+
+def main():
+
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("folder", help="folder MS-Dial alignment exports are saved to")
+    parser.add_argument("--preset", choices=sorted(instruments.PRESETS), default="qtof", help="reduction defaults")
+    parser.add_argument("--drift-correction", action="store_true", help="correct drift using pool qc samples")
+    parser.add_argument(
+        "--run-order", action="store_true", help="order injections by acquisition time from file_times.csv")
+    parser.add_argument(
+        "--imputation", choices=("half_min", "blank_lod", "knn"), help="fill missing heights, none by default")
+    parser.add_argument(
+        "--batch", default=None,
+        help="batch_id, acquisition_time, or injections per batch for per-batch blanks, one batch by default")
+    parser.add_argument("--blank-subtraction", action="store_true", help="subtract the blank average of each batch")
+    parser.add_argument("--registry", help="registry .sqlite file to match reduced features against and store them in")
+    parser.add_argument("--workers", type=int, default=2, help="exports processed at the same time")
+    parser.add_argument("--settle", type=float, default=SETTLE_SECONDS, help="seconds a file must be unchanged")
+    parser.add_argument("--chrome-driver", default="", help="full directory path to Chrome driver")
+    parser.add_argument("--downloads", default="", help="full directory path to downloads folder")
+    parser.add_argument("--no-msflo", action="store_true", help="only reduce, report, export, and statistics")
+    parser.add_argument("--once", action="store_true", help="process exports already in the folder and exit")
+    args = parser.parse_args()
+
+    assert os.path.isdir(args.folder), f"{args.folder} is not a folder"
+    assert args.workers >= 1, "workers must be at least 1"
+    assert args.no_msflo or os.path.exists(args.chrome_driver), "--chrome-driver is required for ms-flo"
+    assert args.no_msflo or os.path.isdir(args.downloads), "--downloads is required for ms-flo"
+
+    assert args.batch in (None, "batch_id", "acquisition_time") or args.batch.isdigit(), \
+        "--batch must be batch_id, acquisition_time, or a number of injections"
+
+    batch = int(args.batch) if args.batch is not None and args.batch.isdigit() else args.batch
+    parameters = dict(
+        instruments.PRESETS[args.preset], drift_correction=args.drift_correction, run_order=args.run_order,
+        imputation=args.imputation, batch=batch, blank_subtraction=args.blank_subtraction, registry=args.registry)
+    stages = ["reduce", "projection", "report", "export", "statistics", "registry"] if args.no_msflo else None
+
+    watch_folder(
+        os.path.abspath(args.folder), parameters, args.chrome_driver, args.downloads, stages, args.workers,
+        args.settle, args.once)
+
+
+if __name__ == "__main__":
+
+    main()
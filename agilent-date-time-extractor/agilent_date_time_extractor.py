@@ -1,20 +1,24 @@
 
 from pathlib import Path
 import os
-import re
+import sys
 import pyinputplus
 import csv
 import time
 
+# sample name pattern is shared with the data reduction scripts
+sys.path.append(str(Path(__file__).resolve().parent.parent / "Metabolomics-Automate-Data-Reduction"))
+from sample_names import SAMPLE_NAME
+
 # get input for folder containing raw data files
 folder = pyinputplus.inputFilepath("Enter folder containing raw data files: ")
 
 # extract date time out from folder structure for each data file
 file_time = {}
-regex_pattern = re.compile(r'[a-z0-9A-Z]+_[a-z0-9A-Z]+_[a-zA-Z]+')
 for file in os.listdir(folder):
-    file_match = regex_pattern.search(file)
-    if file_match != None:
+    # raw data folders end in .d, the sample name is matched without it
+    file_match = SAMPLE_NAME.match(os.path.splitext(file)[0])
+    if file_match != None and file_match.group('study') != None:
         p = Path(folder) / file / 'AcqData' / 'sample_info.xml'
         file_time[file] = {'mtime': p.stat().st_mtime, 'ctime': time.ctime(p.stat().st_mtime)}
 
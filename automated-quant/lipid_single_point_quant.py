@@ -6,13 +6,27 @@ import pandas as pd
 import numpy as np
 import re
 import csv
+import sys
 from pathlib import Path
 import pyinputplus
 
+# shared MS-Dial reader lives with the data reduction scripts
+sys.path.append(str(Path(__file__).resolve().parent.parent / "Metabolomics-Automate-Data-Reduction"))
+import msdial
+import excel
+from sample_names import SAMPLE_NAME
+
 FIRST_COLUMN = 1
 FIRST_ROW = 1
 SECOND_ROW = 2
 
+# adduct families, a feature without an iSTD of its own class is quantified by the closest eluting iSTD of its family
+# adducts not listed are their own family, the sign of each family is the polarity of its adducts
+ADDUCT_FAMILIES = {
+    "[M+H]+": "+H", "[M]+": "+H", "[M+]": "+H", "[M+H-H2O]+": "+H",
+    "[M+Na]+": "+Na", "[M+NH4]+": "+NH4", "[M+K]+": "+K",
+    "[M-H]-": "-H", "[M-H2O-H]-": "-H", "[M+CH3COO]-": "-CH3COO", "[M+HCOO]-": "-HCOO", "[M+Cl]-": "-Cl"}
+
 
 def set_standards_from_csv(df):
     """takes in csv file with standard information and generates dictionary of standards information
@@ -63,19 +77,18 @@ def set_named_constant(df, pattern):
             return column_name
 
 
-def set_sample_name_list(df, pattern):
+def set_sample_name_list(df, pattern=SAMPLE_NAME):
     """returns all samples column headers in data frame to list
     Parameters:
         df (data frame): user excel sheet in pandas data frame
-        pattern: regex pattern to match
+        pattern: compiled sample name pattern shared with the data reduction scripts, names need a minix and mode
     Returns:
         list of sample names in data frame
     """
     sample_names = []
-    regex_pattern = re.compile(pattern)
     for column_name in df.columns:
-        found = regex_pattern.search(column_name.lower())
-        if found != None:
+        found = pattern.match(str(column_name))
+        if found != None and found.group("study") != None:
             sample_names.append(column_name)
     return sample_names
 
@@ -109,6 +122,65 @@ def find_matching_istd(df, row, standards):
             return standard_name
 
 
+def adduct_families(adducts):
+    """returns adduct family of each adduct, adducts not in ADDUCT_FAMILIES are their own family
+    Parameters:
+        adducts: adduct of each feature, ex: Species column
+    Returns:
+        numpy array of family names
+    """
+    adducts = pd.Series(adducts).astype(object).fillna("").astype(str).str.strip()
+    return adducts.map(lambda adduct: ADDUCT_FAMILIES.get(adduct, adduct)).to_numpy(dtype=object)
+
+
+def assign_istds(df, standards):
+    """assigns each feature its iSTD by iSTD match number, features whose number has no iSTD in the sheet get the
+    closest eluting iSTD of the same adduct family
+    Parameters:
+        df (data frame): user excel sheet in pandas data frame
+        standards: dictionary of standards in formath {name: {"ID":, "Row", "ng_extracted"}}
+    Returns:
+        istd_names: numpy array of the iSTD name of each feature, None if its adduct family has no iSTD in the sheet
+        fallback: numpy bool array, True where the iSTD was assigned by retention time
+    """
+    # standards found in the sheet, the first standard of each match number is used as find_matching_istd does
+    annotations = set(df[ANNOTATION_NAME_COLUMN].astype(str))
+    present = [name for name in standards if name in annotations]
+    by_id = {}
+    for name in present:
+        by_id.setdefault(standards[name]["ID"], name)
+
+    istd_names = df[ISTD_MATCH_COLUMN].map(by_id).to_numpy(dtype=object, copy=True)
+    istd_names[pd.isna(istd_names)] = None
+    orphans = np.flatnonzero(pd.isna(istd_names))
+
+    # standards of each family are sorted by retention time once, every orphan is placed by binary search
+    families = adduct_families(df[ADDUCT_COLUMN])
+    retention_times = pd.to_numeric(df[RETENTION_TIME_COLUMN], errors="coerce").to_numpy(dtype=float)
+    standard_rows = np.array([standards[name]["Row"] for name in present], dtype=int)
+    standard_names = np.array(present, dtype=object)
+    for family in pd.unique(families[orphans]):
+        in_family = (families[standard_rows] == family) & np.isfinite(retention_times[standard_rows])
+        rows = orphans[(families[orphans] == family) & np.isfinite(retention_times[orphans])]
+        if not in_family.any() or not len(rows):
+            continue
+
+        order = np.argsort(retention_times[standard_rows[in_family]], kind="stable")
+        sorted_names = standard_names[in_family][order]
+        sorted_times = retention_times[standard_rows[in_family]][order]
+
+        # nearest of the standards eluting just before and just after each orphan
+        after = np.clip(np.searchsorted(sorted_times, retention_times[rows]), 0, len(sorted_times) - 1)
+        before = np.clip(after - 1, 0, len(sorted_times) - 1)
+        closer_after = (np.abs(sorted_times[after] - retention_times[rows])
+                        < np.abs(retention_times[rows] - sorted_times[before]))
+        istd_names[rows] = sorted_names[np.where(closer_after, after, before)]
+
+    fallback = np.zeros(len(df), dtype=bool)
+    fallback[orphans] = ~pd.isna(istd_names[orphans])
+    return istd_names, fallback
+
+
 def calculate_results(df, sample_name_list, standards, sample_amount):
     """calculates single point quant results for entire data frame
     Parameters:
@@ -117,26 +189,34 @@ def calculate_results(df, sample_name_list, standards, sample_amount):
         standards: dictionary of standards in formath {name: {"ID":, "Row", "ng_extracted"}}
         sample_amount: dictionary of sample names as key and sample amount as value
     Returns:
-        df_store_calculations - new data frame with calculated results
+        df_store_calculations - new data frame with calculated results, the iSTD of each feature, and whether it was
+        assigned by retention time fallback, features without an iSTD are left empty
     """
 
     # create a new data frame to store values in
     df_store_calculations = df.copy()
 
-    for sample in sample_name_list:
-        for row in range(len(df)):
-            # get matching internal standards and native values needed for calculation
-            standard = find_matching_istd(df, row, standards)
-            standard_row = standards[standard]["Row"]
-            standard_concentration = standards[standard]["ng_extracted"]
-            native_height = df[sample][row]
-            istd_height = df[sample][standard_row]
-
-            # update data frame location with calculated value
-            calculated_concentration = (
-                    ((native_height / istd_height) * standard_concentration) / sample_amount[sample])
-            df_store_calculations.loc[row,
-                                      sample] = calculated_concentration
+    # get matching internal standard of every feature
+    istd_names, fallback = assign_istds(df, standards)
+    assigned = ~pd.isna(istd_names)
+    standard_rows = np.array([standards[name]["Row"] if name is not None else 0 for name in istd_names], dtype=int)
+    standard_concentration = np.array(
+        [standards[name]["ng_extracted"] if name is not None else np.nan for name in istd_names], dtype=float)
+
+    # every sample of every feature at once, same operation order as the single value formula
+    native_heights = df[sample_name_list].to_numpy(dtype=float)
+    istd_heights = native_heights[standard_rows]
+    amounts = np.array([sample_amount[sample] for sample in sample_name_list], dtype=float)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        calculated_concentrations = ((native_heights / istd_heights) * standard_concentration[:, None]) / amounts
+    calculated_concentrations[~assigned] = np.nan
+    df_store_calculations[sample_name_list] = pd.DataFrame(
+        calculated_concentrations, index=df.index, columns=sample_name_list)
+
+    # record which iSTD quantified each feature and which were assigned by retention time
+    position = df_store_calculations.columns.get_loc(ISTD_MATCH_COLUMN) + 1
+    df_store_calculations.insert(position, "Quant iSTD", np.where(assigned, istd_names, ""))
+    df_store_calculations.insert(position + 1, "iSTD Fallback", fallback)
 
     return df_store_calculations
 
@@ -181,7 +261,7 @@ if __name__ == "__main__":
             try:
                 df_path = pyinputplus.inputFilepath(
                     "Enter full file path for data excel sheet: ", mustExist=True)
-                df = pd.read_excel(df_path)
+                df = msdial.read_table(df_path)
                 break
             except FileNotFoundError:
                 print(FileNotFoundError)
@@ -189,8 +269,9 @@ if __name__ == "__main__":
         # set named constants and sample names from data frame
         ISTD_MATCH_COLUMN = set_named_constant(df, r'number')
         ANNOTATION_NAME_COLUMN = set_named_constant(df, r'name')
-        sample_names = set_sample_name_list(
-            df, r'[a-z0-9A-Z]+_[a-z0-9A-Z]+_[a-zA-Z]+')
+        RETENTION_TIME_COLUMN = set_named_constant(df, r'rt\(min\)|retention')
+        ADDUCT_COLUMN = set_named_constant(df, r'species|adduct')
+        sample_names = set_sample_name_list(df)
 
         # get standards csv file from user and populate standards dictionary
         standards = set_standards_from_csv(df)
@@ -200,10 +281,12 @@ if __name__ == "__main__":
 
         # calculate results and save to new excel sheet
         df_after_calculations = calculate_results(df, sample_names, standards, sample_amount)
+        print(f"{int(df_after_calculations['iSTD Fallback'].sum())} features quantified by closest eluting iSTD "
+              f"of their adduct family, {int((df_after_calculations['Quant iSTD'] == '').sum())} without an iSTD")
         path_obj = Path(df_path)
         save_path = str(path_obj.parent / path_obj.stem) + \
                     '_SinglePointQuant.xlsx'
-        df_after_calculations.to_excel(save_path, index=False)
+        excel.write_excel(df_after_calculations, save_path)
 
         # allow user to repeat on another sheet, or exit program
         again = pyinputplus.inputYesNo(
@@ -0,0 +1,461 @@
+#!/usr/bin/env python
+
+""" run_benchmarks.py: Times pipeline hot paths on synthetic data and appends results to benchmark history """
+
+__author__ = "Bryan Roberts"
+
+import argparse
+import datetime
+import json
+import os
+import platform
+import subprocess
+import sys
+import tempfile
+import time
+
+import numpy as np
+import pandas as pd
+
+import synthetic  # local source
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+HISTORY_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "history.jsonl")
+
+# every tool folder is importable so benchmarks call the same functions the scripts do
+for folder in (
+        "Metabolomics-Automate-Data-Reduction",
+        "automated-quant",
+        "MS-Dial-Batch-Alignment",
+        "Bootcamp-Internal-Standard-Finder"):
+
+    sys.path.append(os.path.join(ROOT, folder))
+
+
+def best_time(function, setup, repeat):
+    """ best wall time of function over repeats, setup is run untimed before each call
+
+    Parameters:
+            function (callable): called with the arguments returned by setup
+            setup (callable): returns tuple of arguments for function
+            repeat (int): number of timed calls
+
+    Returns:
+            float: fastest call in seconds
+
+    """
+
+    times = []
+    for _ in range(repeat):
+
+        arguments = setup()
+        start = time.perf_counter()
+        function(*arguments)
+        times.append(time.perf_counter() - start)
+
+    return min(times)
+
+
+def bench_filter_file(work_dir, features, samples, args):
+    """ reduce.filter_file on a synthetic MS-Dial .txt export """
+
+    import reduce
+
+    return best_time(reduce.filter_file, lambda: (os.path.join(work_dir, "export.txt"),), args.repeat)
+
+
+def bench_add_reduction_columns(work_dir, features, samples, args):
+    """ reduce.add_reduction_columns on the filtered export """
+
+    import reduce
+
+    data_frame = reduce.filter_file(os.path.join(work_dir, "export.txt"))
+    reduce.determine_feature_type(data_frame)
+    blanks, biorecs, pools, study_samples = [], [], [], []
+    reduce.filter_samples(data_frame, blanks, biorecs, pools, study_samples)
+
+    return best_time(
+        reduce.add_reduction_columns,
+        lambda: (data_frame.copy(), blanks, study_samples, pools),
+        args.repeat)
+
+
+def bench_create_single_point_file(work_dir, features, samples, args):
+    """ msflo.create_single_point_file on the filtered export written to a temporary folder """
+
+    import msflo
+    import reduce
+
+    data_frame = reduce.filter_file(os.path.join(work_dir, "export.txt"))
+    reduce.determine_feature_type(data_frame)
+    file_path = os.path.join(work_dir, f"Bench_{synthetic.MINIX}_{synthetic.MODE}_toBeProcessed.txt")
+
+    return best_time(msflo.create_single_point_file, lambda: (file_path, data_frame.copy()), args.repeat)
+
+
+def bench_write_excel(work_dir, features, samples, args):
+    """ excel.write_excel of the filtered export to a temporary folder """
+
+    import excel
+    import reduce
+
+    data_frame = reduce.filter_file(os.path.join(work_dir, "export.txt"))
+    file_path = os.path.join(work_dir, "write_excel.xlsx")
+
+    return best_time(excel.write_excel, lambda: (data_frame, file_path), args.repeat)
+
+
+def bench_feature_statistics(work_dir, features, samples, args):
+    """ univariate.feature_statistics of two alternating groups of study samples, Welch and Mann-Whitney tests """
+
+    import reduce
+    import univariate
+
+    data_frame = reduce.filter_file(os.path.join(work_dir, "export.txt"))
+    reduce.determine_feature_type(data_frame)
+    blanks, biorecs, pools, study_samples = [], [], [], []
+    reduce.filter_samples(data_frame, blanks, biorecs, pools, study_samples)
+    design = pd.Series(["A", "B"] * (len(study_samples) // 2) + ["A"] * (len(study_samples) % 2), index=study_samples)
+
+    def both_tests(data_frame, design):
+
+        univariate.feature_statistics(data_frame, design, "A", "welch")
+        univariate.feature_statistics(data_frame, design, "A", "mannwhitney")
+
+    return best_time(both_tests, lambda: (data_frame, design), args.repeat)
+
+
+def bench_registry_match(work_dir, features, samples, args):
+    """ registry.match of the synthetic export against 20 registered studies with shifted retention times """
+
+    import msdial
+    import registry
+
+    export = msdial.read_export(os.path.join(work_dir, "export.txt"))
+    records = registry.feature_records(export.metadata)
+
+    registry_path = os.path.join(work_dir, "registry.sqlite")
+    if os.path.exists(registry_path):
+
+        os.remove(registry_path)
+
+    connection = registry.connect(registry_path)
+    for number in range(20):
+
+        registry.register(
+            connection, f"study{number}", synthetic.MODE, records.assign(rt=records["rt"] + 0.004 * number))
+
+    try:
+
+        return best_time(registry.match, lambda: (connection, records, synthetic.MODE, "new"), args.repeat)
+
+    finally:
+
+        connection.close()
+
+
+def bench_join_file_times(work_dir, features, samples, args):
+    """ run_order.join_file_times of the export's sample columns against a folder of 100 runs of raw data files """
+
+    import msdial
+    import run_order
+
+    columns = msdial.read_sample_info(os.path.join(work_dir, "export.txt")).index.tolist()
+    names = [f"Run{number:03d}_{column}.d" for number in range(99) for column in columns]
+    names += [column.upper() + ".D" for column in columns]
+
+    rng = np.random.default_rng(0)
+    times = pd.Series(
+        pd.Timestamp("2024-01-01") + pd.to_timedelta(rng.permutation(len(names)) * 600, unit="s"),
+        index=pd.Index(names, name="Sample"), name="Acquired")
+
+    return best_time(run_order.join_file_times, lambda: (columns, times), args.repeat)
+
+
+def bench_qc_projection(work_dir, features, samples, args):
+    """ projection.qc_projection of the biorec, pool, and sample injections of the filtered export """
+
+    import projection
+    import reduce
+
+    data_frame = reduce.filter_file(os.path.join(work_dir, "export.txt"))
+
+    return best_time(projection.qc_projection, lambda: (data_frame,), args.repeat)
+
+
+def bench_calculate_results(work_dir, features, samples, args):
+    """ lipid_single_point_quant.calculate_results on a synthetic iSTD annotated sheet """
+
+    import lipid_single_point_quant
+
+    df, sample_names, standards, sample_amount = synthetic.quant_sheet(features, samples)
+
+    # column names are set by the script's main block
+    lipid_single_point_quant.ISTD_MATCH_COLUMN = "iSTD Matching Number"
+    lipid_single_point_quant.ANNOTATION_NAME_COLUMN = "Metabolite name"
+    lipid_single_point_quant.RETENTION_TIME_COLUMN = "Average Rt(min)"
+    lipid_single_point_quant.ADDUCT_COLUMN = "Species"
+
+    return best_time(
+        lipid_single_point_quant.calculate_results,
+        lambda: (df, sample_names, standards, sample_amount),
+        args.repeat)
+
+
+def bench_find_match(work_dir, features, samples, args):
+    """ MSDialBatchAlignment.findMatch aligning a second batch of the synthetic export by name """
+
+    import msdial
+    import MSDialBatchAlignment
+
+    export = msdial.read_export(os.path.join(work_dir, "export.txt"), dtype=np.float64)
+    results_names = MSDialBatchAlignment.getNames(export)
+
+    return best_time(MSDialBatchAlignment.findMatch, lambda: (export, results_names), args.repeat)
+
+
+def bench_find_standards(work_dir, features, samples, args):
+    """ bootcampInternalStandards.findStandards searching the synthetic export for CSH standards """
+
+    import openpyxl
+    import msdial
+    import bootcampInternalStandards
+
+    export = msdial.read_export(os.path.join(work_dir, "export.txt"))
+    retention_times = msdial.metadata_column(export, msdial.RT_COLUMNS).to_numpy(dtype=float)
+    mass_to_charges = msdial.metadata_column(export, msdial.MZ_COLUMNS).to_numpy(dtype=float)
+    standards = bootcampInternalStandards.getStandards(2)
+
+    # file name is set by the script's main loop
+    bootcampInternalStandards.fileName = "export.txt"
+
+    return best_time(
+        bootcampInternalStandards.findStandards,
+        lambda: (retention_times, mass_to_charges, openpyxl.Workbook().active, 2, 2, standards),
+        args.repeat)
+
+
+def bench_calibrate_standards(work_dir, features, samples, args):
+    """ bootcampInternalStandards.calibrateStandards correcting drift and matching CSH standards of the export """
+
+    import msdial
+    import bootcampInternalStandards
+
+    export = msdial.read_export(os.path.join(work_dir, "export.txt"))
+    retention_times = msdial.metadata_column(export, msdial.RT_COLUMNS).to_numpy(dtype=float)
+    mass_to_charges = msdial.metadata_column(export, msdial.MZ_COLUMNS).to_numpy(dtype=float)
+    heights = export.heights.mean(axis=1, dtype=float)
+    standards = bootcampInternalStandards.getStandards(2)
+
+    return best_time(
+        bootcampInternalStandards.calibrateStandards,
+        lambda: (retention_times, mass_to_charges, heights, standards),
+        args.repeat)
+
+
+def bench_parse_spectra(work_dir, features, samples, args):
+    """ spectra.parse_spectra on the MS/MS spectrum column of the synthetic export """
+
+    import msdial
+    import spectra
+
+    export = msdial.read_export(os.path.join(work_dir, "export.txt"))
+    spectrum_strings = export.metadata["MS/MS spectrum"].to_numpy()
+
+    return best_time(spectra.parse_spectra, lambda: (spectrum_strings,), args.repeat)
+
+
+def bench_cosine_scores(work_dir, features, samples, args):
+    """ spectra.cosine_scores of ten pairs per feature """
+
+    import msdial
+    import spectra
+
+    export = msdial.read_export(os.path.join(work_dir, "export.txt"))
+    parsed = spectra.parse_spectra(export.metadata["MS/MS spectrum"].to_numpy())
+    rng = np.random.default_rng(0)
+    first = rng.integers(0, features, features * 10)
+    second = rng.integers(0, features, features * 10)
+
+    return best_time(spectra.cosine_scores, lambda: (parsed, first, second), args.repeat)
+
+
+def import_time(modules, not_loaded, repeat):
+    """ best wall time of a fresh interpreter importing modules, fails if any of not_loaded was imported with them
+
+    Parameters:
+            modules (list): modules imported by the interpreter
+            not_loaded (list): heavy modules that must not be imported by modules
+            repeat (int): number of timed interpreters
+
+    Returns:
+            float: fastest interpreter in seconds
+
+    """
+
+    code = (
+        f"import sys\nimport {', '.join(modules)}\n"
+        f"loaded = [name for name in {list(not_loaded)!r} if name in sys.modules]\n"
+        f"assert not loaded, f'imported {{loaded}}'")
+    folder = os.path.join(ROOT, "Metabolomics-Automate-Data-Reduction")
+
+    def start():
+
+        result = subprocess.run([sys.executable, "-c", code], cwd=folder, capture_output=True, text=True)
+        if result.returncode:
+
+            raise RuntimeError(result.stderr.strip().splitlines()[-1])
+
+    return best_time(start, tuple, repeat)
+
+
+def bench_startup(work_dir, features, samples, args):
+    """ interpreter start and imports of process.py before its first question """
+
+    return import_time(["process"], ["pandas", "numpy", "plotly", "selenium"], args.repeat)
+
+
+def bench_reduce_only_imports(work_dir, features, samples, args):
+    """ imports needed by a reduce-only pipeline run, without plotting or browser modules """
+
+    return import_time(["pipeline", "reduce", "drift", "qc_metrics"], ["plotly", "selenium"], args.repeat)
+
+
+# benchmarks still scaling with features x samples python loops, skipped above --slow-limit cells
+SLOW_BENCHMARKS = ()
+
+BENCHMARKS = {
+    "reduce.filter_file": bench_filter_file,
+    "reduce.add_reduction_columns": bench_add_reduction_columns,
+    "msflo.create_single_point_file": bench_create_single_point_file,
+    "excel.write_excel": bench_write_excel,
+    "univariate.feature_statistics": bench_feature_statistics,
+    "projection.qc_projection": bench_qc_projection,
+    "registry.match": bench_registry_match,
+    "run_order.join_file_times": bench_join_file_times,
+    "lipid_single_point_quant.calculate_results": bench_calculate_results,
+    "MSDialBatchAlignment.findMatch": bench_find_match,
+    "bootcampInternalStandards.findStandards": bench_find_standards,
+    "bootcampInternalStandards.calibrateStandards": bench_calibrate_standards,
+    "spectra.parse_spectra": bench_parse_spectra,
+    "spectra.cosine_scores": bench_cosine_scores,
+    "process.startup": bench_startup,
+    "pipeline.reduce_only_imports": bench_reduce_only_imports}
+
+
+def git_commit():
+    """ short hash of current commit, None outside a git checkout """
+
+    try:
+
+        return subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"], cwd=ROOT, capture_output=True, text=True,
+            check=True).stdout.strip()
+
+    except (OSError, subprocess.CalledProcessError):
+
+        return None
+
+
+def previous_result(history, record):
+    """ most recent history record for the same benchmark and parameters """
+
+    keys = ("benchmark", "features", "samples", "blank_ratio", "pool_ratio")
+    matches = [old for old in history if all(old.get(key) == record[key] for key in keys) and old.get("seconds")]
+
+    return matches[-1] if matches else None
+
+
+def read_history(history_file):
+    """ reads all benchmark records from json lines history file """
+
+    if not os.path.exists(history_file):
+
+        return []
+
+    with open(history_file) as history:
+
+        return [json.loads(line) for line in history if line.strip()]
+
+
+def main():
+
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--features", type=int, nargs="+", default=[1000, 5000], help="feature counts")
+    parser.add_argument("--samples", type=int, nargs="+", default=[50, 200], help="injection counts")
+    parser.add_argument("--blank-ratio", type=float, default=0.05, help="fraction of injections that are blanks")
+    parser.add_argument("--pool-ratio", type=float, default=0.1, help="fraction of injections that are pool qcs")
+    parser.add_argument("--repeat", type=int, default=3, help="timed calls per benchmark, fastest is kept")
+    parser.add_argument(
+        "--slow-limit", type=int, default=50000, help="largest features x samples run for slow benchmarks")
+    parser.add_argument("--only", nargs="+", choices=sorted(BENCHMARKS), help="benchmarks to run")
+    parser.add_argument("--history", default=HISTORY_FILE, help="json lines file results are appended to")
+    args = parser.parse_args()
+
+    history = read_history(args.history)
+    run = {
+        "timestamp": datetime.datetime.now().isoformat(timespec="seconds"),
+        "commit": git_commit(),
+        "python": platform.python_version(),
+        "numpy": np.__version__,
+        "pandas": pd.__version__,
+        "machine": platform.node()}
+
+    records = []
+    for features in args.features:
+
+        for samples in args.samples:
+
+            with tempfile.TemporaryDirectory() as work_dir:
+
+                synthetic.write_alignment_export(
+                    os.path.join(work_dir, "export.txt"), features, samples, args.blank_ratio, args.pool_ratio)
+
+                for name in args.only or BENCHMARKS:
+
+                    record = dict(
+                        run, benchmark=name, features=features, samples=samples, blank_ratio=args.blank_ratio,
+                        pool_ratio=args.pool_ratio, repeat=args.repeat, seconds=None, error=None)
+
+                    if name in SLOW_BENCHMARKS and features * samples > args.slow_limit:
+
+                        record["error"] = f"skipped: above --slow-limit of {args.slow_limit} cells"
+
+                    # missing optional dependencies (selenium, pyinputplus) are recorded instead of stopping the run
+                    else:
+
+                        try:
+
+                            record["seconds"] = round(BENCHMARKS[name](work_dir, features, samples, args), 6)
+
+                        except ImportError as error:
+
+                            record["error"] = f"skipped: {error}"
+
+                        # startup benchmarks fail when a heavy module is imported too early
+                        except RuntimeError as error:
+
+                            record["error"] = f"failed: {error}"
+
+                    previous = previous_result(history, record)
+                    change = ""
+                    if previous and record["seconds"]:
+
+                        change = f"  ({previous['seconds'] / record['seconds']:.2f}x vs {previous['commit']})"
+
+                    result = record["error"] or f"{record['seconds']:.4f} s"
+                    print(f"{name:45} {features:>7} x {samples:<6} {result}{change}")
+                    records.append(record)
+
+    with open(args.history, "a") as history_file:
+
+        for record in records:
+
+            history_file.write(json.dumps(record) + "\n")
+
+    print(f"results appended: {args.history}")
+
+
+if __name__ == "__main__":
+
+    main()
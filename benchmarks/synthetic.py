@@ -0,0 +1,246 @@
+#!/usr/bin/env python
+
+""" synthetic.py: Generates synthetic MS-Dial alignment exports and iSTD annotated quant sheets for benchmarks """
+
+__author__ = "Bryan Roberts"
+
+import csv
+
+import numpy as np
+import pandas as pd
+
+# MS-Dial 4 metadata columns, sample columns start after MS/MS spectrum
+METADATA_COLUMNS = [
+    "Alignment ID", "Average Rt(min)", "Average Mz", "Metabolite name", "Adduct type", "Post curation result",
+    "Fill %", "MS/MS assigned", "Reference RT", "Reference m/z", "Formula", "Ontology", "INCHIKEY", "SMILES",
+    "Annotation tag (VS1.0)", "RT matched", "m/z matched", "MS/MS matched", "Comment",
+    "Manually modified for quantification", "Manually modified for annotation", "Isotope tracking parent ID",
+    "Isotope tracking weight number", "Total score", "RT similarity", "Dot product", "Reverse dot product",
+    "Fragment presence %", "S/N average", "Spectrum reference file name", "MS1 isotopic spectrum", "MS/MS spectrum"]
+
+# rows above the column header, labelled in the MS/MS spectrum column
+HEADER_LABELS = ["Class", "File type", "Injection order", "Batch ID"]
+
+# lipid classes used for iSTD and native annotations with their positive mode adducts
+CLASSES = [
+    ("CE", "[M+Na]+"), ("Cer", "[M+H]+"), ("DAG", "[M+Na]+"), ("LPC", "[M+H]+"), ("LPE", "[M+H]+"),
+    ("PC", "[M+H]+"), ("PE", "[M+H]+"), ("SM", "[M+H]+"), ("TAG", "[M+NH4]+")]
+
+MINIX = "MX000000"
+MODE = "posCSH"
+
+
+def sample_names(samples, blank_ratio=0.05, pool_ratio=0.1, biorec_ratio=0.05):
+    """ creates sample names in injection order following Name###_MX######_Mode_SampleID-Num
+
+    Parameters:
+            samples (int): total number of injections
+            blank_ratio (float): fraction of injections that are method blanks
+            pool_ratio (float): fraction of injections that are pool qc samples
+            biorec_ratio (float): fraction of injections that are biorec samples
+
+    Returns:
+            names (list): sample column names, qc injections spread evenly through the run
+
+    """
+
+    sample_type = ["Sample"] * samples
+
+    # qc injections are spread evenly through the run, moving to the next free injection when taken
+    for name, ratio in (("MtdBlank", blank_ratio), ("PoolQC", pool_ratio), ("Biorec", biorec_ratio)):
+
+        count = int(round(samples * ratio))
+        for injection in np.linspace(0, samples - 1, count).round().astype(int) if count else []:
+
+            while injection < samples - 1 and sample_type[injection] != "Sample":
+
+                injection += 1
+
+            sample_type[injection] = name
+
+    return [f"Bench{injection + 1:04d}_{MINIX}_{MODE}_{name}-{injection + 1:04d}"
+            for injection, name in enumerate(sample_type)]
+
+
+def feature_table(features, samples, blank_ratio=0.05, pool_ratio=0.1, istd_fraction=0.01, known_fraction=0.2,
+                  seed=0):
+    """ creates metadata and heights for a synthetic alignment
+
+    Parameters:
+            features (int): number of features
+            samples (int): number of injections
+            blank_ratio (float): fraction of injections that are method blanks
+            pool_ratio (float): fraction of injections that are pool qc samples
+            istd_fraction (float): fraction of features annotated as internal standards
+            known_fraction (float): fraction of features annotated as knowns, the rest are unknowns
+            seed (int): random seed
+
+    Returns:
+            metadata (pandas data-frame): MS-Dial metadata columns
+            heights (pandas data-frame): peak heights with sample names as columns
+
+    """
+
+    rng = np.random.default_rng(seed)
+    names = sample_names(samples, blank_ratio, pool_ratio)
+
+    # annotations: iSTDs first, then knowns, then unknowns
+    istds = max(int(features * istd_fraction), len(CLASSES))
+    knowns = int(features * known_fraction)
+    lipid_class = rng.integers(0, len(CLASSES), features)
+    lipid_class[:istds] = np.arange(istds) % len(CLASSES)
+
+    metabolite_name = []
+    adduct = []
+    for feature in range(features):
+
+        class_name, class_adduct = CLASSES[lipid_class[feature]]
+
+        if feature < istds:
+
+            metabolite_name.append(f"1_{class_name} {17 + feature // len(CLASSES)}:0-d7 iSTD")
+
+        elif feature < istds + knowns:
+
+            metabolite_name.append(
+                f"{class_name} {30 + feature % 14}:{feature % 6}{class_adduct}_AAAAAAAAAAAAAA-BBBBBBBBBB-N")
+
+        else:
+
+            metabolite_name.append("Unknown")
+
+        adduct.append(class_adduct)
+
+    metadata = pd.DataFrame({column: [""] * features for column in METADATA_COLUMNS})
+    metadata["Alignment ID"] = np.arange(features)
+    metadata["Average Rt(min)"] = np.round(rng.uniform(0.5, 13, features), 3)
+    metadata["Average Mz"] = np.round(rng.uniform(100, 1200, features), 4)
+    metadata["Metabolite name"] = metabolite_name
+    metadata["Adduct type"] = adduct
+    metadata["MS/MS assigned"] = "True"
+    metadata["INCHIKEY"] = "AAAAAAAAAAAAAA-BBBBBBBBBB-N"
+    metadata["Reverse dot product"] = rng.integers(0, 1000, features)
+    metadata["Spectrum reference file name"] = names[0]
+    metadata["MS/MS spectrum"] = "100.0:1000 150.5:250 201.1:75"
+
+    # heights: lognormal abundance, slow drift over the run, low blank signal, and some missing values
+    abundance = rng.lognormal(9, 1.5, (features, 1))
+    drift = 1 + 0.2 * np.sin(np.linspace(0, np.pi, samples))
+    heights = abundance * drift * rng.lognormal(0, 0.15, (features, samples))
+    is_blank = np.array(["MtdBlank" in name for name in names])
+    heights[:, is_blank] *= rng.uniform(0, 0.1, (features, is_blank.sum()))
+    heights[rng.random((features, samples)) < 0.02] = 0
+
+    return metadata, pd.DataFrame(np.round(heights).astype(np.int64), columns=names)
+
+
+def write_alignment_export(file_location, features, samples, blank_ratio=0.05, pool_ratio=0.1, seed=0):
+    """ writes synthetic MS-Dial alignment export as tab separated .txt or .xlsx
+
+    Parameters:
+            file_location (str): Full directory path of file to be written, ending in .txt or .xlsx
+            features (int): number of features
+            samples (int): number of injections
+            blank_ratio (float): fraction of injections that are method blanks
+            pool_ratio (float): fraction of injections that are pool qc samples
+            seed (int): random seed
+
+    Returns:
+            None
+
+    """
+
+    metadata, heights = feature_table(features, samples, blank_ratio, pool_ratio, seed=seed)
+    names = list(heights.columns)
+
+    header_rows = []
+    for label in HEADER_LABELS:
+
+        if label == "Class":
+
+            values = [name.split("_")[3].split("-")[0] for name in names]
+
+        elif label == "File type":
+
+            values = ["Blank" if "MtdBlank" in name else "QC" if "PoolQC" in name else "Sample" for name in names]
+
+        elif label == "Injection order":
+
+            values = [str(injection + 1) for injection in range(len(names))]
+
+        else:
+
+            values = ["1"] * len(names)
+
+        header_rows.append([""] * (len(METADATA_COLUMNS) - 1) + [label] + values)
+
+    frame = pd.concat([metadata, heights], axis=1)
+
+    if file_location.endswith(".xlsx"):
+
+        import openpyxl
+
+        workbook = openpyxl.Workbook(write_only=True)
+        sheet = workbook.create_sheet()
+        for row in header_rows:
+
+            sheet.append([value if value != "" else None for value in row])
+
+        sheet.append(list(frame.columns))
+        for row in frame.itertuples(index=False):
+
+            sheet.append(list(row))
+
+        workbook.save(file_location)
+
+    else:
+
+        with open(file_location, "w", newline="") as text_file:
+
+            csv.writer(text_file, delimiter="\t").writerows(header_rows)
+            frame.to_csv(text_file, sep="\t", index=False)
+
+
+def quant_sheet(features, samples, seed=0):
+    """ creates iSTD annotated sheet and standards for lipid_single_point_quant.calculate_results
+
+    Parameters:
+            features (int): number of features including one iSTD per class
+            samples (int): number of sample columns
+            seed (int): random seed
+
+    Returns:
+            df (pandas data-frame): quant sheet with iSTD Matching Number and Metabolite name columns
+            sample_names (list): sample columns of df
+            standards (dict): {name: {"Row", "ID", "ng_extracted"}} for each iSTD
+            sample_amount (dict): amount extracted for each sample
+
+    """
+
+    rng = np.random.default_rng(seed)
+    names = [f"Sample{sample + 1:04d}_{MINIX}_{MODE}_S-{sample + 1:04d}" for sample in range(samples)]
+
+    # first rows are the iSTDs, natives are assigned the number of their class iSTD
+    match_number = np.concatenate([
+        np.arange(1, len(CLASSES) + 1), rng.integers(1, len(CLASSES) + 1, features - len(CLASSES))])
+    metabolite_name = [f"1_{CLASSES[number - 1][0]} iSTD" if row < len(CLASSES) else
+                       f"{CLASSES[number - 1][0]} {30 + row % 14}:{row % 6}" for row, number in
+                       enumerate(match_number)]
+
+    df = pd.DataFrame({
+        "identifier": [f"feature{row}" for row in range(features)],
+        "Average Mz": np.round(rng.uniform(100, 1200, features), 4),
+        "Average Rt(min)": np.round(rng.uniform(0.5, 13, features), 3),
+        "iSTD Matching Number": match_number,
+        "Metabolite name": metabolite_name,
+        "Species": [CLASSES[number - 1][1] for number in match_number]})
+    # float heights, calculate_results writes concentrations back into the sample columns
+    heights = pd.DataFrame(np.round(rng.lognormal(9, 1.5, (features, samples))), columns=names)
+    df = pd.concat([df, heights], axis=1)
+
+    standards = {
+        metabolite_name[row]: {"Row": row, "ID": int(match_number[row]), "ng_extracted": 100.0}
+        for row in range(len(CLASSES))}
+    sample_amount = {name: 1.0 for name in names}
+
+    return df, names, standards, sample_amount